@@ -0,0 +1,94 @@
+"""Реестр действий /api/action.
+
+Каждый тип действия — отдельная функция, зарегистрированная со схемой
+обязательных полей. Перед вызовом поля проверяются, а сам вызов
+измеряется: число вызовов, отказов и гистограмма времени по типу действия
+(видно на /metrics).
+
+    @actions.register('buy', user=str, menuId=int)
+    def act_buy(db, d, now_time, now_full):
+        ...
+        return None                       # успех
+        return {"error": "..."}, 400      # отказ
+
+Типы в схеме: str, int, float (числа и числовые строки), list, dict или
+кортеж из них — любой из перечисленных.
+"""
+import time
+
+from logs import get_logger
+from metrics import Counter, Histogram
+
+ACTION_CALLS = Counter('canteen_action_total', 'Вызовы действий /api/action', ['action'])
+ACTION_ERRORS = Counter('canteen_action_errors_total', 'Отказы и исключения действий /api/action', ['action'])
+ACTION_LATENCY = Histogram('canteen_action_duration_seconds', 'Время обработчика действия без коммита, сек',
+                           ['action'])
+
+
+def _matches(value, kind):
+    if isinstance(kind, tuple):
+        return any(_matches(value, k) for k in kind)
+    if kind in (int, float):
+        if isinstance(value, bool):
+            return False
+        if isinstance(value, (int, float)):
+            return kind is float or float(value).is_integer()
+        if isinstance(value, str):
+            try:
+                kind(value)
+                return True
+            except ValueError:
+                return False
+        return False
+    return isinstance(value, kind)
+
+
+class ActionRegistry:
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, action_type, /, **schema):
+        def decorator(fn):
+            self._handlers[action_type] = (fn, schema)
+            return fn
+        return decorator
+
+    @staticmethod
+    def validate(schema, d):
+        """Текст ошибки для первого отсутствующего или неверного поля, иначе None"""
+        for field, kind in schema.items():
+            if d.get(field) is None:
+                return f"нет поля {field}"
+            if not _matches(d[field], kind):
+                return f"неверный тип поля {field}"
+        return None
+
+    def dispatch(self, db, d, *args):
+        """Проверяет и выполняет действие d['type']. Возвращает None или (тело ошибки, HTTP-код)"""
+        act = d.get('type')
+        entry = self._handlers.get(act)
+        if entry is None:
+            get_logger('ACTION').warning(f"⚠️ Неизвестное действие: {act}")
+            ACTION_ERRORS.inc(action='unknown')
+            return {"error": f"Неизвестное действие: {act}", "code": "unknown_action"}, 400
+
+        fn, schema = entry
+        start = time.perf_counter()
+        try:
+            problem = self.validate(schema, d)
+            if problem:
+                error = {"error": f"Некорректные данные: {problem}", "code": "invalid"}, 400
+            else:
+                error = fn(db, d, *args)
+        except Exception:
+            ACTION_ERRORS.inc(action=act)
+            raise
+        finally:
+            ACTION_CALLS.inc(action=act)
+            ACTION_LATENCY.observe(time.perf_counter() - start, action=act)
+        if error:
+            ACTION_ERRORS.inc(action=act)
+        return error
+
+
+actions = ActionRegistry()
@@ -0,0 +1,190 @@
+"""Индекс аллергенов: блюда и аллергии учеников в виде id аллергенов.
+
+Раньше клиент на каждой перерисовке меню для каждого блюда и каждой
+аллергии ученика искал подстроки в составе — dishes × allergens строковых
+сравнений в браузере. Теперь сопоставление делается один раз при записи:
+
+    allergens        id и нормализованное имя (строчные буквы)
+    allergen_terms   слово состава → аллерген («сыр» → лактоза); имя
+                     аллергена — тоже слово
+    dish_allergens   (allergenId, dishId) — заполняется при add_menu_item
+    user_allergens   (username, allergenId) — заполняется при save_profile
+
+Слово ищется подстрокой в составе без учёта регистра, как это делал клиент
+(«орех» находится в «грецкие орехи»). Аллергия не из списка («клубника»)
+заводится новым аллергеном с единственным словом — своим именем, и по нему
+один раз размечаются уже существующие блюда.
+
+/api/menu/safe по профилю ученика (набору id) берёт помеченные блюда одним
+запросом по первичному ключу dish_allergens и кэширует результат на профиль.
+Состав блюда после добавления не меняется, а блюда не удаляются, поэтому
+разметка меняется только с новым блюдом или новым аллергеном — версия кэша
+это MAX(id) меню и аллергенов. Порции берутся из кэша меню (menu.py) и
+остаются точными.
+
+    SAFE_MENU_CACHE_SIZE  сколько профилей держать в кэше (256)
+"""
+import json
+import os
+import threading
+
+SAFE_MENU_CACHE_SIZE = int(os.environ.get('SAFE_MENU_CACHE_SIZE', 256))
+
+# Тот же словарь, что был на клиенте
+ALLERGEN_TERMS = {
+    'лактоза': ('молоко', 'сливки', 'сметана', 'йогурт', 'кефир', 'творог', 'сыр', 'масло сливочное',
+                'сливочное масло', 'мороженое', 'сгущенка'),
+    'орехи': ('орех', 'арахис', 'миндаль', 'фундук', 'кешью', 'грецкий орех', 'фисташки', 'кедровые орехи'),
+    'глютен': ('пшеница', 'мука', 'хлеб', 'макароны', 'булка', 'печенье', 'рожь', 'ячмень', 'овёс', 'манка'),
+    'яйца': ('яйцо', 'яйца', 'желток', 'белок яичный', 'майонез'),
+    'цитрус': ('лимон', 'апельсин', 'мандарин', 'грейпфрут', 'лайм', 'цитрус'),
+    'морепродукты': ('рыба', 'креветки', 'краб', 'кальмар', 'мидии', 'осьминог', 'икра', 'лосось', 'тунец',
+                     'семга'),
+}
+
+
+def install_allergens(db):
+    """Таблицы индекса, словарь аллергенов и разметка существующих блюд и профилей"""
+    db.execute('''CREATE TABLE IF NOT EXISTS allergens (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS allergen_terms (
+        term TEXT PRIMARY KEY,
+        allergenId INTEGER NOT NULL) WITHOUT ROWID''')
+    db.execute('''CREATE TABLE IF NOT EXISTS dish_allergens (
+        allergenId INTEGER NOT NULL,
+        dishId INTEGER NOT NULL,
+        PRIMARY KEY (allergenId, dishId)) WITHOUT ROWID''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_dish_allergens_dish ON dish_allergens (dishId)")
+    db.execute('''CREATE TABLE IF NOT EXISTS user_allergens (
+        username TEXT NOT NULL,
+        allergenId INTEGER NOT NULL,
+        PRIMARY KEY (username, allergenId)) WITHOUT ROWID''')
+    for name, terms in ALLERGEN_TERMS.items():
+        allergen_id = _ensure(db, name)
+        db.executemany("INSERT OR IGNORE INTO allergen_terms (term, allergenId) VALUES (?, ?)",
+                       [(t, allergen_id) for t in terms])
+    reindex_allergens(db)
+
+
+def parse_allergies(text):
+    """Строка профиля «Лактоза, клубника» → нормализованные имена без повторов"""
+    names = (a.strip().lower() for a in (text or '').split(','))
+    return list(dict.fromkeys(n for n in names if n))
+
+
+def _ensure(db, name):
+    """id аллергена; новый заводится со своим именем как словом. Возвращает id"""
+    row = db.execute("SELECT id FROM allergens WHERE name = ?", (name,)).fetchone()
+    if row:
+        return row[0]
+    allergen_id = db.execute("INSERT INTO allergens (name) VALUES (?)", (name,)).lastrowid
+    db.execute("INSERT OR IGNORE INTO allergen_terms (term, allergenId) VALUES (?, ?)", (name, allergen_id))
+    return allergen_id
+
+
+def _terms(db):
+    return db.execute("SELECT term, allergenId FROM allergen_terms").fetchall()
+
+
+def _match(terms, ingredients):
+    """id аллергенов, слова которых есть в составе"""
+    text = (ingredients or '').lower()
+    return {allergen_id for term, allergen_id in terms if term in text} if text else set()
+
+
+def index_dish(db, dish_id, ingredients, terms=None):
+    """Размечает блюдо по составу. Возвращает id найденных аллергенов"""
+    found = _match(terms if terms is not None else _terms(db), ingredients)
+    db.execute("DELETE FROM dish_allergens WHERE dishId = ?", (dish_id,))
+    db.executemany("INSERT INTO dish_allergens (allergenId, dishId) VALUES (?, ?)",
+                   [(a, dish_id) for a in found])
+    return found
+
+
+def set_user_allergies(db, username, text):
+    """Профиль ученика из строки аллергий. Новые аллергены размечаются по всему меню. Возвращает профиль"""
+    known = dict(db.execute("SELECT name, id FROM allergens").fetchall())
+    ids = []
+    for name in parse_allergies(text):
+        if name not in known:
+            known[name] = _ensure(db, name)
+            # Новый аллерген — одно слово, размечаем по нему существующие блюда
+            db.executemany("INSERT OR IGNORE INTO dish_allergens (allergenId, dishId) VALUES (?, ?)",
+                           [(known[name], r[0]) for r in db.execute("SELECT id, ingredients FROM menu")
+                            if name in (r[1] or '').lower()])
+        ids.append(known[name])
+    db.execute("DELETE FROM user_allergens WHERE username = ?", (username,))
+    db.executemany("INSERT OR IGNORE INTO user_allergens (username, allergenId) VALUES (?, ?)",
+                   [(username, a) for a in ids])
+    return tuple(sorted(set(ids)))
+
+
+def reindex_allergens(db):
+    """Полная разметка меню и профилей (миграция, генератор тестовой базы). Возвращает (блюд, профилей)"""
+    db.execute("DELETE FROM dish_allergens")
+    db.execute("DELETE FROM user_allergens")
+    users = db.execute("SELECT username, allergies FROM users WHERE allergies IS NOT NULL AND allergies != ''").fetchall()
+    for username, allergies in users:
+        set_user_allergies(db, username, allergies)
+    terms = _terms(db)
+    dishes = db.execute("SELECT id, ingredients FROM menu").fetchall()
+    db.executemany("INSERT INTO dish_allergens (allergenId, dishId) VALUES (?, ?)",
+                   [(a, dish_id) for dish_id, ingredients in dishes for a in _match(terms, ingredients)])
+    return len(dishes), len(users)
+
+
+def user_profile(db, username):
+    """Профиль ученика — отсортированный кортеж id аллергенов"""
+    return tuple(r[0] for r in db.execute(
+        "SELECT allergenId FROM user_allergens WHERE username = ? ORDER BY allergenId", (username,)))
+
+
+class SafeMenuCache:
+    """Помеченные блюда по профилю аллергий: {id блюда: [имена аллергенов]}"""
+
+    def __init__(self, size=SAFE_MENU_CACHE_SIZE):
+        self.size = size
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _version(db):
+        return tuple(db.execute("SELECT (SELECT MAX(id) FROM menu), (SELECT MAX(id) FROM allergens)").fetchone())
+
+    def flagged(self, db, profile):
+        if not profile:
+            return {}
+        version = self._version(db)
+        # Профиль — набор id аллергенов базы: у каждого шарда школы свой
+        profile_key = (getattr(db, 'path', None), profile)
+        cached = self._profiles.get(profile_key)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        flagged = {}
+        for dish_id, name in db.execute('''SELECT da.dishId, a.name FROM dish_allergens da
+                JOIN allergens a ON a.id = da.allergenId
+                WHERE da.allergenId IN (SELECT value FROM json_each(?))
+                ORDER BY da.dishId, a.id''', (json.dumps(profile),)):
+            flagged.setdefault(dish_id, []).append(name)
+        with self._lock:
+            self._profiles.pop(profile_key, None)
+            while len(self._profiles) >= self.size:
+                # Вытесняем профиль, добавленный раньше всех
+                self._profiles.pop(next(iter(self._profiles)))
+            self._profiles[profile_key] = (version, flagged)
+        return flagged
+
+    def stats(self):
+        return {"profiles": len(self._profiles), "hits": self.hits, "misses": self.misses}
+
+
+safe_menu = SafeMenuCache()
+
+
+def safe_menu_stats():
+    return safe_menu.stats()
@@ -1,177 +1,233 @@
-from flask import Flask, render_template, request, jsonify
-import sqlite3
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from functools import wraps
 import os
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-from cryptography.fernet import Fernet
+from datetime import date, datetime
 import base64
+import hashlib
+import itertools
+import json
+import secrets
+import time
+
+from db import DB_NAME, get_db, pool_stats, connect, route, routed_path
+from pii import (PII_FIELDS, CONTACT_FIELDS, encrypt_data, decrypt_fields, forget_user,
+                 reset_request_counters, request_counters, cache_stats)
+from logs import get_logger, redact, log_stats
+from passwords import HashPoolBusy, hash_password, verify_password, hash_pool_stats
+from migrations import migrate
+from ordering import OrderRejected, NO_DISH, PAID, SOLD_OUT, begin_immediate, place_order
+from subscriptions import SUBSCRIPTION_TYPES, purchase, redeem
+from changes import (SYNC_TABLES, current_cursor, table_versions, cursor_is_valid,
+                     select_visible, collect_changes, prune_change_log)
+from events import DETACH_ENVIRON, EventBroker, EventHub, publish, publish_many, next_batch, prune_events, sse_message
+from inbox import notify, inbox_page, unread_count, mark_read, prune_notifications
+from archive import Archiver, history
+from menu import menu_cache, menu_cache_stats
+from ledger import balance, credit, snapshot_balances, to_kopecks
+from planning import forecast_view, recipes, set_recipe
+from allergens import index_dish, safe_menu, safe_menu_stats, set_user_allergies, user_profile
+from wire import FORMATS as WIRE_FORMATS, columnar_query, compress, dumps, encode_sync, negotiate, table_rows
+from stats import merge_stats, query_stats
+from export import EXPORTS, FORMATS
+from actions import actions
+from shards import NO_SCHOOL, fan_out, router
+from metrics import Gauge, Histogram, SIZE_BUCKETS, ROW_BUCKETS, render_all
 
 app = Flask(__name__)
-DB_NAME = "canteen_full.db"
 
-# ===== КЛЮЧ ШИФРОВАНИЯ =====
-# В продакшене храните этот ключ в переменных окружения!
-ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or Fernet.generate_key()
-cipher = Fernet(ENCRYPTION_KEY)
-
-
-def encrypt_data(data):
-    """Шифрует строку"""
-    if not data:
-        return ''
-    return cipher.encrypt(data.encode()).decode()
-
-
-def decrypt_data(data):
-    """Дешифрует строку"""
-    if not data:
-        return ''
-    try:
-        return cipher.decrypt(data.encode()).decode()
-    except:
-        return data  # Возвращаем как есть если не получилось расшифровать (для старых данных)
+# Журнал изменений чистим раз в N действий, а не на каждом запросе
+PRUNE_EVERY = 500
+
+# Метрики sync для /metrics (метрики действий — в actions.py)
+SYNC_BYTES = Histogram('canteen_sync_payload_bytes', 'Размер ответа /api/sync, байт', ['kind'], SIZE_BUCKETS)
+SYNC_ROWS = Histogram('canteen_sync_rows', 'Строк в ответе /api/sync', ['kind'], ROW_BUCKETS)
+SYNC_ENCODE_SECONDS = Histogram('canteen_sync_encode_seconds', 'Сериализация и сжатие ответа /api/sync, сек',
+                                ['format', 'encoding'])
+RUNTIME_STATS = Gauge('canteen_runtime', 'Пул БД, кэши расшифровки и меню, хэширование паролей и очередь логов',
+                      ['source', 'stat'])
+
+# Пакет действий /api/action/batch
+BATCH_MAX_ACTIONS = 500
+BATCH_MODES = ('all', 'best_effort')
+_prune_counter = itertools.count(1)
+
+# Ключ подписи сессионной cookie (кто вошёл) — отдельный от ключа шифрования персональных данных.
+# Без SECRET_KEY ключ случайный: после перезапуска все сессии сбрасываются
+app.secret_key = os.environ.get('SECRET_KEY')
+if not app.secret_key:
+    app.secret_key = secrets.token_hex(32)
+    get_logger('INIT').warning("⚠️ SECRET_KEY не задан: сессии подписаны случайным ключом и не переживут перезапуск")
+
+# Как долго держать соединение /api/events без событий (сек): SSE-пинг и таймаут long-poll
+EVENTS_HEARTBEAT = 15
+EVENTS_LONGPOLL_TIMEOUT = 25
+
+# Размер страницы для постраничных эндпоинтов
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def decrypt_user(u):
+    """Расшифровывает персональные данные пользователя (dict) на месте"""
+    return decrypt_fields(u, PII_FIELDS)
+
+
+def project_user(u, viewer):
+    """Строка пользователя для выдачи клиенту.
+
+    Хэш пароля не отдаётся никогда. Сам пользователь видит все свои данные,
+    админ — контакты остальных (без карт), прочим персональные данные
+    отдаются пустыми и вообще не расшифровываются.
+    """
+    u.pop('password', None)
+    if viewer and viewer['username'] == u['username']:
+        return decrypt_fields(u, PII_FIELDS)
+    visible = CONTACT_FIELDS if viewer and viewer['role'] == 'admin' else ()
+    for field in PII_FIELDS:
+        if field in u and field not in visible:
+            u[field] = ''
+    u.pop('cardExpiry', None)
+    return decrypt_fields(u, visible)
+
+
+def sync_scope(viewer):
+    """Какие строки /api/sync отдаются смотрящему — scope для changes.py.
+
+    Гость видит только меню, ученик — свои заказы, абонементы и профиль,
+    повар — очередь выдачи с выданным за сегодня, склад и закупки, админ — всё.
+    Права по абонементам (entitlements) каждый получает только свои.
+    """
+    if viewer is None:
+        return {name: None for name, _, _ in SYNC_TABLES if name != 'menu'}
+    me = (viewer['username'],)
+    if viewer['role'] == 'admin':
+        return {'entitlements': ("user = ?", me, False)}
+    scope = {'users': ("username = ?", me, False), 'reviews': None, 'entitlements': ("user = ?", me, False)}
+    if viewer['role'] == 'chef':
+        # Заказ из очереди, выданный сегодня, но купленный раньше, из видимых уходит
+        scope.update({
+            'orders': ("status = ? OR (status = 'Выдано' AND createdAt >= ?)", (PAID, date.today().isoformat()), True),
+            'subTransactions': None,
+            'subscriptionUsage': None,
+        })
+    else:
+        scope.update({
+            'orders': ("user = ?", me, False),
+            'ingredients': None,
+            'purchases': None,
+            'subTransactions': ("user = ?", me, False),
+            'subscriptionUsage': ("user = ?", me, False),
+        })
+    return scope
 
 
-def get_db():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Дефолтный админ и тестовые аккаунты: (логин, пароль, остальные поля)
+SEED_USERS = [
+    ('admin', '123', {'fullName': 'Главный Админ', 'role': 'admin', 'school': 'Система', 'isApproved': 1}),
+    ('a', '1', {'fullName': 'Иван Иванов', 'role': 'student', 'school': 'ГБОУ Школа №656', 'grade': '9А',
+                'balance': 1000, 'isApproved': 1}),
+    ('aa', '1', {'fullName': 'Мария Петрова', 'role': 'chef', 'school': 'ГБОУ Школа №656',
+                 'phone': '+7 999 123-45-67', 'email': 'chef@school.ru', 'isApproved': 1}),
+    ('aaa', '1', {'fullName': 'Администратор Тестовый', 'role': 'admin', 'school': 'ГБОУ Школа №656',
+                  'isApproved': 1}),
+]
 
 
 def init_db():
-    with get_db() as db:
-        # Пользователи
-        db.execute('''CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY, password TEXT, fullName TEXT, role TEXT, 
-            school TEXT, grade TEXT, phone TEXT, email TEXT, balance REAL DEFAULT 0, 
-            allergies TEXT DEFAULT '', isApproved INTEGER DEFAULT 1,
-            cardNumber TEXT DEFAULT '', cardHolder TEXT DEFAULT '', cardExpiry TEXT DEFAULT '')''')
-
-        # Меню (добавлено поле ingredients для состава блюда)
-        db.execute('''CREATE TABLE IF NOT EXISTS menu (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            name TEXT, 
-            price REAL, 
-            portions INTEGER, 
-            type TEXT, 
-            ingredients TEXT DEFAULT '',
-            addedDate TEXT)''')
-
-        # Заказы
-        db.execute('''CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            user TEXT, 
-            name TEXT, 
-            price REAL, 
-            status TEXT, 
-            allergies TEXT, 
-            issuedAt TEXT, 
-            createdAt TEXT)''')
-
-        # Ингредиенты
-        db.execute('''CREATE TABLE IF NOT EXISTS ingredients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            name TEXT, 
-            amount REAL, 
-            unit TEXT)''')
-
-        # Прочее
-        db.execute('''CREATE TABLE IF NOT EXISTS reviews (
-            dish TEXT, 
-            text TEXT, 
-            author TEXT)''')
-
-        db.execute('''CREATE TABLE IF NOT EXISTS purchases (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            item TEXT, 
-            qty TEXT, 
-            price REAL DEFAULT 0,
-            status TEXT)''')
-
-        db.execute('''CREATE TABLE IF NOT EXISTS notifications (
-            title TEXT, 
-            text TEXT, 
-            type TEXT, 
-            toUser TEXT, 
-            toRole TEXT, 
-            time TEXT)''')
-
-        db.execute('''CREATE TABLE IF NOT EXISTS sub_transactions (
-            user TEXT, 
-            type TEXT, 
-            amount REAL, 
-            time TEXT)''')
-
-        db.execute('''CREATE TABLE IF NOT EXISTS subscription_usage (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT,
-            subType TEXT,
-            date TEXT,
-            dishesUsed TEXT,
-            createdAt TEXT)''')
-
-        # Проверяем существование столбца ingredients и добавляем если его нет
-        cursor = db.execute("PRAGMA table_info(menu)")
-        columns = [column[1] for column in cursor.fetchall()]
-
-        if 'ingredients' not in columns:
-            print("[MIGRATION] Добавляем поле 'ingredients' в таблицу menu...")
-            db.execute("ALTER TABLE menu ADD COLUMN ingredients TEXT DEFAULT ''")
+    # Школы тестовых аккаунтов подключаются сами; без шардов все пути — одна база
+    seeds = {}
+    for username, password, fields in SEED_USERS:
+        path = router.path_for_school(fields['school']) or router.add_school(fields['school'])
+        seeds.setdefault(path, []).append((username, password, fields))
+
+    paths = router.paths()
+    for path in paths:
+        with get_db(path) as db:
+            # Схема и индексы — версионными миграциями (migrations.py)
+            migrate(db)
+
+            prune_change_log(db)
+            prune_events(db)
+            prune_notifications(db)
+            snapshot_balances(db)
+
+            seed_users(db, seeds.get(path, []))
             db.commit()
-            print("[MIGRATION] ✅ Поле 'ingredients' успешно добавлено!")
+    get_logger('INIT').info("✅ База данных инициализирована с зашифрованными данными", databases=len(paths))
+
+
+def seed_users(db, users):
+    """Дефолтный админ и тестовые аккаунты. Пароли хэшируем только для тех, кого ещё нет:
+    scrypt на каждом импорте заметно замедлял запуск воркеров и тестов"""
+    if not users:
+        return
+    existing = {r[0] for r in db.execute(
+        f"SELECT username FROM users WHERE username IN ({','.join('?' * len(users))})",
+        [u[0] for u in users]).fetchall()}
+    for username, password, fields in users:
+        if username in existing:
+            continue
+        row = dict(fields, username=username, password=hash_password(password))
+        for field in CONTACT_FIELDS:
+            if row.get(field):
+                row[field] = encrypt_data(row[field])
+        db.execute(f"INSERT OR IGNORE INTO users ({', '.join(row)}) VALUES ({','.join('?' * len(row))})",
+                   list(row.values()))
+        router.claim(username, fields['school'])
 
-        if 'category' not in columns:
-            print("[MIGRATION] Добавляем поле 'category' в таблицу menu...")
-            db.execute("ALTER TABLE menu ADD COLUMN category TEXT DEFAULT 'Обед'")
-            db.commit()
-            print("[MIGRATION] ✅ Поле 'category' успешно добавлено!")
 
-        # Проверяем существование столбца price в таблице purchases
-        cursor = db.execute("PRAGMA table_info(purchases)")
-        purchase_columns = [column[1] for column in cursor.fetchall()]
+init_db()
+archiver = Archiver(paths=router.paths)
+_brokers = {}
+# Ожидающие /api/events и /api/events/poll под canteen serve — без потока запроса на каждого
+events_hub = EventHub(EVENTS_HEARTBEAT)
 
-        if 'price' not in purchase_columns:
-            print("[MIGRATION] Добавляем поле 'price' в таблицу purchases...")
-            db.execute("ALTER TABLE purchases ADD COLUMN price REAL DEFAULT 0")
-            db.commit()
-            print("[MIGRATION] ✅ Поле 'price' успешно добавлено!")
 
-        # Проверяем существование полей карты в таблице users
-        cursor = db.execute("PRAGMA table_info(users)")
-        user_columns = [column[1] for column in cursor.fetchall()]
+def broker():
+    """Брокер событий базы текущего запроса: у каждого шарда своя таблица events"""
+    path = routed_path()
+    events = _brokers.get(path)
+    if events is None:
+        events = _brokers.setdefault(path, EventBroker(lambda: get_db(path)))
+    return events
 
-        if 'cardNumber' not in user_columns:
-            print("[MIGRATION] Добавляем поля карты в таблицу users...")
-            db.execute("ALTER TABLE users ADD COLUMN cardNumber TEXT DEFAULT ''")
-            db.execute("ALTER TABLE users ADD COLUMN cardHolder TEXT DEFAULT ''")
-            db.execute("ALTER TABLE users ADD COLUMN cardExpiry TEXT DEFAULT ''")
-            db.commit()
-            print("[MIGRATION] ✅ Поля карты успешно добавлены!")
 
-        # Дефолтный админ
-        db.execute(
-            "INSERT OR IGNORE INTO users (username, password, fullName, role, school, isApproved) VALUES (?,?,?,?,?,?)",
-            ('admin', generate_password_hash('123'), 'Главный Админ', 'admin', 'Система', 1))
+@app.before_request
+def _reset_pii_counters():
+    reset_request_counters()
 
-        # Тестовые аккаунты (хэшированные пароли, зашифрованные данные)
-        db.execute(
-            "INSERT OR IGNORE INTO users (username, password, fullName, role, school, grade, balance, isApproved) VALUES (?,?,?,?,?,?,?,?)",
-            ('a', generate_password_hash('1'), 'Иван Иванов', 'student', 'ГБОУ Школа №656', '9А', 1000, 1))
 
-        db.execute(
-            "INSERT OR IGNORE INTO users (username, password, fullName, role, school, phone, email, isApproved) VALUES (?,?,?,?,?,?,?,?)",
-            ('aa', generate_password_hash('1'), 'Мария Петрова', 'chef', 'ГБОУ Школа №656',
-             encrypt_data('+7 999 123-45-67'), encrypt_data('chef@school.ru'), 1))
+@app.before_request
+def _route_request():
+    """Запрос работает с базой школы пользователя сессии (shards.py); гость — ?school= или первая школа"""
+    if not router.enabled:
+        return
+    school = session.get('school')
+    if school is None and session.get('username'):
+        # Сессия открыта до включения шардов
+        school = session['school'] = router.locate(session['username'])[0]
+    path = router.path_for_school(school or request.args.get('school'))
+    route(path or router.first_path())
 
-        db.execute(
-            "INSERT OR IGNORE INTO users (username, password, fullName, role, school, isApproved) VALUES (?,?,?,?,?,?)",
-            ('aaa', generate_password_hash('1'), 'Администратор Тестовый', 'admin', 'ГБОУ Школа №656', 1))
 
-        db.commit()
-        print("[INIT] ✅ База данных инициализирована с зашифрованными данными")
+@app.teardown_request
+def _unroute_request(exc):
+    if router.enabled:
+        route(None)
 
 
-init_db()
+@app.before_request
+def _start_archiver():
+    # Фоновый перенос старой истории в архив (archive.py); в каждом процессе — свой поток
+    archiver.ensure_started()
+
+
+@app.after_request
+def _report_pii_counters(resp):
+    # Сколько раз запрос просил расшифровать данные и сколько из них дошло до Fernet (мимо кэша)
+    calls, fernet = request_counters()
+    resp.headers['X-PII-Decrypts'] = f'{calls}/{fernet}'
+    return resp
 
 
 @app.route('/')
@@ -181,93 +237,625 @@ def index():
 
 @app.route('/api/sync')
 def sync():
-    """Синхронизация всех данных - используется всеми пользователями"""
+    """Синхронизация данных - используется всеми пользователями.
+
+    Без параметров возвращает полный снимок (первая загрузка). С ?since=<курсор>
+    возвращает только строки, изменённые после курсора, или 304 если изменений нет.
+    ?format=columnar — таблицы столбцами с одним заголовком (wire.py).
+    """
+    since = request.args.get('since', type=int)
+    fmt = request.args.get('format', 'json')
+    if fmt not in WIRE_FORMATS:
+        return jsonify({"error": f"format: {' или '.join(WIRE_FORMATS)}"}), 400
+    viewer = current_user()
+
     with get_db() as db:
-        menu_items = [dict(r) for r in db.execute("SELECT * FROM menu ORDER BY id DESC").fetchall()]
-        orders_list = [dict(r) for r in db.execute("SELECT * FROM orders ORDER BY id DESC").fetchall()]
-
-        print(f"[SYNC] ✅ Отправляем {len(menu_items)} блюд в меню")
-        print(f"[SYNC] ✅ Отправляем {len(orders_list)} заказов")
-
-        # Выводим первые 3 блюда для проверки
-        if menu_items:
-            print("[SYNC] Первые блюда в меню:")
-            for item in menu_items[:3]:
-                ingredients_info = f", состав: {item.get('ingredients', 'не указан')}" if item.get(
-                    'ingredients') else ""
-                print(f"  - {item['name']} ({item['price']}₽, {item['portions']} порций{ingredients_info})")
-
-        # Расшифровываем персональные данные пользователей
-        users_raw = [dict(r) for r in db.execute("SELECT * FROM users").fetchall()]
-        users_decrypted = []
-        for u in users_raw:
-            if u.get('phone'):
-                u['phone'] = decrypt_data(u['phone'])
-            if u.get('email'):
-                u['email'] = decrypt_data(u['email'])
-            if u.get('cardNumber'):
-                u['cardNumber'] = decrypt_data(u['cardNumber'])
-            if u.get('cardHolder'):
-                u['cardHolder'] = decrypt_data(u['cardHolder'])
-            users_decrypted.append(u)
+        cursor = current_cursor(db)
+        etag = f'sync-{cursor}-{viewer_tag(viewer)}' + ('' if fmt == 'json' else f'-{fmt}')
+
+        if since == cursor or (since is None and request.if_none_match.contains_weak(etag)):
+            return _sync_response(None, etag, fmt, status=304, kind='not_modified')
+
+        if since is not None and since < cursor and cursor_is_valid(db, since):
+            changes = collect_changes(db, since, cursor, scope=sync_scope(viewer),
+                                      row_hook=lambda name, row: project_user(row, viewer) if name == 'users' else row)
+            rows = sum(len(c['upserts']) + len(c['deleted']) for c in changes.values())
+            get_logger('SYNC').info("Дельта", since=since, cursor=cursor, rows=rows)
+            return _sync_response({
+                "full": False,
+                "cursor": cursor,
+                "versions": table_versions(db),
+                "changes": changes
+            }, etag, fmt, kind='delta', rows=rows)
+
+        # Полный снимок: первая загрузка или курсор клиента устарел
+        snapshot = full_snapshot(db, viewer, fmt)
+        rows = sum(table_rows(v) for v in snapshot.values())
+        snapshot.update({"full": True, "cursor": cursor, "versions": table_versions(db)})
+        return _sync_response(snapshot, etag, fmt, kind='full', rows=rows)
+
+
+def viewer_tag(viewer):
+    """Часть ETag снимка: чей он и за какой день (у повара в снимке выданное за сегодня)"""
+    if viewer is None:
+        return 'guest'
+    key = f"{viewer['username']}\0{viewer['role']}\0{date.today().isoformat()}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def full_snapshot(db, viewer, fmt='json'):
+    """Синхронизируемые таблицы в объёме, положенном смотрящему (sync_scope): строки отбираются в SQL.
+
+    Для columnar таблицы без расшифровки собираются прямо из кортежей SQLite, без словаря на строку.
+    """
+    scope = sync_scope(viewer)
+    snapshot = {}
+    for name, table, key in SYNC_TABLES:
+        if table == 'menu':
+            snapshot[name] = menu_cache.all(db)
+            continue
+        if name in scope and scope[name] is None:
+            snapshot[name] = []
+            continue
+        where, params, _ = scope.get(name) or (None, (), False)
+        query = select_visible(table, key, where)
+        if table == 'orders':
+            query += " ORDER BY id DESC"
+        if fmt == 'columnar' and table != 'users':
+            snapshot[name] = columnar_query(db, query, params)
+        else:
+            snapshot[name] = [dict(r) for r in db.execute(query, params).fetchall()]
+
+    get_logger('SYNC').info("Полный снимок", menu=table_rows(snapshot['menu']), orders=table_rows(snapshot['orders']))
+
+    # Расшифровываем персональные данные только там, где они положены смотрящему
+    snapshot['users'] = [project_user(u, viewer) for u in snapshot['users']]
+    return snapshot
+
+
+def _sync_response(payload, etag, fmt, status=200, kind='full', rows=0):
+    """Ответ sync с ETag, в формате fmt и со сжатием по Accept-Encoding.
+
+    Ответ свой у каждого смотрящего: общие кэши его не хранят, а браузер не отдаёт
+    снимок, полученный до входа, после входа (Vary: Cookie).
+    """
+    if payload is None:
+        resp = app.response_class(status=status)
+    else:
+        start = time.perf_counter()
+        encoding = negotiate(request.accept_encodings)
+        body, encoding = compress(dumps(encode_sync(payload, fmt)), encoding)
+        SYNC_ENCODE_SECONDS.observe(time.perf_counter() - start, format=fmt, encoding=encoding or 'identity')
+        resp = app.response_class(body, status=status, mimetype='application/json')
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+    # Тело зависит от сжатия — ETag слабый
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Accept-Encoding')
+    resp.vary.add('Cookie')
+    SYNC_BYTES.observe(resp.calculate_content_length() or 0, kind=kind)
+    SYNC_ROWS.observe(rows, kind=kind)
+    return resp
+
+
+@app.route('/metrics')
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    for source, stats in (('db_pool', pool_stats()), ('pii_cache', cache_stats()), ('menu_cache', menu_cache_stats()),
+                          ('safe_menu_cache', safe_menu_stats()), ('password_hashing', hash_pool_stats()), ('logging', log_stats()),
+                          ('shards', router.stats()), ('events_hub', events_hub.stats())):
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                RUNTIME_STATS.set(value, source=source, stat=stat)
+    return app.response_class(render_all(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/db/stats')
+def db_stats():
+    """Статистика пула соединений, кэшей расшифровки и меню, пула хэширования паролей, очереди логов,
+    шардов и подписчиков событий процесса"""
+    return jsonify(dict(pool_stats(), piiCache=cache_stats(), menuCache=menu_cache_stats(),
+                        safeMenuCache=safe_menu_stats(), passwordHashing=hash_pool_stats(), logging=log_stats(),
+                        shards=router.stats(), eventsHub=events_hub.stats()))
+
+
+@app.route('/api/events')
+def events_stream():
+    """Поток событий об изменениях (Server-Sent Events).
+
+    Событие — маленькая подсказка, что поменялось; данные клиент забирает
+    через /api/sync?since=. Пока событий нет, соединение ждёт без запросов к БД.
+    Под canteen serve после заголовков соединение уходит в events_hub, и поток
+    запроса возвращается в пул; сервер разработки держит поток на подписку.
+    """
+    viewer = current_user()
+    viewer = dict(viewer) if viewer else None
+    # База и брокер запроса фиксируются до начала потока
+    path, events = routed_path(), broker()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('after', type=int)
+    if last_id is None:
+        last_id = events.latest()
+
+    detach = request.environ.get(DETACH_ENVIRON)
+
+    def stream(last_id):
+        yield "retry: 3000\n\n"
+        if detach:
+            events_hub.add(detach(), events, lambda: get_db(path), viewer, last_id)
+            return
+        while True:
+            latest = events.wait(last_id, EVENTS_HEARTBEAT)
+            if latest <= last_id:
+                yield ": ping\n\n"
+                continue
+            with get_db(path) as db:
+                batch, last_id = next_batch(db, last_id, latest, viewer)
+            for e in batch:
+                yield sse_message(e)
+
+    resp = Response(stream_with_context(stream(last_id)), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+    return resp
+
+
+@app.route('/api/events/poll')
+def events_poll():
+    """Long-poll для клиентов без SSE: ждёт события после ?after= не дольше ?timeout= сек.
+
+    Под canteen serve ожидание, как и поток /api/events, идёт в events_hub без потока запроса.
+    """
+    viewer = current_user()
+    viewer = dict(viewer) if viewer else None
+    after = request.args.get('after', type=int)
+    events = broker()
+    if after is None:
+        return jsonify({"events": [], "cursor": events.latest()})
+
+    timeout = min(request.args.get('timeout', EVENTS_LONGPOLL_TIMEOUT, type=float), EVENTS_LONGPOLL_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    detach = request.environ.get(DETACH_ENVIRON)
+    if detach:
+        path = routed_path()
+
+        def handoff():
+            # Пустой кусок отправляет заголовки, тело допишет хаб
+            yield b''
+            events_hub.add(detach(), events, lambda: get_db(path), viewer, after, deadline)
+
+        return Response(handoff(), mimetype='application/json')
+
+    while True:
+        latest = events.wait(after, max(0, deadline - time.monotonic()))
+        if latest > after:
+            with get_db() as db:
+                batch, after = next_batch(db, after, latest, viewer)
+            if batch:
+                return jsonify({"events": batch, "cursor": after})
+        if time.monotonic() >= deadline:
+            return jsonify({"events": [], "cursor": after})
+
+
+# ===== ПОЛЬЗОВАТЕЛЬ СЕССИИ И ПРАВА =====
+
+def current_user():
+    """Пользователь текущей сессии (username, role, school) или None"""
+    username = session.get('username')
+    if not username:
+        return None
+    with get_db() as db:
+        return db.execute("SELECT username, role, school, isApproved FROM users WHERE username = ?",
+                          (username,)).fetchone()
+
+
+def require_role(*roles):
+    """Декоратор: эндпоинт доступен только вошедшему пользователю с одной из ролей"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            u = current_user()
+            if not u:
+                return jsonify({"error": "Требуется вход"}), 401
+            if roles and u['role'] not in roles:
+                return jsonify({"error": "Недостаточно прав"}), 403
+            return f(u, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def page_limit():
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_page(db, select, where, params, key='id', descending=True, row_hook=None):
+    """Постраничная выборка по ключу (keyset): WHERE ... AND key </> курсор ORDER BY key LIMIT.
+
+    Курсор берётся из ?before= (по убыванию) или ?after= (по возрастанию).
+    Возвращает {"items": [...], "next": курсор следующей страницы или None}.
+    """
+    return _keyset(db, select, where, params, key, descending, row_hook, page_limit(), page_cursor(key, descending))
+
+
+def page_cursor(key='id', descending=True):
+    return request.args.get('before' if descending else 'after', type=int if key != 'username' else str)
+
+
+def _keyset(db, select, where, params, key, descending, row_hook, limit, cursor):
+    where = list(where)
+    params = list(params)
+    if cursor is not None:
+        where.append(f"{key} {'<' if descending else '>'} ?")
+        params.append(cursor)
+    query = select + (" WHERE " + " AND ".join(where) if where else "")
+    query += f" ORDER BY {key} {'DESC' if descending else 'ASC'} LIMIT ?"
+    rows = [dict(r) for r in db.execute(query, params + [limit + 1]).fetchall()]
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_key = '_rid' if key == 'rowid' else key.split('.')[-1]
+    items = [row_hook(r) for r in rows] if row_hook else rows
+    return {"items": items, "next": rows[-1][next_key] if has_more else None}
+
+
+def sharded_page(paths, select, where, params, key='id', descending=True, row_hook=None):
+    """keyset_page по нескольким базам (шардам школ): страница с каждой и слияние по ключу.
+
+    Ключи в шардах не пересекаются: логины уникальны по каталогу, id — по диапазонам школ (shards.py).
+    """
+    limit, cursor = page_limit(), page_cursor(key, descending)
+    pages = fan_out(lambda db: _keyset(db, select, where, params, key, descending, row_hook, limit, cursor), paths)
+    if len(pages) == 1:
+        return pages[0]
+    next_key = '_rid' if key == 'rowid' else key.split('.')[-1]
+    items = sorted((r for p in pages for r in p['items']), key=lambda r: r[next_key], reverse=descending)
+    has_more = len(items) > limit or any(p['next'] is not None for p in pages)
+    items = items[:limit]
+    return {"items": items, "next": items[-1][next_key] if has_more and items else None}
+
+
+# ===== ЭНДПОИНТЫ ПО РОЛЯМ =====
+# Каждый отдаёт только данные своей роли/пользователя с WHERE и LIMIT в SQL,
+# чтобы объём ответа не рос вместе с историей всей школы.
+
+@app.route('/api/menu')
+def menu_view():
+    """Текущее меню (доступно всем)"""
+    category = request.args.get('category')
+    with get_db() as db:
+        rows = menu_cache.all(db)
+    return jsonify([r for r in rows if r['category'] == category] if category else rows)
+
+
+@app.route('/api/menu/safe')
+@require_role()
+def safe_menu_view(u):
+    """Меню без блюд с аллергенами пользователя; помеченные блюда — в flagged с найденными аллергенами"""
+    category = request.args.get('category')
+    with get_db() as db:
+        flagged = safe_menu.flagged(db, user_profile(db, u['username']))
+        rows = menu_cache.all(db)
+    if category:
+        rows = [r for r in rows if r['category'] == category]
+    return jsonify({"items": [r for r in rows if r['id'] not in flagged],
+                    "flagged": {str(r['id']): flagged[r['id']] for r in rows if r['id'] in flagged}})
+
+
+@app.route('/api/schools')
+def schools_view():
+    """Школы для регистрации; sharded — регистрация только в подключённых школах"""
+    return jsonify({"sharded": router.enabled, "schools": router.schools()})
+
+
+@app.route('/api/me')
+@require_role()
+def me_view(u):
+    with get_db() as db:
+        row = db.execute("SELECT * FROM users WHERE username = ?", (u['username'],)).fetchone()
+        return jsonify(project_user(dict(row), u))
+
+
+@app.route('/api/me/orders')
+@require_role()
+def my_orders(u):
+    """Заказы пользователя, от новых к старым"""
+    where, params = ["user = ?"], [u['username']]
+    if request.args.get('status'):
+        where.append("status = ?")
+        params.append(request.args['status'])
+    with get_db() as db:
+        return jsonify(keyset_page(db, "SELECT * FROM orders", where, params))
+
+
+@app.route('/api/me/ledger')
+@require_role()
+def my_ledger(u):
+    """Баланс в копейках и операции по счёту, от новых к старым"""
+    with get_db() as db:
+        page = keyset_page(db, "SELECT * FROM ledger", ["user = ?"], [u['username']])
+        return jsonify(dict(page, balance=balance(db, u['username'])))
+
+
+@app.route('/api/me/notifications')
+@require_role()
+def my_notifications(u):
+    """Входящие: личные уведомления и объявления для роли, от новых к старым, с признаком read"""
+    with get_db() as db:
+        return jsonify(inbox_page(db, u['username'], u['role'], request.args.get('before', type=int),
+                                  page_limit()))
+
+
+@app.route('/api/me/notifications/unread')
+@require_role()
+def my_unread_notifications(u):
+    """Число непрочитанных уведомлений для бейджа"""
+    with get_db() as db:
+        return jsonify(unread_count(db, u['username'], u['role']))
+
+
+@app.route('/api/me/notifications/read', methods=['POST'])
+@require_role()
+def mark_notifications_read(u):
+    """Отмечает прочитанными уведомления до {"upTo": id} включительно (без upTo — все)"""
+    up_to = (request.get_json(silent=True) or {}).get('upTo')
+    if up_to is not None and not isinstance(up_to, int):
+        return jsonify({"error": "upTo должен быть числом"}), 400
+    with get_db() as db:
+        last_read = mark_read(db, u['username'], up_to)
+        db.commit()
+    return jsonify({"ok": True, "lastReadId": last_read})
+
 
+@app.route('/api/me/subscriptions')
+@require_role('student')
+def my_subscriptions(u):
+    """Действующие права, купленные абонементы и история их использования"""
+    with get_db() as db:
+        transactions = [dict(r) for r in db.execute(
+            "SELECT rowid AS _rid, * FROM sub_transactions WHERE user = ? ORDER BY rowid DESC",
+            (u['username'],)).fetchall()]
+        usage = keyset_page(db, "SELECT * FROM subscription_usage", ["user = ?"], [u['username']])
+        entitlements = [dict(r) for r in db.execute(
+            "SELECT rowid AS _rid, * FROM entitlements WHERE user = ? ORDER BY type", (u['username'],)).fetchall()]
+        return jsonify({"entitlements": entitlements, "transactions": transactions, "usage": usage})
+
+
+@app.route('/api/chef/queue')
+@require_role('chef', 'admin')
+def chef_queue(u):
+    """Очередь выдачи: оплаченные заказы в порядке поступления"""
+    with get_db() as db:
+        return jsonify(keyset_page(
+            db, "SELECT orders.*, users.grade FROM orders LEFT JOIN users ON users.username = orders.user",
+            ["orders.status = 'Оплачено'"], [], key='orders.id', descending=False))
+
+
+@app.route('/api/chef/stock')
+@require_role('chef', 'admin')
+def chef_stock(u):
+    """Остатки порций по блюдам и склад ингредиентов"""
+    with get_db() as db:
         return jsonify({
-            "menu": menu_items,
-            "orders": orders_list,
-            "ingredients": [dict(r) for r in db.execute("SELECT * FROM ingredients").fetchall()],
-            "users": users_decrypted,
-            "reviews": [dict(r) for r in db.execute("SELECT * FROM reviews").fetchall()],
-            "purchases": [dict(r) for r in db.execute("SELECT * FROM purchases").fetchall()],
-            "notifications": [dict(r) for r in db.execute("SELECT * FROM notifications").fetchall()],
-            "subTransactions": [dict(r) for r in db.execute("SELECT * FROM sub_transactions").fetchall()],
-            "subscriptionUsage": [dict(r) for r in db.execute("SELECT * FROM subscription_usage").fetchall()]
+            "menu": [{k: r[k] for k in ('id', 'name', 'type', 'category', 'portions')} for r in menu_cache.all(db)],
+            "ingredients": [dict(r) for r in db.execute("SELECT * FROM ingredients ORDER BY id").fetchall()]
         })
 
 
+@app.route('/api/chef/recipes')
+@require_role('chef', 'admin')
+def chef_recipes(u):
+    """Рецептуры: расход ингредиентов на порцию блюда"""
+    with get_db() as db:
+        return jsonify(recipes(db))
+
+
+@app.route('/api/chef/forecast')
+@require_role('chef', 'admin')
+def chef_forecast(u):
+    """Последний прогноз (forecast.py): рекомендуемые порции по дням и предложения закупок"""
+    with get_db() as db:
+        return jsonify(forecast_view(db))
+
+
+@app.route('/api/admin/users')
+@require_role('admin')
+def admin_users(u):
+    """Пользователи всех школ (шардов) с фильтрами по роли, школе и статусу одобрения"""
+    where, params = [], []
+    for field in ('role', 'school'):
+        if request.args.get(field):
+            where.append(f"{field} = ?")
+            params.append(request.args[field])
+    if request.args.get('pending'):
+        where.append("isApproved = 0")
+    return jsonify(sharded_page(router.paths(request.args.get('school')), "SELECT * FROM users", where, params,
+                                key='username', descending=False, row_hook=lambda row: project_user(row, u)))
+
+
+@app.route('/api/admin/purchases')
+@require_role('admin')
+def admin_purchases(u):
+    """Заявки на закупку всех школ, от новых к старым, с фильтром по статусу"""
+    where, params = [], []
+    if request.args.get('status'):
+        where.append("status = ?")
+        params.append(request.args['status'])
+    return jsonify(sharded_page(router.paths(), "SELECT * FROM purchases", where, params))
+
+
+@app.route('/api/admin/report')
+@require_role('admin')
+def admin_report(u):
+    """Отчёт по заказам за период: итоги по статусам и страница заказов, включая архив за период"""
+    where, params = [], []
+    if request.args.get('from'):
+        where.append("createdAt >= ?")
+        params.append(request.args['from'])
+    if request.args.get('to'):
+        # Дата 'to' включительно: все ISO-метки этого дня меньше следующего символа после даты
+        where.append("createdAt < ?")
+        params.append(request.args['to'] + '\uffff')
+    if request.args.get('status'):
+        where.append("status = ?")
+        params.append(request.args['status'])
+
+    limit = page_limit()
+    page_where, page_params = list(where), list(params)
+    if request.args.get('before', type=int) is not None:
+        page_where.append("id < ?")
+        page_params.append(request.args.get('before', type=int))
+    where_sql = " WHERE " + " AND ".join(where) if where else ""
+    page_sql = " WHERE " + " AND ".join(page_where) if page_where else ""
+
+    date_from, date_to = request.args.get('from'), request.args.get('to')
+
+    def report(db):
+        # Рабочая база и архивы шарда: итоги по статусам и первые limit+1 строк каждого источника
+        totals, rows = [], []
+        for schema in history(db, date_from, date_to):
+            totals += db.execute(
+                f"SELECT status, COUNT(*), COALESCE(SUM(price), 0) FROM {schema}.orders{where_sql} GROUP BY status",
+                params).fetchall()
+            rows += [dict(r) for r in db.execute(
+                f"SELECT * FROM {schema}.orders{page_sql} ORDER BY id DESC LIMIT ?",
+                page_params + [limit + 1]).fetchall()]
+        return totals, rows
+
+    # Итоги складываются по всем шардам и источникам, страница — слиянием по id (id школ не пересекаются)
+    totals, rows = {}, []
+    for shard_totals, shard_rows in fan_out(report, router.paths()):
+        for status, count, amount in shard_totals:
+            total = totals.setdefault(status, {"status": status, "count": 0, "amount": 0})
+            total["count"] += count
+            total["amount"] += amount
+        rows += shard_rows
+
+    rows.sort(key=lambda r: r['id'], reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({"items": rows, "next": rows[-1]['id'] if has_more else None,
+                    "totals": [totals[k] for k in sorted(totals, key=lambda k: (k is None, k or ''))]})
+
+
+@app.route('/api/stats')
+@require_role('admin')
+def stats_view(u):
+    """Финансовая сводка за период по дневным агрегатам.
+
+    ?from=, ?to= — даты YYYY-MM-DD включительно; ?school= — одна школа;
+    ?group=day|school|dish|category — разбивка. С шардами — сумма сводок всех школ.
+    """
+    date_from, date_to = request.args.get('from'), request.args.get('to')
+    school, group = request.args.get('school'), request.args.get('group')
+    return jsonify(merge_stats(fan_out(lambda db: query_stats(db, date_from, date_to, school, group),
+                                       router.paths(school)), group))
+
+
+@app.route('/api/export/<kind>')
+@require_role('admin')
+def export_report(u, kind):
+    """Потоковая выгрузка orders|purchases в ?format=csv|xlsx с фильтрами (см. export.py)"""
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORTS or fmt not in FORMATS:
+        return jsonify({"error": "Неизвестный отчёт или формат"}), 400
+
+    header, rows = EXPORTS[kind]
+    writer, mimetype = FORMATS[fmt]
+    args = request.args.to_dict()
+    paths = router.paths(args.get('school'))
+
+    def shard_rows():
+        # Шарды по очереди; отдельное соединение: долгая выгрузка не занимает слот общего пула
+        for path in paths:
+            db = connect(path)
+            try:
+                yield from rows(db, args)
+            finally:
+                db.close()
+
+    def generate():
+        yield from writer(header, shard_rows())
+
+    filename = f"{kind}_{datetime.now().strftime('%Y-%m-%d')}.{fmt}"
+    resp = Response(stream_with_context(generate()), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
 @app.route('/api/login', methods=['POST'])
 def login():
     d = request.json
-    print(f"[LOGIN] Попытка входа: {d['username']}")
+    get_logger('LOGIN').info(f"Попытка входа: {d['username']}")
 
-    with get_db() as db:
-        u = db.execute("SELECT * FROM users WHERE username = ?", (d['username'],)).fetchone()
-        if u and check_password_hash(u['password'], d['password']):
-            if u['role'] == 'chef' and not u['isApproved']:
-                print(f"[LOGIN] ❌ Повар {d['username']} не одобрен")
-                return jsonify({"error": "Аккаунт повара ожидает одобрения админом"}), 403
-
-            print(f"[LOGIN] ✅ Успешный вход: {d['username']} ({u['role']})")
-
-            # Расшифровываем чувствительные данные перед отправкой
-            user_data = dict(u)
-            if user_data.get('phone'):
-                user_data['phone'] = decrypt_data(user_data['phone'])
-            if user_data.get('email'):
-                user_data['email'] = decrypt_data(user_data['email'])
-            if user_data.get('cardNumber'):
-                user_data['cardNumber'] = decrypt_data(user_data['cardNumber'])
-            if user_data.get('cardHolder'):
-                user_data['cardHolder'] = decrypt_data(user_data['cardHolder'])
-
-            return jsonify(user_data)
-
-    print(f"[LOGIN] ❌ Неверные данные для {d['username']}")
+    # С шардами база пользователя — по каталогу логинов
+    school, path = router.locate(d['username'])
+    u = None
+    if path:
+        with get_db(path) as db:
+            u = db.execute("SELECT * FROM users WHERE username = ?", (d['username'],)).fetchone()
+
+    # Проверка хэша — в пуле хэширования, соединение с БД на это время уже свободно
+    try:
+        password_ok = u is not None and verify_password(u['password'], d['password'])
+    except HashPoolBusy:
+        get_logger('LOGIN').warning(f"⚠️ Очередь хэширования переполнена: {d['username']}")
+        return jsonify({"error": "Сервер перегружен, попробуйте войти ещё раз"}), 503
+
+    if password_ok:
+        if u['role'] == 'chef' and not u['isApproved']:
+            get_logger('LOGIN').warning(f"❌ Повар {d['username']} не одобрен")
+            return jsonify({"error": "Аккаунт повара ожидает одобрения админом"}), 403
+
+        get_logger('LOGIN').info(f"✅ Успешный вход: {d['username']} ({u['role']})")
+
+        # Расшифровываем чувствительные данные перед отправкой
+        session['username'] = u['username']
+        session['school'] = school
+        user_data = dict(u)
+        user_data.pop('password', None)
+        return jsonify(decrypt_user(user_data))
+
+    get_logger('LOGIN').warning(f"❌ Неверные данные для {d['username']}")
     return jsonify({"error": "Неверный логин или пароль"}), 401
 
 
+@app.route('/api/logout', methods=['POST'])
+def logout():
+    session.pop('username', None)
+    session.pop('school', None)
+    return jsonify({"ok": True})
+
+
 @app.route('/api/register', methods=['POST'])
 def register():
     d = request.json
-    print(f"[REGISTER] Регистрация нового пользователя: {d['username']} ({d['role']})")
+    get_logger('REGISTER').info(f"Регистрация нового пользователя: {d['username']} ({d['role']})")
 
-    with get_db() as db:
+    # Хэшируем пароль в пуле хэширования до того, как брать соединение с БД
+    try:
+        hashed_password = hash_password(d['password'])
+    except HashPoolBusy:
+        get_logger('REGISTER').warning(f"⚠️ Очередь хэширования переполнена: {d['username']}")
+        return jsonify({"error": "Сервер перегружен, попробуйте ещё раз"}), 503
+
+    # С шардами школа должна быть подключена, а логин — свободен во всех школах (каталог)
+    path = router.path_for_school(d.get('school'))
+    if path is None:
+        code, message, status = NO_SCHOOL
+        return jsonify({"error": message, "code": code}), status
+    if not router.claim(d['username'], d.get('school')):
+        return jsonify({"error": "Логин уже занят или ошибка данных"}), 400
+
+    with get_db(path) as db:
         try:
             is_app = 0 if d['role'] == 'chef' else 1
 
-            # Хэшируем пароль
-            hashed_password = generate_password_hash(d['password'])
-
-            # Шифруем персональные данные
+            # Шифруем персональные данные (старые значения с тем же логином убираем из кэша)
+            forget_user(db, d['username'])
             encrypted_phone = encrypt_data(d.get('phone', ''))
             encrypted_email = encrypt_data(d.get('email', ''))
 
@@ -276,13 +864,311 @@ def register():
                 (d['username'], hashed_password, d['fullName'], d['role'], d['school'], d.get('grade', ''),
                  encrypted_phone, encrypted_email, is_app))
             db.commit()
-            print(f"[REGISTER] ✅ Пользователь {d['username']} зарегистрирован (пароль захэширован)")
+            get_logger('REGISTER').info(f"✅ Пользователь {d['username']} зарегистрирован (пароль захэширован)")
             return jsonify({"ok": True})
         except Exception as e:
-            print(f"[REGISTER] ❌ Ошибка: {e}")
+            router.release(d['username'])
+            get_logger('REGISTER').warning(f"❌ Ошибка: {e}")
             return jsonify({"error": "Логин уже занят или ошибка данных"}), 400
 
 
+@actions.register('buy', user=str, menuId=int)
+def act_buy(db, d, now_time, now_full):
+    # Порция и деньги списываются атомарно (ordering.py), без гонки за последнюю порцию
+    try:
+        # Раскупленное или несуществующее блюдо отклоняем по кэшу, не занимая блокировку записи
+        dish = menu_cache.get(db, d['menuId'])
+        if dish is None or (dish['portions'] or 0) <= 0:
+            raise OrderRejected(*(NO_DISH if dish is None else SOLD_OUT))
+        order_id, name, price, portions_left = place_order(
+            db, d['user'], d['menuId'], d.get('allergies', ''), now_full)
+    except OrderRejected as e:
+        get_logger('BUY').warning(f"❌ Невозможно купить: {e.code}")
+        return {"error": e.message, "code": e.code}, e.status
+    publish(db, 'order_paid', {"id": order_id, "name": name, "user": d['user']}, to_role='chef')
+    publish(db, 'stock', {"id": d['menuId'], "portions": portions_left})
+    notify(db, 'Оплата', f'Заказ {name} принят', to_user=d['user'], time=now_time)
+    get_logger('BUY').info(f"✅ Покупка: {d['user']} купил {name}")
+
+
+@actions.register('add_menu_item', name=str, price=float, portions=int)
+def act_add_menu_item(db, d, now_time, now_full):
+    dish_type = d.get('dishType', 'Второе')
+    ingredients = d.get('ingredients', '')
+    category = d.get('category', 'Обед')
+
+    cursor = db.execute(
+        "INSERT INTO menu (name, price, portions, type, ingredients, category, addedDate) VALUES (?,?,?,?,?,?,?)",
+        (d['name'], float(d['price']), int(d['portions']), dish_type, ingredients, category, now_full))
+
+    dish_id = cursor.lastrowid
+    allergens = index_dish(db, dish_id, ingredients)
+
+    # Уведомление для всех учеников о новом блюде
+    notify(db, 'Новое блюдо!', f'В меню добавлено: {d["name"]} ({dish_type})', to_role='student', time=now_time)
+    publish(db, 'menu', {"id": dish_id})
+
+    get_logger('ADD_DISH').info(f"✅ Блюдо добавлено: {d['name']}", id=dish_id, price=d['price'],
+                                portions=d['portions'], dishType=dish_type, category=category,
+                                allergens=len(allergens))
+
+
+@actions.register('buy_sub', user=str, subType=str)
+def act_buy_sub(db, d, now_time, now_full):
+    if d['subType'] not in SUBSCRIPTION_TYPES:
+        return {"error": f"Неизвестный абонемент: {d['subType']}", "code": "invalid"}, 400
+    # Как и при покупке блюда: списание только при достаточном балансе, по серверной цене
+    # (поле price от клиента не учитывается), строкой журнала со ссылкой на покупку
+    try:
+        price, valid_to, meals_left = purchase(db, d['user'], d['subType'], now_full)
+    except OrderRejected as e:
+        get_logger('SUB').warning(f"❌ Абонемент не куплен: {e.code}")
+        return {"error": e.message, "code": e.code}, e.status
+    # Уведомление ученику о покупке абонемента
+    notify(db, 'Абонемент куплен', f'Абонемент «{d["subType"]}» оплачен — {price}₽. '
+           f'Действует до {valid_to}, обедов: {meals_left}', to_user=d['user'], time=now_time)
+    get_logger('SUB').info(f"✅ Абонемент: {d['user']} купил {d['subType']}", validTo=valid_to, mealsLeft=meals_left)
+
+
+@actions.register('refill', user=str, amount=float)
+def act_refill(db, d, now_time, now_full):
+    amount = to_kopecks(d['amount'])
+    if amount <= 0:
+        return {"error": "Сумма пополнения должна быть больше нуля", "code": "invalid"}, 400
+    try:
+        credit(db, d['user'], amount, 'refill', None, now_full)
+    except OrderRejected as e:
+        return {"error": e.message, "code": e.code}, e.status
+    # Уведомление ученику о пополнении
+    notify(db, 'Баланс пополнен', f'На счёт зачислено {d["amount"]}₽', to_user=d['user'], time=now_time)
+    get_logger('REFILL').info(f"✅ Пополнение: {d['user']} +{d['amount']}₽")
+
+
+@actions.register('confirm_order', id=int)
+def act_confirm_order(db, d, now_time, now_full):
+    order = db.execute("SELECT * FROM orders WHERE id = ?", (d['id'],)).fetchone()
+    db.execute("UPDATE orders SET status = 'Выдано', issuedAt = ? WHERE id = ?", (now_time, d['id']))
+    if order:
+        # Уведомление ученику о выдаче
+        notify(db, 'Заказ выдан', f'{order["name"]} — ваш заказ готов к получению', to_user=order['user'],
+               time=now_time)
+        publish(db, 'order_issued', {"id": order['id']}, to_user=order['user'])
+        publish(db, 'order_issued', {"id": order['id']}, to_role='chef')
+    get_logger('CONFIRM').info(f"✅ Заказ #{d['id']} выдан")
+
+
+@actions.register('save_profile', user=str, allergies=str)
+def act_save_profile(db, d, now_time, now_full):
+    db.execute("UPDATE users SET allergies = ? WHERE username = ?", (d['allergies'], d['user']))
+    profile = set_user_allergies(db, d['user'], d['allergies'])
+    get_logger('PROFILE').info(f"✅ Профиль обновлен: {d['user']}", allergens=len(profile))
+
+
+@actions.register('approve_chef', target=str)
+def act_approve_chef(db, d, now_time, now_full):
+    db.execute("UPDATE users SET isApproved = 1 WHERE username = ?", (d['target'],))
+    # Уведомление повару о том что его одобрили
+    notify(db, 'Аккаунт одобрен', 'Ваш аккаунт повара успешно одобрен. Теперь вы можете войти.',
+           to_user=d['target'], time=now_time)
+    get_logger('APPROVE').info(f"✅ Повар одобрен: {d['target']}")
+
+
+@actions.register('reject_chef', target=str)
+def act_reject_chef(db, d, now_time, now_full):
+    forget_user(db, d['target'])
+    db.execute("DELETE FROM users WHERE username = ?", (d['target'],))
+    db.execute("DELETE FROM user_allergens WHERE username = ?", (d['target'],))
+    get_logger('REJECT').info(f"✅ Повар удален: {d['target']}")
+
+
+@actions.register('update_stock', id=int, val=int)
+def act_update_stock(db, d, now_time, now_full):
+    db.execute("UPDATE menu SET portions = ? WHERE id = ?", (int(d['val']), d['id']))
+    publish(db, 'stock', {"id": d['id'], "portions": int(d['val'])})
+    get_logger('STOCK').info(f"✅ Обновление порций: ID {d['id']} → {d['val']}")
+
+
+@actions.register('set_recipe', dishId=int, items=list)
+def act_set_recipe(db, d, now_time, now_full):
+    # items: [{"ingredientId": 1, "qty": 0.05}, ...] — расход на порцию в единицах ингредиента
+    error, lines = set_recipe(db, int(d['dishId']), d['items'])
+    if error:
+        code, message, status = error
+        return {"error": message, "code": code}, status
+    get_logger('RECIPE').info(f"✅ Рецептура блюда #{d['dishId']}: {lines} ингредиентов")
+
+
+@actions.register('add_ing', name=str, unit=str)
+def act_add_ing(db, d, now_time, now_full):
+    db.execute("INSERT INTO ingredients (name, amount, unit) VALUES (?,?,?)", (d['name'], 0, d['unit']))
+    get_logger('INGREDIENT').info(f"✅ Ингредиент добавлен: {d['name']}")
+
+
+@actions.register('set_ing', id=int, val=float)
+def act_set_ing(db, d, now_time, now_full):
+    db.execute("UPDATE ingredients SET amount = ? WHERE id = ?", (float(d['val']), d['id']))
+    get_logger('INGREDIENT').info(f"✅ Количество обновлено: ID {d['id']} → {d['val']}")
+
+
+@actions.register('add_review', dish=str, text=str, author=str)
+def act_add_review(db, d, now_time, now_full):
+    db.execute("INSERT INTO reviews (dish, text, author) VALUES (?,?,?)", (d['dish'], d['text'], d['author']))
+    get_logger('REVIEW').info(f"✅ Отзыв от {d['author']}")
+
+
+@actions.register('add_purchase', item=str, qty=(str, float))
+def act_add_purchase(db, d, now_time, now_full):
+    price = d.get('price', 0)
+    db.execute("INSERT INTO purchases (item, qty, price, status) VALUES (?,?,?,?)",
+               (d['item'], d['qty'], float(price), 'Ожидает'))
+    # Уведомление админу о новой заявке на закупку
+    notify(db, 'Новая закупка', f'Заявка: {d["item"]} ({d["qty"]}) — {price}₽. Ожидает одобрения.',
+           to_role='admin', time=now_time)
+    publish(db, 'purchase', {"status": 'Ожидает'}, to_role='admin')
+    get_logger('PURCHASE').info(f"✅ Заявка на закупку: {d['item']} ({d['qty']}) на сумму {price}₽")
+
+
+@actions.register('approve_purchase', id=int)
+def act_approve_purchase(db, d, now_time, now_full):
+    purchase = db.execute("SELECT * FROM purchases WHERE id = ?", (d['id'],)).fetchone()
+    db.execute("UPDATE purchases SET status = 'Одобрено' WHERE id = ?", (d['id'],))
+    publish(db, 'purchase', {"id": d['id'], "status": 'Одобрено'}, to_role='chef')
+    if purchase:
+        get_logger('PURCHASE').info(
+            f"✅ Закупка одобрена: ID {d['id']} - {purchase['item']} на {(purchase['price'] or 0)}₽")
+        # Уведомление повару (ИСПРАВЛЕНО: двойные кавычки снаружи, одинарные внутри)
+        notify(db, 'Закупка одобрена', f"{purchase['item']} ({purchase['qty']}) — {purchase['price'] or 0}₽ одобрена",
+               to_role='chef', time=now_time)
+    else:
+        get_logger('PURCHASE').info(f"✅ Закупка одобрена: ID {d['id']}")
+
+
+@actions.register('reject_purchase', id=int)
+def act_reject_purchase(db, d, now_time, now_full):
+    purchase = db.execute("SELECT * FROM purchases WHERE id = ?", (d['id'],)).fetchone()
+    db.execute("UPDATE purchases SET status = 'Запрещено' WHERE id = ?", (d['id'],))
+    publish(db, 'purchase', {"id": d['id'], "status": 'Запрещено'}, to_role='chef')
+    if purchase:
+        get_logger('PURCHASE').warning(f"❌ Закупка запрещена: ID {d['id']} - {purchase['item']}")
+        # Уведомление повару о запрете (ИСПРАВЛЕНО: двойные кавычки снаружи, одинарные внутри)
+        notify(db, 'Закупка отклонена', f"{purchase['item']} ({purchase['qty']}) — заявка запрещена администратором",
+               to_role='chef', time=now_time)
+    else:
+        get_logger('PURCHASE').warning(f"❌ Закупка запрещена: ID {d['id']}")
+
+
+@actions.register('save_card', user=str, cardNumber=str, cardHolder=str, cardExpiry=str)
+def act_save_card(db, d, now_time, now_full):
+    # Шифруем данные карты перед сохранением
+    encrypted_card = encrypt_data(d['cardNumber'])
+    encrypted_holder = encrypt_data(d['cardHolder'])
+
+    forget_user(db, d['user'])
+    db.execute("UPDATE users SET cardNumber = ?, cardHolder = ?, cardExpiry = ? WHERE username = ?",
+               (encrypted_card, encrypted_holder, d['cardExpiry'], d['user']))
+    get_logger('CARD').info(f"✅ Карта сохранена (зашифрована) для {d['user']}")
+
+
+@actions.register('remove_card', user=str)
+def act_remove_card(db, d, now_time, now_full):
+    forget_user(db, d['user'])
+    db.execute("UPDATE users SET cardNumber = '', cardHolder = '', cardExpiry = '' WHERE username = ?",
+               (d['user'],))
+    get_logger('CARD').info(f"✅ Карта удалена для {d['user']}")
+
+
+@actions.register('use_subscription', user=str, subType=str)
+def act_use_subscription(db, d, now_time, now_full):
+    # Право, порции, заказы и использование — постоянное число запросов при любом числе блюд (subscriptions.py)
+    today = now_full[:10]
+    try:
+        orders, stock, meals_left = redeem(db, d['user'], d['subType'], d.get('dishes'),
+                                           d.get('allergies', ''), now_full, today)
+    except OrderRejected as e:
+        get_logger('SUB_USE').warning(f"❌ {d['user']}: абонемент {d['subType']} не использован — {e.code}")
+        return {"error": e.message, "code": e.code}, e.status
+
+    publish_many(db, 'order_paid', "SELECT NULL, 'chef', json_object('id', json_extract(value, '$[0]'), "
+                 "'name', json_extract(value, '$[1]'), 'user', ?) FROM json_each(?)",
+                 (d['user'], json.dumps(orders)))
+    publish(db, 'stock', {"items": [{"id": dish_id, "portions": portions} for dish_id, portions in stock]})
+    dishes = ', '.join(name for _, name in orders)
+    notify(db, 'Абонемент использован', f'{d["subType"]}: {dishes}', to_user=d['user'], time=now_time)
+
+    get_logger('SUB_USE').info(f"✅ Абонемент {d['subType']} использован: {d['user']} — {dishes}",
+                               mealsLeft=meals_left)
+
+
+# ===== Пакетные варианты: один SQL-запрос вместо цикла по строкам =====
+@actions.register('confirm_dish_orders', dish=str)
+def act_confirm_dish_orders(db, d, now_time, now_full):
+    # Выдать все оплаченные заказы блюда: уведомления, события и статусы — по одному запросу
+    paid = "FROM orders WHERE status = 'Оплачено' AND name = ?"
+    notified = db.execute(f"""INSERT INTO notifications (title, text, toUser, time, createdAt)
+        SELECT 'Заказ выдан', name || ' — ваш заказ готов к получению', user, ?, ? {paid}
+        RETURNING id, toUser""", (now_time, now_full, d['dish'])).fetchall()
+    publish_many(db, 'notification', "SELECT json_extract(value, '$[1]'), NULL, "
+                 "json_object('id', json_extract(value, '$[0]')) FROM json_each(?)",
+                 (json.dumps([list(r) for r in notified]),))
+    publish_many(db, 'order_issued', f"SELECT user, NULL, json_object('id', id) {paid}", (d['dish'],))
+    issued = db.execute(f"UPDATE orders SET status = 'Выдано', issuedAt = ? WHERE status = 'Оплачено' AND name = ? "
+                        f"RETURNING id", (now_time, d['dish'])).fetchall()
+    if issued:
+        publish(db, 'order_issued', {"ids": [r[0] for r in issued]}, to_role='chef')
+    get_logger('CONFIRM').info(f"✅ Выдано заказов «{d['dish']}»: {len(issued)}")
+
+
+@actions.register('apply_stock_deltas', deltas=list)
+def act_apply_stock_deltas(db, d, now_time, now_full):
+    # deltas: [{"id": 1, "delta": -2}, ...]; порции не уходят ниже нуля
+    changed = db.execute("""UPDATE menu SET portions = MAX(0, menu.portions + x.delta)
+        FROM (SELECT json_extract(value, '$.id') AS id, CAST(SUM(json_extract(value, '$.delta')) AS INTEGER) AS delta
+              FROM json_each(?) GROUP BY 1) AS x
+        WHERE menu.id = x.id
+        RETURNING menu.id, menu.portions""", (json.dumps(d['deltas']),)).fetchall()
+    if changed:
+        publish(db, 'stock', {"items": [{"id": r[0], "portions": r[1]} for r in changed]})
+    get_logger('STOCK').info(f"✅ Пакетное обновление порций: {len(changed)} блюд")
+
+
+@actions.register('apply_ingredient_deltas', deltas=list)
+def act_apply_ingredient_deltas(db, d, now_time, now_full):
+    # deltas: [{"id": 1, "delta": 2.5}, ...]; остаток не уходит ниже нуля
+    changed = db.execute("""UPDATE ingredients SET amount = MAX(0, ingredients.amount + x.delta)
+        FROM (SELECT json_extract(value, '$.id') AS id, SUM(json_extract(value, '$.delta')) AS delta
+              FROM json_each(?) GROUP BY 1) AS x
+        WHERE ingredients.id = x.id
+        RETURNING ingredients.id""", (json.dumps(d['deltas']),)).fetchall()
+    get_logger('INGREDIENT').info(f"✅ Пакетное обновление склада: {len(changed)} позиций")
+
+
+def action_path(d, viewer):
+    """База действия с шардами: шард школы его ученика или повара (user, target) — пополнение или одобрение
+    из другой школы, иначе школа ?school= для админа. None — база запроса.
+
+    viewer — пользователь сессии (current_user()), его читают до начала транзакции:
+    внутри BEGIN IMMEDIATE пакета лишнее соединение из пула не берём.
+    """
+    if not router.enabled:
+        return None
+    subject = d.get('user') or d.get('target')
+    if isinstance(subject, str) and subject != session.get('username'):
+        return router.path_for_user(subject)
+    if d.get('school') and viewer and viewer['role'] == 'admin':
+        return router.path_for_school(d['school'])
+    return None
+
+
+def apply_action(db, d, now_time, now_full):
+    """Выполняет одно действие в текущей транзакции через реестр actions.
+
+    Возвращает None при успехе или (тело ошибки, HTTP-код). Транзакцию завершает
+    вызывающий код: /api/action фиксирует её или при ошибке откатывает целиком,
+    /api/action/batch откатывает ошибочное действие до точки сохранения.
+    """
+    return actions.dispatch(db, d, now_time, now_full)
+
+
 @app.route('/api/action', methods=['POST'])
 def action():
     d = request.json
@@ -290,226 +1176,112 @@ def action():
     now_time = datetime.now().strftime("%H:%M")
     now_full = datetime.now().isoformat()
 
-    print(f"\n{'=' * 60}")
-    print(f"[ACTION] Получен запрос: {act}")
-    print(f"[ACTION] Данные: {d}")
-    print(f"{'=' * 60}")
+    get_logger('ACTION').debug(f"Получен запрос: {act}", data=redact(d))
 
+    path = action_path(d, current_user() if router.enabled else None)
+    if path:
+        route(path)
     with get_db() as db:
-        if act == 'buy':
-            u = db.execute("SELECT balance FROM users WHERE username = ?", (d['user'],)).fetchone()
-            m = db.execute("SELECT * FROM menu WHERE id = ?", (d['menuId'],)).fetchone()
-            if u and m and u['balance'] >= m['price'] and m['portions'] > 0:
-                db.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (m['price'], d['user']))
-                db.execute("UPDATE menu SET portions = portions - 1 WHERE id = ?", (d['menuId'],))
-                db.execute("INSERT INTO orders (user, name, price, status, allergies, createdAt) VALUES (?,?,?,?,?,?)",
-                           (d['user'], m['name'], m['price'], 'Оплачено', d.get('allergies', ''), now_full))
-                db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                           ('Оплата', f'Заказ {m["name"]} принят', d['user'], now_time))
-                print(f"[BUY] ✅ Покупка: {d['user']} купил {m['name']}")
-            else:
-                print(f"[BUY] ❌ Невозможно купить: баланс или порции")
-                db.commit()
-                return jsonify({"error": "Невозможно купить"}), 400
-
-        elif act == 'add_menu_item':
-            print(f"\n[ADD_DISH] 🍽️ ДОБАВЛЕНИЕ НОВОГО БЛЮДА")
-            print(f"[ADD_DISH] Название: {d['name']}")
-            print(f"[ADD_DISH] Цена: {d['price']}₽")
-            print(f"[ADD_DISH] Порции: {d['portions']}")
-            print(f"[ADD_DISH] Тип: {d.get('dishType', 'Второе')}")
-            print(f"[ADD_DISH] Категория: {d.get('category', 'Обед')}")
-            print(f"[ADD_DISH] Состав: {d.get('ingredients', 'не указан')}")
-            print(f"[ADD_DISH] Дата: {now_full}")
-
-            dish_type = d.get('dishType', 'Второе')
-            ingredients = d.get('ingredients', '')
-            category = d.get('category', 'Обед')
-
-            cursor = db.execute(
-                "INSERT INTO menu (name, price, portions, type, ingredients, category, addedDate) VALUES (?,?,?,?,?,?,?)",
-                (d['name'], float(d['price']), int(d['portions']), dish_type, ingredients, category, now_full))
-
-            dish_id = cursor.lastrowid
-
-            # Уведомление для всех учеников о новом блюде
-            db.execute("INSERT INTO notifications (title, text, toRole, time) VALUES (?,?,?,?)",
-                       ('Новое блюдо!', f'В меню добавлено: {d["name"]} ({dish_type})', 'student', now_time))
-
-            print(f"[ADD_DISH] ✅ Блюдо добавлено с ID: {dish_id}")
-
-        elif act == 'buy_sub':
-            db.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (d['price'], d['user']))
-            db.execute("INSERT INTO sub_transactions (user, type, amount, time) VALUES (?,?,?,?)",
-                       (d['user'], d['subType'], d['price'], now_full))
-            # Уведомление ученику о покупке абонемента
-            db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                       ('Абонемент куплен', f'Абонемент «{d["subType"]}» успешно оплачен — {d["price"]}₽', d['user'],
-                        now_time))
-            print(f"[SUB] ✅ Абонемент: {d['user']} купил {d['subType']}")
-
-        elif act == 'refill':
-            db.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (d['amount'], d['user']))
-            # Уведомление ученику о пополнении
-            db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                       ('Баланс пополнен', f'На счёт зачислено {d["amount"]}₽', d['user'], now_time))
-            print(f"[REFILL] ✅ Пополнение: {d['user']} +{d['amount']}₽")
-
-        elif act == 'confirm_order':
-            order = db.execute("SELECT * FROM orders WHERE id = ?", (d['id'],)).fetchone()
-            db.execute("UPDATE orders SET status = 'Выдано', issuedAt = ? WHERE id = ?", (now_time, d['id']))
-            if order:
-                # Уведомление ученику о выдаче
-                db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                           ('Заказ выдан', f'{order["name"]} — ваш заказ готов к получению', order['user'], now_time))
-            print(f"[CONFIRM] ✅ Заказ #{d['id']} выдан")
-
-        elif act == 'save_profile':
-            db.execute("UPDATE users SET allergies = ? WHERE username = ?", (d['allergies'], d['user']))
-            print(f"[PROFILE] ✅ Профиль обновлен: {d['user']}")
-
-        elif act == 'approve_chef':
-            db.execute("UPDATE users SET isApproved = 1 WHERE username = ?", (d['target'],))
-            # Уведомление повару о том что его одобрили
-            db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                       ('Аккаунт одобрен', 'Ваш аккаунт повара успешно одобрен. Теперь вы можете войти.', d['target'],
-                        now_time))
-            print(f"[APPROVE] ✅ Повар одобрен: {d['target']}")
-
-        elif act == 'reject_chef':
-            db.execute("DELETE FROM users WHERE username = ?", (d['target'],))
-            print(f"[REJECT] ✅ Повар удален: {d['target']}")
-
-        elif act == 'update_stock':
-            db.execute("UPDATE menu SET portions = ? WHERE id = ?", (int(d['val']), d['id']))
-            print(f"[STOCK] ✅ Обновление порций: ID {d['id']} → {d['val']}")
-
-        elif act == 'add_ing':
-            db.execute("INSERT INTO ingredients (name, amount, unit) VALUES (?,?,?)", (d['name'], 0, d['unit']))
-            print(f"[INGREDIENT] ✅ Ингредиент добавлен: {d['name']}")
-
-        elif act == 'set_ing':
-            db.execute("UPDATE ingredients SET amount = ? WHERE id = ?", (float(d['val']), d['id']))
-            print(f"[INGREDIENT] ✅ Количество обновлено: ID {d['id']} → {d['val']}")
-
-        elif act == 'add_review':
-            db.execute("INSERT INTO reviews (dish, text, author) VALUES (?,?,?)", (d['dish'], d['text'], d['author']))
-            print(f"[REVIEW] ✅ Отзыв от {d['author']}")
-
-        elif act == 'add_purchase':
-            price = d.get('price', 0)
-            db.execute("INSERT INTO purchases (item, qty, price, status) VALUES (?,?,?,?)",
-                       (d['item'], d['qty'], float(price), 'Ожидает'))
-            # Уведомление админу о новой заявке на закупку
-            db.execute("INSERT INTO notifications (title, text, toRole, time) VALUES (?,?,?,?)",
-                       ('Новая закупка', f'Заявка: {d["item"]} ({d["qty"]}) — {price}₽. Ожидает одобрения.', 'admin',
-                        now_time))
-            print(f"[PURCHASE] ✅ Заявка на закупку: {d['item']} ({d['qty']}) на сумму {price}₽")
-
-        elif act == 'approve_purchase':
-            purchase = db.execute("SELECT * FROM purchases WHERE id = ?", (d['id'],)).fetchone()
-            db.execute("UPDATE purchases SET status = 'Одобрено' WHERE id = ?", (d['id'],))
-            if purchase:
-                print(
-                    f"[PURCHASE] ✅ Закупка одобрена: ID {d['id']} - {purchase['item']} на {(purchase['price'] or 0)}₽")
-                # Уведомление повару (ИСПРАВЛЕНО: двойные кавычки снаружи, одинарные внутри)
-                db.execute("INSERT INTO notifications (title, text, toRole, time) VALUES (?,?,?,?)",
-                           ('Закупка одобрена',
-                            f"{purchase['item']} ({purchase['qty']}) — {purchase.get('price', 0)}₽ одобрена", 'chef',
-                            now_time))
-            else:
-                print(f"[PURCHASE] ✅ Закупка одобрена: ID {d['id']}")
-
-        elif act == 'reject_purchase':
-            purchase = db.execute("SELECT * FROM purchases WHERE id = ?", (d['id'],)).fetchone()
-            db.execute("UPDATE purchases SET status = 'Запрещено' WHERE id = ?", (d['id'],))
-            if purchase:
-                print(f"[PURCHASE] ❌ Закупка запрещена: ID {d['id']} - {purchase['item']}")
-                # Уведомление повару о запрете (ИСПРАВЛЕНО: двойные кавычки снаружи, одинарные внутри)
-                db.execute("INSERT INTO notifications (title, text, toRole, time) VALUES (?,?,?,?)",
-                           ('Закупка отклонена',
-                            f"{purchase['item']} ({purchase['qty']}) — заявка запрещена администратором", 'chef',
-                            now_time))
-            else:
-                print(f"[PURCHASE] ❌ Закупка запрещена: ID {d['id']}")
-
-        elif act == 'save_card':
-            # Шифруем данные карты перед сохранением
-            encrypted_card = encrypt_data(d['cardNumber'])
-            encrypted_holder = encrypt_data(d['cardHolder'])
-
-            db.execute("UPDATE users SET cardNumber = ?, cardHolder = ?, cardExpiry = ? WHERE username = ?",
-                       (encrypted_card, encrypted_holder, d['cardExpiry'], d['user']))
-            print(f"[CARD] ✅ Карта сохранена (зашифрована) для {d['user']}: **** {d['cardNumber'][-4:]}")
-
-        elif act == 'remove_card':
-            db.execute("UPDATE users SET cardNumber = '', cardHolder = '', cardExpiry = '' WHERE username = ?",
-                       (d['user'],))
-            print(f"[CARD] ✅ Карта удалена для {d['user']}")
-
-        elif act == 'use_subscription':
-            # Проверяем что у пользователя есть абонемент
-            today = datetime.now().strftime("%Y-%m-%d")
-            sub_type = d['subType']  # 'Завтраки' или 'Обеды'
-
-            # Проверяем что пользователь купил этот абонемент
-            has_sub = db.execute("SELECT * FROM sub_transactions WHERE user = ? AND type = ?",
-                                 (d['user'], sub_type)).fetchone()
-            if not has_sub:
-                print(f"[SUB_USE] ❌ У {d['user']} нет абонемента {sub_type}")
-                return jsonify({"error": "У вас нет этого абонемента"}), 400
-
-            # Проверяем что сегодня ещё не брал по этому абонементу
-            already_used = db.execute("SELECT * FROM subscription_usage WHERE user = ? AND subType = ? AND date = ?",
-                                      (d['user'], sub_type, today)).fetchone()
-            if already_used:
-                print(f"[SUB_USE] ❌ {d['user']} уже использовал абонемент {sub_type} сегодня")
-                return jsonify({"error": "Вы уже использовали абонемент сегодня"}), 400
-
-            # Получаем выбранные блюда
-            selected_dishes = d.get('dishes', [])  # список ID блюд
-            if not selected_dishes:
-                return jsonify({"error": "Выберите блюда"}), 400
-
-            # Создаём заказы для каждого выбранного блюда
-            dishes_info = []
-            for dish_id in selected_dishes:
-                dish = db.execute("SELECT * FROM menu WHERE id = ?", (dish_id,)).fetchone()
-                if dish and dish['portions'] > 0:
-                    db.execute("UPDATE menu SET portions = portions - 1 WHERE id = ?", (dish_id,))
-                    db.execute(
-                        "INSERT INTO orders (user, name, price, status, allergies, createdAt) VALUES (?,?,?,?,?,?)",
-                        (d['user'], dish['name'], 0, 'Оплачено', d.get('allergies', ''), now_full))
-                    dishes_info.append(dish['name'])
-                    print(f"[SUB_USE] ✅ {d['user']} взял по абонементу: {dish['name']}")
-
-            # Записываем использование абонемента
-            db.execute("INSERT INTO subscription_usage (user, subType, date, dishesUsed, createdAt) VALUES (?,?,?,?,?)",
-                       (d['user'], sub_type, today, ', '.join(dishes_info), now_full))
-
-            # Уведомление
-            db.execute("INSERT INTO notifications (title, text, toUser, time) VALUES (?,?,?,?)",
-                       ('Абонемент использован', f'{sub_type}: {", ".join(dishes_info)}', d['user'], now_time))
-
-            print(f"[SUB_USE] ✅ Абонемент {sub_type} использован: {d['user']} — {', '.join(dishes_info)}")
-
-        else:
-            print(f"[ACTION] ⚠️ Неизвестное действие: {act}")
+        error = apply_action(db, d, now_time, now_full)
+        if error:
+            # Обработчик мог успеть записать часть изменений до отказа — не фиксируем их
+            db.rollback()
+            return jsonify(error[0]), error[1]
+
+        if next(_prune_counter) % PRUNE_EVERY == 0:
+            prune_change_log(db)
+            prune_events(db)
+            prune_notifications(db)
+            snapshot_balances(db)
 
         db.commit()
+        menu_cache.refresh(db)
+
+    # Будим клиентов, ждущих на /api/events
+    broker().notify()
 
-    print(f"[ACTION] ✅ Действие {act} успешно выполнено и закоммичено\n")
+    get_logger('ACTION').debug(f"✅ Действие {act} выполнено и закоммичено")
     return jsonify({"ok": True})
 
 
+@app.route('/api/action/batch', methods=['POST'])
+def action_batch():
+    """Несколько действий /api/action в одной транзакции с одним коммитом.
+
+    {"mode": "all" | "best_effort", "actions": [{"type": ...}, ...]}
+    all — первая ошибка откатывает весь пакет; best_effort — каждое действие
+    в своей точке сохранения, откатываются только ошибочные.
+    """
+    d = request.json or {}
+    actions = d.get('actions')
+    mode = d.get('mode', 'all')
+    if mode not in BATCH_MODES or not isinstance(actions, list) or not actions:
+        return jsonify({"error": "Нужны mode (all или best_effort) и непустой список actions"}), 400
+    if len(actions) > BATCH_MAX_ACTIONS:
+        return jsonify({"error": f"Не больше {BATCH_MAX_ACTIONS} действий в пакете"}), 413
+
+    now_time = datetime.now().strftime("%H:%M")
+    now_full = datetime.now().isoformat()
+    get_logger('BATCH').info(f"Получен пакет: {len(actions)} действий, режим {mode}")
+
+    viewer = current_user() if router.enabled else None
+    results = []
+    with get_db() as db:
+        try:
+            begin_immediate(db)
+        except OrderRejected as e:
+            return jsonify({"error": e.message, "code": e.code}), e.status
+
+        for i, item in enumerate(actions):
+            db.execute("SAVEPOINT batch_item")
+            try:
+                # Пакет — одна транзакция в базе запроса; действие над другой школой в него не входит
+                if not isinstance(item, dict):
+                    error = ({"error": "Действие должно быть объектом"}, 400)
+                elif action_path(item, viewer) not in (None, routed_path()):
+                    error = ({"error": "Действие для другой школы — отдельным запросом", "code": "other_school"}, 409)
+                else:
+                    error = apply_action(db, item, now_time, now_full)
+            except Exception as e:
+                error = ({"error": f"Некорректные данные: {e}"}, 400)
+
+            if error is None:
+                db.execute("RELEASE batch_item")
+                results.append({"index": i, "ok": True})
+                continue
+
+            db.execute("ROLLBACK TO batch_item")
+            db.execute("RELEASE batch_item")
+            results.append(dict(error[0], index=i, ok=False, status=error[1]))
+            if mode == 'all':
+                db.rollback()
+                for r in results[:-1]:
+                    r.update(ok=False, rolledBack=True)
+                results.extend({"index": j, "ok": False, "skipped": True} for j in range(i + 1, len(actions)))
+                get_logger('BATCH').warning(f"❌ Пакет откатан на действии #{i}: {error[0].get('error')}")
+                return jsonify({"ok": False, "mode": mode, "failed": i, "results": results}), error[1]
+
+        if next(_prune_counter) % PRUNE_EVERY == 0:
+            prune_change_log(db)
+            prune_events(db)
+            prune_notifications(db)
+            snapshot_balances(db)
+
+        db.commit()
+        menu_cache.refresh(db)
+
+    broker().notify()
+
+    applied = sum(r['ok'] for r in results)
+    get_logger('BATCH').info(f"✅ Применено {applied} из {len(actions)}")
+    return jsonify({"ok": applied == len(actions), "mode": mode, "results": results})
+
+
 if __name__ == '__main__':
     os.makedirs('templates', exist_ok=True)
 
-    print("\n" + "=" * 60)
-    print("🚀 СЕРВЕР ЗАПУСКАЕТСЯ")
-    print("=" * 60)
-    print("📍 URL: http://127.0.0.1:8080")
-    print("📂 База данных: canteen_full.db")
-    print("=" * 60 + "\n")
+    # Сервер разработки с перезагрузкой; для продакшена — python -m canteen serve (canteen.py)
+    port = int(os.environ.get('PORT', 8080))
+    get_logger('SERVER').info("🚀 Сервер разработки запускается", url=f"http://127.0.0.1:{port}", db=DB_NAME)
 
-    app.run(debug=True, port=8080)
\ No newline at end of file
+    app.run(debug=True, port=port)
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Горячее и холодное хранение: перенос старой истории в архивные базы.
+
+Заказы, использования абонементов и покупки абонементов старше
+ARCHIVE_AFTER_DAYS переносятся в отдельные файлы SQLite — по месяцу или по
+учебному полугодию. В рабочей базе остаётся только горячий набор, поэтому
+sync, очередь повара и проверки при покупке его не перебирают. Оплаченные,
+но ещё не выданные заказы остаются в рабочей базе всегда: по ним работает
+выдача. Действие абонементов хранится в entitlements (subscriptions.py),
+поэтому старые покупки переносятся без исключений.
+
+Файлы учитываются в archive_files (период, границы дат, число строк).
+Отчёты и выгрузки за период подключают (ATTACH) только пересекающиеся с ним
+файлы, по одному, и читают их так же, как рабочую таблицу. Дневные агрегаты
+/api/stats при переносе не меняются (см. stats.py).
+
+Перенос идёт пачками по ARCHIVE_BATCH строк, каждая пачка — своя
+транзакция BEGIN IMMEDIATE: запись в рабочую базу блокируется ненадолго.
+Повторный запуск после сбоя безопасен — строки, уже попавшие в архив,
+пропускаются по rowid.
+
+    ARCHIVE_DIR             каталог архивных файлов основной базы (archive рядом с ней);
+                            у шарда школы (shards.py) — всегда archive рядом с его файлом
+    ARCHIVE_AFTER_DAYS      старше скольких дней переносить (180)
+    ARCHIVE_PERIOD          month — файл на месяц, term — на учебное полугодие
+    ARCHIVE_BATCH           строк в одной транзакции переноса (5000)
+    ARCHIVE_INTERVAL_HOURS  как часто сервер запускает перенос сам (24, 0 — не запускать)
+
+Вручную (например, из cron): python archive.py [--days N] [--period month|term]
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from changes import prune_change_log
+from db import DB_NAME, connect
+from logs import get_logger
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_PERIOD = os.environ.get('ARCHIVE_PERIOD', 'month')
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 5000))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', 24))
+
+# Первый перенос — не сразу при старте, чтобы не мешать прогреву
+ARCHIVE_START_DELAY = 60
+
+PERIODS = ('month', 'term')
+
+# Таблица → (столбец с ISO-датой, условие «строка должна остаться в рабочей базе»)
+ARCHIVED_TABLES = {
+    'orders': ('createdAt', "status = 'Оплачено'"),
+    'subscription_usage': ('createdAt', None),
+    'sub_transactions': ('time', None),
+}
+
+# Имя, под которым подключается архивный файл
+ALIAS = 'cold'
+
+
+def install_archive(db):
+    """Реестр архивных файлов и индексы для выборки старых строк по дате"""
+    db.execute('''CREATE TABLE IF NOT EXISTS archive_files (
+        file TEXT PRIMARY KEY,
+        period TEXT,
+        fromDay TEXT,
+        toDay TEXT,
+        rows INTEGER DEFAULT 0,
+        archivedAt TEXT)''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sub_usage_created ON subscription_usage (createdAt)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sub_tx_time ON sub_transactions (time)")
+
+
+def period_of(day, period=ARCHIVE_PERIOD):
+    """(имя периода, первый день, первый день следующего) для даты.
+
+    Учебное полугодие: сентябрь—декабрь — первое, январь—август — второе
+    (имя по году начала учебного года: 2025-1, 2025-2).
+    """
+    if period == 'month':
+        end = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+        return f"{day.year:04d}-{day.month:02d}", date(day.year, day.month, 1), end
+    if period == 'term':
+        if day.month >= 9:
+            return f"{day.year:04d}-1", date(day.year, 9, 1), date(day.year + 1, 1, 1)
+        return f"{day.year - 1:04d}-2", date(day.year, 1, 1), date(day.year, 9, 1)
+    raise ValueError(f"Неизвестный период архива: {period}")
+
+
+def archive_dir(db):
+    """Каталог архивов базы: ARCHIVE_DIR для DB_PATH, archive рядом с файлом для шардов школ"""
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    if not path or os.path.abspath(path) == os.path.abspath(DB_NAME):
+        return ARCHIVE_DIR
+    return os.path.join(os.path.dirname(path), 'archive')
+
+
+def _cold_table_sql(db, table):
+    sql = db.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    return re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS {ALIAS}.{table}', sql)
+
+
+@contextmanager
+def attached(db, file):
+    """Подключает архивный файл как схему cold на время блока"""
+    db.execute(f"ATTACH DATABASE ? AS {ALIAS}", (os.path.join(archive_dir(db), file),))
+    try:
+        yield ALIAS
+    finally:
+        db.execute(f"DETACH DATABASE {ALIAS}")
+
+
+def _move(db, table, where, params, file, period, start, end, batch):
+    """Переносит строки main.table по условию в архивный файл пачками. Возвращает число перенесённых"""
+    date_column = ARCHIVED_TABLES[table][0]
+    columns = ', '.join(f'"{c[1]}"' for c in db.execute(f"PRAGMA main.table_info({table})").fetchall())
+    moved = 0
+    with attached(db, file):
+        db.execute(_cold_table_sql(db, table))
+        db.execute(f"CREATE INDEX IF NOT EXISTS {ALIAS}.idx_{table}_{date_column} ON {table} ({date_column})")
+        db.commit()
+        while True:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                upto = db.execute(f"SELECT MAX(rowid) FROM (SELECT rowid FROM main.{table} WHERE {where} "
+                                  f"ORDER BY rowid LIMIT ?)", (*params, batch)).fetchone()[0]
+                if upto is None:
+                    db.rollback()
+                    break
+                # rowid сохраняется: повторный перенос той же строки после сбоя игнорируется
+                db.execute(f"INSERT OR IGNORE INTO {ALIAS}.{table} (rowid, {columns}) "
+                           f"SELECT rowid, {columns} FROM main.{table} WHERE {where} AND rowid <= ?",
+                           (*params, upto))
+                count = db.execute(f"DELETE FROM main.{table} WHERE {where} AND rowid <= ?",
+                                   (*params, upto)).rowcount
+                db.execute('''INSERT INTO main.archive_files (file, period, fromDay, toDay, rows, archivedAt)
+                    VALUES (?,?,?,?,?,?)
+                    ON CONFLICT (file) DO UPDATE SET rows = rows + excluded.rows, archivedAt = excluded.archivedAt''',
+                           (file, period, start.isoformat(), end.isoformat(), count, datetime.now().isoformat()))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            moved += count
+    return moved
+
+
+def archive_old_rows(db, days=ARCHIVE_AFTER_DAYS, period=ARCHIVE_PERIOD, batch=ARCHIVE_BATCH):
+    """Переносит строки старше days дней в архивные файлы. Возвращает {таблица: перенесено строк}"""
+    if period not in PERIODS:
+        raise ValueError(f"Неизвестный период архива: {period}")
+    os.makedirs(archive_dir(db), exist_ok=True)
+    cutoff = date.today() - timedelta(days=days)
+    log = get_logger('ARCHIVE')
+    result = {}
+
+    for table, (column, keep) in ARCHIVED_TABLES.items():
+        movable = f" AND NOT ({keep})" if keep else ""
+        where = f"{column} >= ? AND {column} < ?{movable}"
+        moved = 0
+        start = date.min
+        while True:
+            # Следующая старая строка; пустые периоды пропускаются без создания файлов
+            oldest = db.execute(f"SELECT MIN({column}) FROM main.{table} WHERE {where}",
+                                (start.isoformat(), cutoff.isoformat())).fetchone()[0]
+            if not oldest:
+                break
+            name, start, end = period_of(date.fromisoformat(oldest[:10]), period)
+            count = _move(db, table, where, (start.isoformat(), min(end, cutoff).isoformat()),
+                          f"canteen-{name}.db", name, start, end, batch)
+            if count:
+                log.info(f"📦 {table}: {count} строк → canteen-{name}.db")
+            moved += count
+            start = end
+        result[table] = moved
+
+    if any(result.values()):
+        # Удаления попали в журнал изменений — клиенты получат их дельтой или полным снимком
+        prune_change_log(db)
+        db.commit()
+    return result
+
+
+def archive_files(db, date_from=None, date_to=None):
+    """Архивные файлы, пересекающиеся с периодом (даты YYYY-MM-DD включительно), от новых к старым"""
+    return [r[0] for r in db.execute('''SELECT file FROM main.archive_files
+        WHERE (? IS NULL OR toDay > ?) AND (? IS NULL OR fromDay <= ?) AND rows > 0
+        ORDER BY fromDay DESC''', (date_from, date_from, date_to, date_to)).fetchall()]
+
+
+def history(db, date_from=None, date_to=None, chronological=False):
+    """Схемы для исторического запроса: рабочая база и архивы за период.
+
+    По умолчанию сначала рабочая база, затем архивы от новых к старым;
+    chronological — архивы от старых к новым, рабочая база последней.
+    Архив подключён, пока потребитель работает с его схемой, и отключается
+    перед следующим — курсоры по нему нужно дочитать или закрыть.
+    """
+    files = archive_files(db, date_from, date_to)
+    directory = archive_dir(db)
+    sources = ['main'] + files if not chronological else files[::-1] + ['main']
+    for source in sources:
+        if source == 'main':
+            yield source
+        elif not os.path.exists(os.path.join(directory, source)):
+            get_logger('ARCHIVE').warning(f"⚠️ Нет архивного файла {source}")
+        else:
+            with attached(db, source) as schema:
+                yield schema
+
+
+class Archiver:
+    """Фоновый перенос раз в interval_hours по всем базам paths(). Поток запускается лениво и заново после fork"""
+
+    def __init__(self, connect=connect, paths=lambda: [DB_NAME], interval_hours=ARCHIVE_INTERVAL_HOURS,
+                 delay=ARCHIVE_START_DELAY):
+        self._connect = connect
+        self._paths = paths
+        self._interval = interval_hours * 3600
+        self._delay = delay
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='archiver', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        wait = self._delay
+        while True:
+            time.sleep(wait)
+            wait = self._interval
+            for path in self._paths():
+                db = self._connect(path)
+                try:
+                    archive_old_rows(db)
+                except sqlite3.Error as e:
+                    # Другой процесс мог переносить одновременно — следующий запуск доделает
+                    get_logger('ARCHIVE').warning(f"⚠️ Перенос в архив не удался: {e}", db=path)
+                finally:
+                    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос старых заказов и абонементов в архивные базы")
+    parser.add_argument('--db', default=DB_NAME, help=f"рабочая база ({DB_NAME})")
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help="переносить строки старше N дней")
+    parser.add_argument('--period', choices=PERIODS, default=ARCHIVE_PERIOD, help="файл на месяц или на полугодие")
+    parser.add_argument('--batch', type=int, default=ARCHIVE_BATCH, help="строк в одной транзакции")
+    args = parser.parse_args()
+
+    from migrations import migrate
+
+    db = connect(args.db)
+    try:
+        migrate(db)
+        result = archive_old_rows(db, args.days, args.period, args.batch)
+        print(f"✅ Перенесено: {result}")
+        for r in db.execute("SELECT * FROM archive_files ORDER BY fromDay").fetchall():
+            print(f"   {r['file']}: {r['rows']} строк ({r['fromDay']} — {r['toDay']})")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
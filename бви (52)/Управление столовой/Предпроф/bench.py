@@ -0,0 +1,487 @@
+"""Нагрузочный прогон «обеденный пик» на временной базе.
+
+Ученики опрашивают /api/sync по курсору, в середине прогона массово
+покупают блюда и берут обеды по абонементу; повара выдают заказы, админы
+смотрят статистику, отчёт и выгрузку. По каждому эндпоинту считаются
+пропускная способность, задержки p50/p95/p99, ошибки и блокировки базы,
+в конце проверяется, что порции не перепроданы и балансы не ушли в минус.
+Результат пишется в JSON, чтобы сравнивать прогоны между коммитами.
+
+    python bench.py                                   # в процессе, через test_client
+    python bench.py --server --workers 4              # против python -m canteen serve на временной базе
+    python bench.py --students 200 --duration 60 --out result.json
+    python bench.py --compare old.json new.json       # сравнение двух прогонов
+    python bench.py --payload big.db                  # размер и время полного снимка /api/sync по форматам
+
+Работает офлайн: база создаётся во временной папке и удаляется после прогона.
+Для --payload нужна готовая база (например, reset_and_fill_database.py
+--schools 5 --students 2000) — она копируется во временную папку.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+# Построчный лог сервера во время прогона только мешает
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from ledger import reconcile  # noqa: E402
+from migrations import migrate  # noqa: E402
+from subscriptions import grant  # noqa: E402
+
+BENCH_PASSWORD = 'bench'
+SCHOOL = 'ГБОУ Школа №656'
+SUB_TYPE = 'Обеды'
+
+DISHES = [
+    ("Каша овсяная с маслом", 80, "Завтрак"),
+    ("Омлет с сыром", 120, "Завтрак"),
+    ("Борщ украинский", 180, "Обед"),
+    ("Суп куриный с лапшой", 150, "Обед"),
+    ("Котлета с пюре", 200, "Обед"),
+    ("Плов узбекский", 190, "Обед"),
+    ("Компот из сухофруктов", 50, "Обед"),
+]
+
+
+# ===== ПОДГОТОВКА БАЗЫ =====
+
+def seed(db_path, students, chefs, admins, portions, balance):
+    """Схема и тестовые данные одним пакетом; хэш пароля дешёвый и общий для всех"""
+    conn = sqlite3.connect(db_path)
+    migrate(conn, log=lambda msg: None)
+    pwhash = generate_password_hash(BENCH_PASSWORD, 'pbkdf2:sha256:1000')
+    now = datetime.now().isoformat()
+
+    users = ([(f's{i}', pwhash, f'Ученик {i}', 'student', SCHOOL, '9А', balance) for i in range(students)] +
+             [(f'c{i}', pwhash, f'Повар {i}', 'chef', SCHOOL, '', 0) for i in range(chefs)] +
+             [(f'adm{i}', pwhash, f'Админ {i}', 'admin', SCHOOL, '', 0) for i in range(admins)])
+    conn.executemany("INSERT INTO users (username, password, fullName, role, school, grade, balance, isApproved) "
+                     "VALUES (?,?,?,?,?,?,?,1)", users)
+    conn.executemany("INSERT INTO menu (name, price, portions, type, category, addedDate) VALUES (?,?,?,?,?,?)",
+                     [(name, price, portions, 'Второе', category, now) for name, price, category in DISHES])
+    conn.executemany("INSERT INTO sub_transactions (user, type, amount, time) VALUES (?,?,?,?)",
+                     [(f's{i}', SUB_TYPE, 2000, now) for i in range(students)])
+    for i in range(students):
+        grant(conn, f's{i}', SUB_TYPE, now[:10])
+    conn.commit()
+    conn.close()
+
+
+# ===== КЛИЕНТЫ =====
+
+class InProcessClient:
+    """Клиент поверх Flask test_client (без сети)"""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None):
+        resp = self._client.open(path, method=method, json=body)
+        data = resp.get_data()
+        return resp.status_code, data
+
+
+class HttpClient:
+    """Клиент к запущенному серверу (urllib, cookie сессии в своей банке)"""
+
+    def __init__(self, base_url):
+        self._opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self._base = base_url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self._base + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with self._opener.open(req, timeout=60) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+# ===== ИЗМЕРЕНИЯ =====
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def call(self, client, name, method, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body)
+        except Exception as e:
+            status, data = 0, str(e).encode()
+        elapsed = time.perf_counter() - start
+        locked = b'locked' in data or b'"busy"' in data
+        with self._lock:
+            s = self.samples.setdefault(name, {"latencies": [], "statuses": {}, "locked": 0})
+            s["latencies"].append(elapsed)
+            s["statuses"][status] = s["statuses"].get(status, 0) + 1
+            s["locked"] += locked
+        return status, data
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[i]
+
+
+def summarize(recorder, elapsed):
+    endpoints, total = {}, 0
+    for name, s in sorted(recorder.samples.items()):
+        lat = sorted(s["latencies"])
+        n = len(lat)
+        total += n
+        errors = sum(c for code, c in s["statuses"].items() if code == 0 or code >= 500)
+        rejected = sum(c for code, c in s["statuses"].items() if 400 <= code < 500)
+        endpoints[name] = {
+            "requests": n,
+            "rps": round(n / elapsed, 1),
+            "p50_ms": round(percentile(lat, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(lat, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(lat, 0.99) * 1000, 2),
+            "max_ms": round(lat[-1] * 1000, 2) if lat else 0,
+            "errors": errors,
+            "rejected": rejected,
+            "locked": s["locked"],
+            "statuses": {str(k): v for k, v in sorted(s["statuses"].items())},
+        }
+    return total, endpoints
+
+
+# ===== СЦЕНАРИИ =====
+
+def login(recorder, client, username):
+    status, _ = recorder.call(client, 'login', 'POST', '/api/login',
+                              {"username": username, "password": BENCH_PASSWORD})
+    if status != 200:
+        raise RuntimeError(f"Не удалось войти как {username}: {status}")
+
+
+def student(recorder, client, username, stop, rush, rng, menu_ids):
+    login(recorder, client, username)
+    cursor = None
+    while not stop.is_set():
+        path = '/api/sync' if cursor is None else f'/api/sync?since={cursor}'
+        status, data = recorder.call(client, 'sync', 'GET', path)
+        if status == 200:
+            cursor = json.loads(data).get('cursor', cursor)
+
+        # В обеденный пик ученики покупают в разы чаще
+        p_buy = 0.5 if rush.is_set() else 0.05
+        if rng.random() < p_buy:
+            recorder.call(client, 'buy', 'POST', '/api/action',
+                          {"type": "buy", "user": username, "menuId": rng.choice(menu_ids)})
+        if rush.is_set() and rng.random() < 0.1:
+            recorder.call(client, 'use_subscription', 'POST', '/api/action',
+                          {"type": "use_subscription", "user": username, "subType": SUB_TYPE,
+                           "dishes": [rng.choice(menu_ids)]})
+        time.sleep(rng.uniform(0.05, 0.2))
+
+
+def chef(recorder, client, username, stop, rng):
+    login(recorder, client, username)
+    while not stop.is_set():
+        status, data = recorder.call(client, 'chef_queue', 'GET', '/api/chef/queue?limit=20')
+        items = json.loads(data).get('items', []) if status == 200 else []
+        for order in items[:5]:
+            recorder.call(client, 'confirm_order', 'POST', '/api/action', {"type": "confirm_order", "id": order['id']})
+        time.sleep(rng.uniform(0.1, 0.3))
+
+
+def admin(recorder, client, username, stop, rng):
+    login(recorder, client, username)
+    today = datetime.now().strftime('%Y-%m-%d')
+    while not stop.is_set():
+        recorder.call(client, 'stats', 'GET', f'/api/stats?from={today}&to={today}&group=dish')
+        recorder.call(client, 'report', 'GET', f'/api/admin/report?from={today}&to={today}')
+        if rng.random() < 0.2:
+            recorder.call(client, 'export', 'GET', f'/api/export/orders?format=csv&from={today}')
+        time.sleep(rng.uniform(0.5, 1.5))
+
+
+# ===== ПРОВЕРКА ИНВАРИАНТОВ =====
+
+def check_invariants(db_path, portions, balance, students):
+    """Порции не перепроданы, балансы не отрицательны, деньги сходятся с заказами и с журналом"""
+    conn = sqlite3.connect(db_path)
+    sold = dict(conn.execute("SELECT name, COUNT(*) FROM orders GROUP BY name").fetchall())
+    left = dict(conn.execute("SELECT name, portions FROM menu").fetchall())
+    oversold = {name: sold.get(name, 0) - (portions - left[name]) for name in left
+                if sold.get(name, 0) != portions - left[name] or left[name] < 0}
+    negative = conn.execute("SELECT COUNT(*) FROM users WHERE balance < 0").fetchone()[0]
+    spent = conn.execute("SELECT COALESCE(SUM(price), 0) FROM orders").fetchone()[0]
+    debited = students * balance - conn.execute(
+        "SELECT COALESCE(SUM(balance), 0) FROM users WHERE username GLOB 's[0-9]*'").fetchone()[0]
+    ledger = reconcile(conn)['mismatches']
+    conn.close()
+    return {
+        "ordersCreated": sum(sold.values()),
+        "oversold": oversold,
+        "negativeBalances": negative,
+        "moneyMismatch": round(debited - spent, 2),
+        "ledgerMismatches": len(ledger),
+        "ok": not oversold and negative == 0 and abs(debited - spent) < 0.01 and not ledger,
+    }
+
+
+def db_size(db_path):
+    return sum(os.path.getsize(db_path + suffix) for suffix in ('', '-wal', '-shm')
+               if os.path.exists(db_path + suffix))
+
+
+# ===== ЗАПУСК =====
+
+def start_server(db_path, port, workers):
+    # Тот же многопроцессный сервер, что и в продакшене (canteen.py)
+    env = dict(os.environ, DB_PATH=db_path, PORT=str(port), WEB_WORKERS=str(workers),
+               ARCHIVE_DIR=os.path.join(os.path.dirname(db_path), 'archive'))
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'canteen.py'), 'serve'], cwd=HERE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/menu', timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Сервер не запустился")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='canteen-bench-')
+    db_path = os.path.join(workdir, 'canteen_full.db')
+    server = None
+    try:
+        seed(db_path, args.students, args.chefs, args.admins, args.portions, args.balance)
+
+        if args.server:
+            server = start_server(db_path, args.port, args.workers)
+            make_client = lambda: HttpClient(f'http://127.0.0.1:{args.port}')  # noqa: E731
+        else:
+            # База сервера — canteen_full.db в текущей папке
+            os.chdir(workdir)
+            import app as canteen
+            make_client = lambda: InProcessClient(canteen.app)  # noqa: E731
+
+        conn = sqlite3.connect(db_path)
+        menu_ids = [r[0] for r in conn.execute("SELECT id FROM menu")]
+        conn.close()
+
+        recorder, stop, rush = Recorder(), threading.Event(), threading.Event()
+        threads = []
+        for i in range(args.students):
+            rng = random.Random(args.seed + i)
+            threads.append(threading.Thread(target=student, daemon=True,
+                                            args=(recorder, make_client(), f's{i}', stop, rush, rng, menu_ids)))
+        for i in range(args.chefs):
+            threads.append(threading.Thread(target=chef, daemon=True,
+                                            args=(recorder, make_client(), f'c{i}', stop, random.Random(-i - 1))))
+        for i in range(args.admins):
+            threads.append(threading.Thread(target=admin, daemon=True,
+                                            args=(recorder, make_client(), f'adm{i}', stop, random.Random(-i - 100))))
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        # Пик — средняя треть прогона
+        time.sleep(args.duration / 3)
+        rush.set()
+        time.sleep(args.duration / 3)
+        rush.clear()
+        time.sleep(args.duration / 3)
+        stop.set()
+        for t in threads:
+            t.join(timeout=30)
+        elapsed = time.perf_counter() - start
+
+        total, endpoints = summarize(recorder, elapsed)
+        return {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "commit": git_commit(),
+            "mode": "server" if args.server else "in-process",
+            "workers": args.workers if args.server else None,
+            "config": {k: getattr(args, k) for k in ('students', 'chefs', 'admins', 'duration', 'portions',
+                                                     'balance', 'seed')},
+            "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                            "cpus": os.cpu_count()},
+            "elapsed_s": round(elapsed, 2),
+            "requests": total,
+            "rps": round(total / elapsed, 1),
+            "errors": sum(e["errors"] for e in endpoints.values()),
+            "locked": sum(e["locked"] for e in endpoints.values()),
+            "endpoints": endpoints,
+            "db_size_bytes": db_size(db_path),
+            "invariants": check_invariants(db_path, args.portions, args.balance, args.students),
+        }
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ===== РАЗМЕР ОТВЕТА SYNC =====
+
+def payload(db_path, viewer_name, repeat):
+    """Полный снимок /api/sync на копии базы: байты и время сборки, сериализации и сжатия по вариантам"""
+    workdir = tempfile.mkdtemp(prefix='canteen-payload-')
+    try:
+        shutil.copy(db_path, os.path.join(workdir, 'canteen_full.db'))
+        os.chdir(workdir)
+        os.environ['DB_PATH'] = os.path.join(workdir, 'canteen_full.db')
+        import app as canteen
+        import wire
+
+        def build(fmt):
+            snapshot = canteen.full_snapshot(db, viewer, fmt)
+            snapshot.update({"full": True, "cursor": 0, "versions": {}})
+            return snapshot
+
+        variants = [
+            # Как было: jsonify (стандартный json, ensure_ascii и сортировка ключей)
+            ('jsonify', lambda: canteen.app.json.dumps(build('json')).encode()),
+            ('json', lambda: wire.dumps(build('json'))),
+            ('columnar', lambda: wire.dumps(wire.encode_sync(build('columnar'), 'columnar'))),
+        ]
+        results, rows = [], {}
+        with canteen.app.app_context(), canteen.get_db() as db:
+            viewer = db.execute("SELECT * FROM users WHERE username = ?", (viewer_name,)).fetchone()
+            viewer = dict(viewer) if viewer else None
+            rows = {k: wire.table_rows(v) for k, v in build('json').items() if isinstance(v, list)}
+            for name, serialize in variants:
+                for encoding in (None,) + wire.encodings():
+                    times = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        body, _ = wire.compress(serialize(), encoding)
+                        times.append(time.perf_counter() - start)
+                    results.append({"format": name, "encoding": encoding or 'identity', "bytes": len(body),
+                                    "ms": round(percentile(sorted(times), 50) * 1000, 2)})
+
+        baseline = results[0]
+        for v in results:
+            v["bytes_vs_jsonify"] = round(v["bytes"] / baseline["bytes"], 3)
+            v["ms_vs_jsonify"] = round(v["ms"] / baseline["ms"], 3)
+        return {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "commit": git_commit(),
+            "mode": "payload",
+            "viewer": viewer_name,
+            "rows": rows,
+            "orjson": wire.orjson is not None,
+            "variants": results,
+        }
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_payload(result):
+    rows = ', '.join(f"{k} {v}" for k, v in result['rows'].items())
+    print(f"\nПолный снимок для {result['viewer']}: {rows}; orjson {'есть' if result['orjson'] else 'нет'}")
+    print("мс — сборка снимка из базы, сериализация и сжатие вместе (медиана)")
+    print(f"{'формат':<10}{'сжатие':<10}{'байт':>12}{'доля':>8}{'мс':>9}{'доля':>8}")
+    for v in result['variants']:
+        print(f"{v['format']:<10}{v['encoding']:<10}{v['bytes']:>12}{v['bytes_vs_jsonify']:>8}"
+              f"{v['ms']:>9}{v['ms_vs_jsonify']:>8}")
+
+
+def print_report(result):
+    print(f"\n{result['mode']}: {result['requests']} запросов за {result['elapsed_s']} с "
+          f"({result['rps']} req/s), ошибок {result['errors']}, блокировок {result['locked']}, "
+          f"база {result['db_size_bytes'] / 1024 / 1024:.1f} МБ")
+    print(f"{'эндпоинт':<18}{'req':>7}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'err':>6}{'4xx':>6}{'lock':>6}")
+    for name, e in result['endpoints'].items():
+        print(f"{name:<18}{e['requests']:>7}{e['rps']:>8}{e['p50_ms']:>9}{e['p95_ms']:>9}{e['p99_ms']:>9}"
+              f"{e['errors']:>6}{e['rejected']:>6}{e['locked']:>6}")
+    inv = result['invariants']
+    print(f"Инварианты: {'✅' if inv['ok'] else '❌'} заказов {inv['ordersCreated']}, перепродано {inv['oversold']}, "
+          f"отрицательных балансов {inv['negativeBalances']}, расхождение денег {inv['moneyMismatch']}, "
+          f"расхождений с журналом {inv['ledgerMismatches']}")
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} → {new.get('commit')}: {old['rps']} → {new['rps']} req/s")
+    print(f"{'эндпоинт':<18}{'p95 было':>10}{'p95 стало':>11}{'изм.':>9}")
+    for name in sorted(set(old['endpoints']) | set(new['endpoints'])):
+        a = old['endpoints'].get(name, {}).get('p95_ms')
+        b = new['endpoints'].get(name, {}).get('p95_ms')
+        change = f"{(b - a) / a * 100:+.0f}%" if a and b else ''
+        print(f"{name:<18}{a if a is not None else '-':>10}{b if b is not None else '-':>11}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон столовой на временной базе")
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--chefs', type=int, default=2)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=30, help="длительность прогона, сек")
+    parser.add_argument('--portions', type=int, default=100, help="порций каждого блюда")
+    parser.add_argument('--balance', type=int, default=1000, help="стартовый баланс ученика")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server', action='store_true', help="гонять через HTTP против локального сервера")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--workers', type=int, default=2, help="воркеров сервера в режиме --server")
+    parser.add_argument('--out', help="куда записать JSON (по умолчанию bench-results/<время>-<коммит>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="сравнить два JSON-результата")
+    parser.add_argument('--payload', metavar='DB', help="измерить размер и сериализацию полного снимка sync на базе")
+    parser.add_argument('--viewer', default='admin', help="от чьего имени снимок для --payload")
+    parser.add_argument('--repeat', type=int, default=5, help="повторов каждого варианта для --payload")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.payload:
+        result = payload(args.payload, args.viewer, args.repeat)
+        print_payload(result)
+    else:
+        result = run(args)
+        print_report(result)
+
+    out = args.out or os.path.join(HERE, 'bench-results',
+                                   f"{datetime.now():%Y%m%d-%H%M%S}-{result['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результат: {out}")
+    sys.exit(0 if result.get('invariants', {'ok': True})['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""Запуск сервера для продакшена: python -m canteen serve.
+
+Мастер-процесс один раз выполняет инициализацию и миграции (импорт app),
+открывает сокет и форкает воркеры. Каждый воркер обслуживает запросы
+ограниченным пулом потоков. Когда все потоки заняты, воркер не принимает
+новые соединения, и их забирают свободные воркеры. Упавший воркер мастер
+перезапускает. Ожидание событий (/api/events и /api/events/poll) потока
+не занимает: после заголовков ответа соединение уходит потоку событий
+воркера (events.EventHub).
+
+Сигналы мастеру:
+    TERM, INT  мягкая остановка: воркеры дообслуживают начатые запросы
+               (не дольше WEB_GRACEFUL_TIMEOUT), затем выходят
+    HUP        перезагрузка без простоя: новая версия кода проверяется и
+               мигрирует базу отдельным процессом, мастер перезапускает себя
+               с тем же сокетом, поднимает новые воркеры и мягко гасит старые
+
+    python -m canteen serve [--workers N] [--threads N] [--port P]
+    python -m canteen migrate          — только инициализация и миграции
+
+    HOST                  адрес (0.0.0.0)
+    PORT                  порт (8080)
+    WEB_WORKERS           процессов-воркеров (число ядер)
+    WEB_THREADS           потоков на воркер (16)
+    WEB_GRACEFUL_TIMEOUT  сколько ждать начатые запросы при остановке, сек (30)
+    WEB_KEEPALIVE         сколько держать простаивающее keep-alive соединение, сек (5)
+"""
+import argparse
+import io
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from events import DETACH_ENVIRON
+from logs import get_logger
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8080))
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 16))
+WEB_GRACEFUL_TIMEOUT = float(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+WEB_KEEPALIVE = float(os.environ.get('WEB_KEEPALIVE', 5))
+
+# Переживают перезапуск мастера по HUP: сокет и воркеры старой версии
+LISTEN_FD_ENV = 'CANTEEN_LISTEN_FD'
+OLD_WORKERS_ENV = 'CANTEEN_OLD_WORKERS'
+
+# Воркер, упавший быстрее этого (сек), перезапускается с паузой — не в цикле
+MIN_WORKER_LIFETIME = 1
+
+
+class _Discard(io.RawIOBase):
+    """wfile отданного соединения: хвост ответа werkzeug в сокет не пишется"""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Журнал запросов — в подсистему HTTP вместо stderr"""
+
+    protocol_version = 'HTTP/1.1'
+    timeout = WEB_KEEPALIVE
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ[DETACH_ENVIRON] = self.detach
+        return environ
+
+    def detach(self):
+        """Отдаёт соединение приложению и освобождает поток запроса.
+
+        Вызывается из тела ответа после отправки заголовков. Возвращает копию
+        сокета: дальше ответ (chunked) пишет владелец копии, а werkzeug
+        дописывает свой завершающий чанк в никуда и не закрывает соединение.
+        """
+        self.server.detached.add(self.connection)
+        self.close_connection = True
+        self.wfile = _Discard()
+        return self.connection.dup()
+
+    def log_request(self, code='-', size='-'):
+        get_logger('HTTP').debug(f"{self.command} {self.path} {code}", size=size)
+
+    def log_error(self, format, *args):
+        get_logger('HTTP').warning(format % args)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI-сервер воркера на общем сокете мастера с пулом из threads потоков"""
+
+    multithread = True
+
+    def __init__(self, app, sock, threads):
+        host, port = sock.getsockname()[:2]
+        super().__init__(host, port, app, handler=RequestHandler, fd=sock.fileno())
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='http')
+        self._slots = threading.Semaphore(threads)
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.detached = set()
+
+    def process_request(self, request, client_address):
+        # Ждём свободный поток; пока ждём, следующие соединения принимают другие воркеры
+        while not self._slots.acquire(timeout=0.5):
+            if self._stopping.is_set():
+                self.shutdown_request(request)
+                return
+        with self._active_lock:
+            self._active += 1
+        self._executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if request in self.detached:
+                # Соединение живёт в копии сокета у приложения — закрываем только свой дескриптор
+                self.detached.discard(request)
+                request.close()
+            else:
+                self.shutdown_request(request)
+            with self._active_lock:
+                self._active -= 1
+            self._slots.release()
+
+    def stop(self):
+        """Перестаёт принимать соединения (из обработчика сигнала)"""
+        self._stopping.set()
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def drain(self, timeout):
+        """Ждёт начатые запросы не дольше timeout сек. Возвращает, сколько не успели"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._active_lock:
+                if self._active == 0:
+                    return 0
+            time.sleep(0.1)
+        return self._active
+
+
+def listen_socket(host, port):
+    """Сокет, унаследованный от прошлой версии мастера (HUP), или новый"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        return socket.socket(fileno=int(fd))
+    return socket.create_server((host, port), backlog=2048)
+
+
+def run_worker(app, sock, threads, graceful_timeout):
+    log = get_logger('SERVER')
+    server = PooledWSGIServer(app, sock, threads)
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    # Ctrl+C приходит всей группе процессов — останавливает мастер, он и погасит воркеры
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    log.info("Воркер запущен", pid=os.getpid(), threads=threads)
+    server.serve_forever()
+    left = server.drain(graceful_timeout)
+    if left:
+        log.warning(f"⚠️ Воркер остановлен с незавершёнными запросами: {left}", pid=os.getpid())
+    log.info("Воркер остановлен", pid=os.getpid())
+
+
+class Master:
+    def __init__(self, app, sock, workers, threads, graceful_timeout):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.children = {}   # pid → время запуска
+        self.old = set()     # воркеры прошлой версии, ожидающие остановки
+        self._stop = False
+        self._reload = False
+        self.log = get_logger('SERVER')
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.threads, self.graceful_timeout)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                logging_flush()
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for _ in range(self.workers):
+            self.spawn()
+        self.log.info("🚀 Сервер запущен", address=f"{self.sock.getsockname()[0]}:{self.sock.getsockname()[1]}",
+                      workers=self.workers, threads=self.threads, pid=os.getpid())
+
+        # Новые воркеры уже принимают соединения — старые дообслуживают свои и выходят
+        self.old = {int(p) for p in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if p}
+        self._signal(self.old, signal.SIGTERM)
+
+        while not self._stop:
+            self._reap()
+            if self._reload:
+                self._reload = False
+                self.reexec()
+            time.sleep(0.2)
+        self.shutdown()
+
+    def _on_stop(self, *_):
+        self._stop = True
+
+    def _on_reload(self, *_):
+        self._reload = True
+
+    def _signal(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.old.discard(pid)
+            started = self.children.pop(pid, None)
+            if started is None or self._stop:
+                continue
+            self.log.warning(f"⚠️ Воркер {pid} завершился (код {os.waitstatus_to_exitcode(status)}), перезапускаем")
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+
+    def reexec(self):
+        """HUP: проверка и миграции новой версии, затем перезапуск мастера с тем же сокетом"""
+        from pii import ENCRYPTION_KEY
+        # Сгенерированный при старте ключ должен пережить перезапуск, иначе данные не расшифровать
+        os.environ.setdefault('ENCRYPTION_KEY', ENCRYPTION_KEY.decode()
+                              if isinstance(ENCRYPTION_KEY, bytes) else ENCRYPTION_KEY)
+        # То же для ключа сессий, иначе после перезагрузки всех разлогинит
+        from app import app
+        os.environ.setdefault('SECRET_KEY', app.secret_key)
+
+        self.log.info("Перезагрузка: проверяем новую версию и применяем миграции")
+        check = subprocess.run([sys.executable, os.path.abspath(__file__), 'migrate'])
+        if check.returncode != 0:
+            self.log.warning("⚠️ Новая версия не запускается — продолжаем на текущей")
+            return
+
+        os.set_inheritable(self.sock.fileno(), True)
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(p) for p in list(self.children) + list(self.old))
+        logging_flush()
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)] + sys.argv[1:])
+
+    def shutdown(self):
+        self.log.info("Останавливаем воркеры", workers=len(self.children) + len(self.old))
+        pids = set(self.children) | self.old
+        self._signal(pids, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                pids.discard(pid)
+            else:
+                time.sleep(0.1)
+        self._signal(pids, signal.SIGKILL)
+        self.log.info("✅ Сервер остановлен")
+        logging_flush()
+
+
+def logging_flush():
+    from logs import setup_logging
+    setup_logging().stop()
+
+
+def serve(args):
+    sock = listen_socket(args.host, args.port)
+    # Инициализация и миграции — при импорте, один раз, до fork
+    from app import app
+    from db import close_pools
+    # Соединения SQLite не переживают fork: воркеры откроют свои
+    close_pools()
+    Master(app, sock, args.workers, args.threads, args.graceful_timeout).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m canteen', description="Сервер столовой")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="многопроцессный сервер для продакшена")
+    serve_parser.add_argument('--host', default=HOST)
+    serve_parser.add_argument('--port', type=int, default=PORT)
+    serve_parser.add_argument('--workers', type=int, default=WEB_WORKERS)
+    serve_parser.add_argument('--threads', type=int, default=WEB_THREADS)
+    serve_parser.add_argument('--graceful-timeout', type=float, default=WEB_GRACEFUL_TIMEOUT)
+
+    commands.add_parser('migrate', help="инициализация базы и миграции")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(args)
+    else:
+        import app  # noqa: F401 — инициализация и миграции выполняются при импорте
+        logging_flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Журнал изменений для инкрементальной синхронизации (/api/sync?since=...).
+
+Каждая запись в синхронизируемые таблицы через триггеры попадает в change_log
+с монотонно растущим seq. Клиент хранит последний seq (курсор) и получает
+только строки, изменённые после него.
+
+Видимость строк задаёт scope — {ключ sync: (WHERE, параметры, leaves) или None}:
+None — таблица смотрящему не отдаётся, условие — только подходящие строки,
+таблицы нет в scope — отдаётся целиком. leaves=True — строка может перестать
+подходить под условие от изменения (заказ из очереди повара выдан вчерашним
+числом): изменённые и больше не видимые строки такой таблицы приходят как
+удалённые. Для «своих строк» leaves=False, чужие ключи клиенту не уходят.
+"""
+
+# (ключ в ответе sync, таблица, ключевой столбец)
+# Для таблиц без первичного ключа используется rowid, он отдаётся клиенту как _rid.
+# Уведомления не синхронизируются: у них свои входящие (inbox.py, /api/me/notifications)
+SYNC_TABLES = [
+    ('menu', 'menu', 'id'),
+    ('orders', 'orders', 'id'),
+    ('ingredients', 'ingredients', 'id'),
+    ('users', 'users', 'username'),
+    ('reviews', 'reviews', 'rowid'),
+    ('purchases', 'purchases', 'id'),
+    ('subTransactions', 'sub_transactions', 'rowid'),
+    ('subscriptionUsage', 'subscription_usage', 'id'),
+    ('entitlements', 'entitlements', 'rowid'),
+]
+
+# Таблицы, которым журнал ставит миграция 2 (install_change_log). Выпущенная миграция
+# не меняется: таблицы, добавленные в SYNC_TABLES позже, получают триггеры
+# своей миграцией через track_changes
+CHANGE_LOG_BASE_TABLES = ('menu', 'orders', 'ingredients', 'users', 'reviews', 'purchases',
+                          'sub_transactions', 'subscription_usage')
+
+# Сколько последних записей журнала хранить. Клиент с более старым курсором
+# получает полный снимок.
+CHANGE_LOG_KEEP = 50000
+
+# Ограничение SQLite на число параметров в одном запросе
+_IN_CHUNK = 500
+
+
+def install_change_log(db):
+    """Создаёт таблицу журнала и триггеры на все синхронизируемые таблицы"""
+    db.execute('''CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT,
+        rowKey,
+        op TEXT)''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_change_log_tbl_seq ON change_log (tbl, seq)")
+
+    for _, table, key in SYNC_TABLES:
+        if table in CHANGE_LOG_BASE_TABLES:
+            track_changes(db, table, key)
+
+
+def track_changes(db, table, key):
+    """Триггеры, записывающие изменения строк таблицы в change_log"""
+    for event, ref, op in (('INSERT', 'NEW', 'upsert'), ('UPDATE', 'NEW', 'upsert'), ('DELETE', 'OLD', 'delete')):
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_log
+            AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO change_log (tbl, rowKey, op) VALUES ('{table}', {ref}.{key}, '{op}');
+            END''')
+
+
+def current_cursor(db):
+    """Текущая версия данных (последний seq журнала)"""
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+
+
+def table_versions(db):
+    """Версия каждой таблицы — seq её последнего изменения"""
+    rows = db.execute("SELECT tbl, MAX(seq) FROM change_log GROUP BY tbl").fetchall()
+    versions = {table: 0 for _, table, _ in SYNC_TABLES}
+    versions.update({r[0]: r[1] for r in rows})
+    return {name: versions[table] for name, table, _ in SYNC_TABLES}
+
+
+def cursor_is_valid(db, since):
+    """Проверяет, что журнал ещё содержит все изменения после since"""
+    floor = db.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+    return since >= 0 and (floor is None or since >= floor - 1)
+
+
+def select_rows(table, key):
+    """SELECT для выборки строк таблицы в формате sync"""
+    if key == 'rowid':
+        return f"SELECT rowid AS _rid, * FROM {table}"
+    return f"SELECT * FROM {table}"
+
+
+def select_visible(table, key, where=None):
+    """SELECT строк таблицы в формате sync, видимых смотрящему (условие where из scope)"""
+    query = select_rows(table, key)
+    return f"{query} WHERE ({where})" if where else query
+
+
+def table_version(db, table):
+    """seq последнего изменения одной таблицы (0, если в журнале его нет)"""
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log WHERE tbl = ?", (table,)).fetchone()[0]
+
+
+def changed_keys(db, table, since, cursor):
+    """Ключи строк таблицы, изменённых в интервале (since, cursor]: (изменённые, удалённые)"""
+    # Для каждой строки берём последнюю операцию: bare-столбец op при MAX()
+    # в SQLite берётся из той же записи, что и максимум
+    changed = db.execute(
+        "SELECT rowKey, op, MAX(seq) FROM change_log WHERE tbl = ? AND seq > ? AND seq <= ? GROUP BY rowKey",
+        (table, since, cursor)).fetchall()
+    return [r[0] for r in changed if r[1] != 'delete'], [r[0] for r in changed if r[1] == 'delete']
+
+
+def select_by_keys(db, table, key, keys, where=None, params=()):
+    """Строки таблицы с указанными ключами (запросами по _IN_CHUNK ключей), подходящие под where"""
+    for i in range(0, len(keys), _IN_CHUNK):
+        chunk = keys[i:i + _IN_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        query = f"{select_rows(table, key)} WHERE {key} IN ({placeholders})"
+        if where:
+            query += f" AND ({where})"
+        yield from db.execute(query, list(chunk) + list(params)).fetchall()
+
+
+def collect_changes(db, since, cursor, row_hook=None, scope=None):
+    """Собирает изменения в интервале (since, cursor] по всем таблицам.
+
+    Возвращает {ключ sync: {"upserts": [...], "deleted": [...]}} только для
+    изменившихся таблиц. row_hook(name, row) позволяет дообработать строку
+    (например, расшифровать персональные данные); scope — видимость строк
+    смотрящему (см. описание модуля).
+    """
+    scope = scope or {}
+    result = {}
+    for name, table, key in SYNC_TABLES:
+        if name in scope and scope[name] is None:
+            continue
+        keys, deleted = changed_keys(db, table, since, cursor)
+        if not keys and not deleted:
+            continue
+
+        where, params, leaves = scope.get(name) or (None, (), False)
+        row_key = '_rid' if key == 'rowid' else key
+        upserts = []
+        for r in select_by_keys(db, table, key, keys, where, params):
+            row = dict(r)
+            upserts.append(row_hook(name, row) if row_hook else row)
+        if leaves:
+            visible = {row[row_key] for row in upserts}
+            deleted += [k for k in keys if k not in visible]
+        if not upserts and not deleted:
+            continue
+
+        result[name] = {"key": row_key, "upserts": upserts, "deleted": deleted}
+    return result
+
+
+def prune_change_log(db, keep=CHANGE_LOG_KEEP):
+    """Удаляет старые записи журнала, оставляя последние keep"""
+    db.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?", (keep,))
@@ -0,0 +1,211 @@
+"""Подключение к SQLite: пул соединений, WAL и настройки через переменные окружения.
+
+    DB_PATH               файл базы (canteen_full.db в текущем каталоге)
+    DB_POOL_SIZE          максимум соединений в пуле процесса (16)
+    DB_POOL_TIMEOUT       сколько ждать свободного соединения, сек (10)
+    DB_JOURNAL_MODE       режим журнала (WAL) — читатели не блокируют писателя
+    DB_SYNCHRONOUS        PRAGMA synchronous (NORMAL — безопасно в WAL и быстрее FULL)
+    DB_BUSY_TIMEOUT_MS    сколько ждать снятия блокировки записи, мс (5000)
+    DB_CACHE_SIZE_KB      кэш страниц на соединение, КБ (16384)
+    DB_MMAP_SIZE          размер memory-mapped I/O, байт (268435456)
+    DB_STATEMENT_CACHE    кэш подготовленных запросов на соединение (256)
+
+Пул — на каждый файл базы. get_db() без пути отдаёт соединение с базой,
+выбранной для текущего запроса через route() (шард школы, shards.py), иначе
+с DB_PATH.
+"""
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+DB_NAME = os.environ.get('DB_PATH', "canteen_full.db")
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', 256))
+
+
+class Connection(sqlite3.Connection):
+    """Соединение, которое помнит свой файл: кэши процесса (меню, аллергены) держат состояние по базам"""
+    path = None
+
+
+def connect(path=None):
+    """Новое соединение с настроенными PRAGMA (без пула)"""
+    conn = sqlite3.connect(path or DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=DB_STATEMENT_CACHE, check_same_thread=False, factory=Connection)
+    conn.path = path or DB_NAME
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """Пул соединений процесса.
+
+    Соединение берётся на время одного `with`, затем возвращается в пул.
+    Свободные соединения выдаются LIFO, чтобы горячие (с прогретым кэшем
+    страниц и запросов) переиспользовались первыми.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._stats = {"hits": 0, "misses": 0, "waits": 0, "wait_ms": 0.0, "timeouts": 0, "max_in_use": 0}
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            self._count(hits=1)
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                conn = connect(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            self._count(misses=1)
+            return conn
+
+        # Пул исчерпан — ждём, пока кто-то вернёт соединение
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self._count(acquired=False, timeouts=1)
+            raise sqlite3.OperationalError("Нет свободных соединений с базой данных")
+        self._count(waits=1, wait_ms=(time.perf_counter() - started) * 1000)
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def _count(self, acquired=True, **deltas):
+        with self._lock:
+            for k, v in deltas.items():
+                self._stats[k] += v
+            if acquired:
+                self._in_use += 1
+                self._stats['max_in_use'] = max(self._stats['max_in_use'], self._in_use)
+
+    def connection(self):
+        return PooledConnection(self)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=self.size, created=self._created, in_use=self._in_use,
+                        idle=self._idle.qsize())
+
+    def close_all(self):
+        """Закрывает свободные соединения (например, перед fork)"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = self._in_use
+
+
+class PooledConnection:
+    """`with get_db() as db:` — коммит при успехе, откат при исключении, возврат в пул"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = self._pool.acquire()
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        conn, self._conn = self._conn, None
+        try:
+            if exc_type is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        finally:
+            self._pool.release(conn)
+        return False
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+# База для get_db() без пути в текущем запросе; None — DB_PATH
+_route = contextvars.ContextVar('db_route', default=None)
+
+
+def route(path):
+    """Выбирает базу для get_db() без пути до следующего route(); None — DB_PATH"""
+    _route.set(path)
+
+
+def routed_path():
+    return _route.get() or DB_NAME
+
+
+def get_pool(path=None):
+    """Пул базы (по умолчанию — выбранной для запроса); после fork создаётся заново"""
+    path = path or routed_path()
+    pool = _pools.get(path)
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools.get(path)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[path] = ConnectionPool(path)
+    return pool
+
+
+def get_db(path=None):
+    return get_pool(path).connection()
+
+
+def pool_stats():
+    """Статистика пула; с несколькими базами (шардами) — сумма по пулам и их число"""
+    pools = [p for p in list(_pools.values()) if p.pid == os.getpid()] or [get_pool()]
+    if len(pools) == 1:
+        return pools[0].stats()
+    total = {}
+    for pool in pools:
+        for k, v in pool.stats().items():
+            total[k] = total.get(k, 0) + v
+    return dict(total, pools=len(pools))
+
+
+def close_pools():
+    """Закрывает свободные соединения всех пулов (перед fork)"""
+    for pool in list(_pools.values()):
+        pool.close_all()
@@ -0,0 +1,365 @@
+"""Push-уведомления клиентам об изменениях (SSE /api/events и long-poll).
+
+События пишутся в таблицу events в той же транзакции, что и само изменение,
+поэтому их видят все процессы сервера. Ожидающие клиенты спят на условной
+переменной и не трогают БД: один фоновый поток на процесс раз в
+POLL_INTERVAL проверяет MAX(id), а записи из этого же процесса будят
+клиентов сразу через notify().
+
+Под canteen serve ожидающий клиент (SSE или long-poll) не держит поток
+запроса: отправив заголовки, сервер отдаёт сокет EventHub — одному потоку
+на процесс, который ждёт событий на всех таких соединениях сразу.
+"""
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from datetime import datetime
+
+from logs import get_logger
+
+# Как часто проверять события других процессов (сек)
+POLL_INTERVAL = 0.5
+
+# Сколько последних событий хранить
+EVENTS_KEEP = 10000
+
+# Максимум событий в одной пачке для клиента
+BATCH_SIZE = 100
+
+# Сколько неотправленных байт копить медленному клиенту хаба, прежде чем отключить его
+HUB_MAX_BUFFER = 1 << 20
+
+# Ключ WSGI environ: функция, забирающая сокет запроса у потока (canteen.RequestHandler.detach)
+DETACH_ENVIRON = 'canteen.detach'
+
+
+def install_events(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT,
+        toUser TEXT,
+        toRole TEXT,
+        payload TEXT,
+        createdAt TEXT)''')
+
+
+def publish(db, event_type, data=None, to_user=None, to_role=None):
+    """Записывает событие в текущей транзакции.
+
+    Без to_user и to_role событие получают все подключённые клиенты.
+    """
+    db.execute("INSERT INTO events (type, toUser, toRole, payload, createdAt) VALUES (?,?,?,?,?)",
+               (event_type, to_user, to_role, json.dumps(data or {}, ensure_ascii=False),
+                datetime.now().isoformat()))
+
+
+def publish_many(db, event_type, rows_sql, params=()):
+    """Записывает пачку событий одним INSERT ... SELECT.
+
+    rows_sql — SELECT, отдающий (toUser, toRole, payload в JSON) на каждое событие.
+    """
+    db.execute(f"INSERT INTO events (type, toUser, toRole, payload, createdAt) SELECT ?, r.*, ? FROM ({rows_sql}) r",
+               (event_type, datetime.now().isoformat(), *params))
+
+
+def fetch_events(db, after, upto, user=None):
+    """События в интервале (after, upto], адресованные пользователю, его роли или всем"""
+    username = user['username'] if user else None
+    role = user['role'] if user else None
+    rows = db.execute('''SELECT id, type, payload FROM events
+        WHERE id > ? AND id <= ?
+          AND ((toUser IS NULL AND toRole IS NULL) OR toUser = ? OR toRole = ?)
+        ORDER BY id LIMIT ?''', (after, upto, username, role, BATCH_SIZE)).fetchall()
+    return [{"id": r['id'], "type": r['type'], "data": json.loads(r['payload'])} for r in rows]
+
+
+def next_batch(db, after, upto, user=None):
+    """Пачка событий для клиента и курсор, с которого продолжать"""
+    batch = fetch_events(db, after, upto, user)
+    return batch, batch[-1]['id'] if len(batch) == BATCH_SIZE else upto
+
+
+def sse_message(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+
+def prune_events(db, keep=EVENTS_KEEP):
+    db.execute("DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (keep,))
+
+
+class EventBroker:
+    """Будит ожидающих клиентов, когда в таблице events появляются новые записи"""
+
+    def __init__(self, connect, poll_interval=POLL_INTERVAL):
+        self._connect = connect
+        self._poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._latest = None
+        self._waiting = 0
+        self._watchers = []
+        self._poller = None
+
+    def _read_latest(self):
+        with self._connect() as db:
+            return db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def latest(self):
+        """id последнего известного события"""
+        with self._cond:
+            if self._latest is None:
+                self._latest = self._read_latest()
+            return self._latest
+
+    def notify(self):
+        """Проверяет новые события и будит ожидающих. Вызывать после коммита"""
+        latest = self._read_latest()
+        watchers = ()
+        with self._cond:
+            if self._latest is None or latest > self._latest:
+                self._latest = latest
+                self._cond.notify_all()
+                watchers = list(self._watchers)
+        for callback in watchers:
+            callback()
+
+    def wait(self, after, timeout):
+        """Ждёт событие с id > after не дольше timeout сек. Возвращает последний id"""
+        self.latest()
+        with self._cond:
+            self._waiting += 1
+            self._ensure_poller()
+            try:
+                self._cond.wait_for(lambda: self._latest > after, timeout)
+            finally:
+                self._waiting -= 1
+            return self._latest
+
+    def watch(self, callback):
+        """callback() вызывается после каждого нового события, пока не снят unwatch"""
+        with self._cond:
+            self._watchers.append(callback)
+            self._ensure_poller()
+
+    def unwatch(self, callback):
+        with self._cond:
+            self._watchers.remove(callback)
+
+    def _ensure_poller(self):
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll, name='event-poller', daemon=True)
+            self._poller.start()
+
+    def _poll(self):
+        # Ловит события, записанные другими процессами; пока никто не ждёт — БД не трогает
+        while True:
+            time.sleep(self._poll_interval)
+            with self._cond:
+                idle = self._waiting == 0 and not self._watchers
+            if not idle:
+                try:
+                    self.notify()
+                except Exception as e:
+                    get_logger('EVENTS').warning(f"⚠️ Ошибка опроса событий: {e}")
+
+
+class _Subscriber:
+    """Соединение SSE или long-poll, которое обслуживает EventHub"""
+
+    __slots__ = ('sock', 'events', 'connect', 'viewer', 'after', 'poll', 'due', 'out', 'writing', 'done')
+
+    def __init__(self, sock, events, connect, viewer, after, poll, due):
+        self.sock = sock
+        self.events = events
+        self.connect = connect
+        self.viewer = viewer
+        self.after = after
+        self.poll = poll
+        # SSE — время следующего пинга, long-poll — срок ответа
+        self.due = due
+        self.out = bytearray()
+        self.writing = False
+        self.done = False
+
+
+def _chunk(data):
+    """Кусок тела с Transfer-Encoding: chunked — werkzeug выбирает его для ответа без длины"""
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+class EventHub:
+    """Ожидающие событий клиенты (SSE и long-poll) без потока на каждого.
+
+    Сервер (canteen.py) после заголовков ответа передаёт сокет в add() и
+    сразу освобождает поток запроса. Дальше соединением занимается поток
+    хаба: по сигналу брокера дописывает пачки событий SSE и раз в heartbeat
+    сек шлёт пинг, а long-poll отвечает первой непустой пачкой или пустой к
+    сроку. Сокет закрывается, когда клиент отключился или не успевает
+    читать (больше HUB_MAX_BUFFER в очереди). Поток один на процесс и
+    запускается с первым подписчиком — уже в воркере, после fork.
+    """
+
+    def __init__(self, heartbeat):
+        self._heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pid = None
+        self._subscribers = set()
+        self._watched = {}   # брокер → число его подписчиков
+
+    def add(self, sock, events, connect, viewer, after, deadline=None):
+        """Передаёт хабу соединение, ждущее событий брокера events после after.
+
+        connect() — соединение с базой брокера, viewer — кому адресованы события.
+        С deadline (по time.monotonic()) это long-poll: один ответ
+        {"events", "cursor"} не позже deadline; без него — поток SSE.
+        """
+        sock.setblocking(False)
+        poll = deadline is not None
+        subscriber = _Subscriber(sock, events, connect, viewer, after, poll,
+                                 deadline if poll else time.monotonic() + self._heartbeat)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            self._pending.append(subscriber)
+        self._wake()
+
+    def stats(self):
+        return {"subscribers": len(self._subscribers), "pending": len(self._pending)}
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        threading.Thread(target=self._run, name='event-hub', daemon=True).start()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # Буфер полон — поток и так проснётся
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                get_logger('EVENTS').warning(f"⚠️ Ошибка хаба событий: {e}")
+                time.sleep(POLL_INTERVAL)
+
+    def _step(self):
+        timeout = None
+        if self._subscribers:
+            timeout = max(0, min(s.due for s in self._subscribers) - time.monotonic())
+        for key, mask in self._selector.select(timeout):
+            if key.data is None:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            subscriber = key.data
+            if mask & selectors.EVENT_READ and not self._alive(subscriber):
+                self._drop(subscriber)
+            elif mask & selectors.EVENT_WRITE:
+                self._flush(subscriber)
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for subscriber in pending:
+            self._admit(subscriber)
+
+        now = time.monotonic()
+        for subscriber in list(self._subscribers):
+            if subscriber in self._subscribers:
+                self._serve(subscriber, now)
+
+    def _admit(self, subscriber):
+        self._subscribers.add(subscriber)
+        self._selector.register(subscriber.sock, selectors.EVENT_READ, subscriber)
+        events = subscriber.events
+        self._watched[events] = self._watched.get(events, 0) + 1
+        if self._watched[events] == 1:
+            events.watch(self._wake)
+
+    def _serve(self, subscriber, now):
+        if subscriber.done:
+            return
+        latest = subscriber.events.latest()
+        batch = []
+        # Long-poll отвечает первой непустой пачкой, SSE получает всё до latest
+        while latest > subscriber.after and not (batch and subscriber.poll):
+            with subscriber.connect() as db:
+                more, subscriber.after = next_batch(db, subscriber.after, latest, subscriber.viewer)
+            batch.extend(more)
+
+        if subscriber.poll:
+            if batch or now >= subscriber.due:
+                subscriber.done = True
+                self._send(subscriber, json.dumps({"events": batch, "cursor": subscriber.after}, ensure_ascii=False))
+            return
+        if not batch and now < subscriber.due:
+            return
+        subscriber.due = now + self._heartbeat
+        self._send(subscriber, ''.join(sse_message(e) for e in batch) or ": ping\n\n")
+
+    def _send(self, subscriber, text):
+        subscriber.out += _chunk(text.encode())
+        if subscriber.done:
+            subscriber.out += b'0\r\n\r\n'
+        if len(subscriber.out) > HUB_MAX_BUFFER:
+            # Клиент не читает: пусть переподключится и заберёт изменения через sync
+            self._drop(subscriber)
+        else:
+            self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        try:
+            sent = subscriber.sock.send(subscriber.out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(subscriber)
+            return
+        del subscriber.out[:sent]
+        if subscriber.done and not subscriber.out:
+            self._drop(subscriber)
+            return
+        writing = bool(subscriber.out)
+        if writing != subscriber.writing:
+            subscriber.writing = writing
+            mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self._selector.modify(subscriber.sock, mask, subscriber)
+
+    @staticmethod
+    def _alive(subscriber):
+        # Клиент событий ничего не присылает; пустое чтение — он закрыл соединение
+        try:
+            return bool(subscriber.sock.recv(4096))
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _drop(self, subscriber):
+        if subscriber not in self._subscribers:
+            return
+        self._subscribers.discard(subscriber)
+        self._selector.unregister(subscriber.sock)
+        try:
+            subscriber.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        subscriber.sock.close()
+        events = subscriber.events
+        self._watched[events] -= 1
+        if not self._watched[events]:
+            del self._watched[events]
+            events.unwatch(self._wake)
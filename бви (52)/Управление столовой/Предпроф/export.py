@@ -0,0 +1,189 @@
+"""Потоковая выгрузка отчётов в CSV и XLSX (/api/export/<kind>).
+
+Строки читаются курсором SQLite пачками по FETCH_SIZE и сразу уходят клиенту
+chunked-ответом, поэтому память не зависит от размера периода. В WAL долгое
+чтение не мешает параллельным записям.
+
+XLSX собирается вручную (zip с листом из inline-строк) без сторонних
+библиотек: zipfile умеет писать в поток без seek.
+"""
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from archive import history
+
+FETCH_SIZE = 1000
+
+# Что можно выгружать: заголовки, SELECT и фильтры из query string
+ORDER_COLUMNS = ['Дата', 'Ученик', 'Класс', 'Школа', 'Блюдо', 'Цена', 'Статус', 'Выдано']
+PURCHASE_COLUMNS = ['№', 'Продукт', 'Количество', 'Сумма', 'Статус']
+
+
+def order_rows(db, args):
+    """Заказы с фильтрами ?from=, ?to= (YYYY-MM-DD включительно), ?school=, ?status=, ?dish=, включая архив"""
+    where, params = [], []
+    if args.get('from'):
+        where.append("o.createdAt >= ?")
+        params.append(args['from'])
+    if args.get('to'):
+        where.append("o.createdAt < ?")
+        params.append(args['to'] + '\uffff')
+    if args.get('school'):
+        where.append("u.school = ?")
+        params.append(args['school'])
+    if args.get('status'):
+        where.append("o.status = ?")
+        params.append(args['status'])
+    if args.get('dish'):
+        where.append("o.name = ?")
+        params.append(args['dish'])
+    where_sql = " WHERE " + " AND ".join(where) if where else ""
+    # Архивы за период (archive.py) от старых к новым, затем рабочая база
+    for schema in history(db, args.get('from'), args.get('to'), chronological=True):
+        cursor = db.execute(f'''
+            SELECT substr(o.createdAt, 1, 10), o.user, u.grade, u.school, o.name, o.price, o.status, o.issuedAt
+            FROM {schema}.orders o LEFT JOIN main.users u ON u.username = o.user{where_sql}
+            ORDER BY o.id''', params)
+        try:
+            yield from _iter_cursor(cursor)
+        finally:
+            # Архив отключается только без открытых курсоров
+            cursor.close()
+
+
+def purchase_rows(db, args):
+    """Заявки на закупку с фильтром ?status="""
+    if args.get('status'):
+        cursor = db.execute("SELECT id, item, qty, price, status FROM purchases WHERE status = ? ORDER BY id",
+                            (args['status'],))
+    else:
+        cursor = db.execute("SELECT id, item, qty, price, status FROM purchases ORDER BY id")
+    return _iter_cursor(cursor)
+
+
+EXPORTS = {
+    'orders': (ORDER_COLUMNS, order_rows),
+    'purchases': (PURCHASE_COLUMNS, purchase_rows),
+}
+
+
+def _iter_cursor(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        for r in rows:
+            yield tuple(r)
+
+
+def stream_csv(header, rows):
+    """CSV с разделителем «;» и BOM — так его правильно открывает Excel"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=';', lineterminator='\n')
+    buf.write('\ufeff')
+    writer.writerow(header)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(['' if v is None else v for v in row])
+        if i % FETCH_SIZE == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+class _Pipe:
+    """Файлоподобный приёмник для zipfile: копит байты, пока их не заберёт генератор"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+_XLSX_STATIC = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Отчёт" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+# Управляющие символы недопустимы в XML
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_row(values):
+    cells = []
+    for v in values:
+        if v is None:
+            cells.append('<c/>')
+        elif isinstance(v, (int, float)):
+            cells.append(f'<c><v>{v}</v></c>')
+        else:
+            text = escape(_XML_INVALID.sub('', str(v)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def stream_xlsx(header, rows):
+    """XLSX с одним листом; строки пишутся и отдаются по мере чтения"""
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, content in _XLSX_STATIC.items():
+            zf.writestr(name, content)
+        yield pipe.drain()
+
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         '<sheetData>' + _xlsx_row(header)).encode('utf-8'))
+            for i, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                if i % FETCH_SIZE == 0:
+                    yield pipe.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield pipe.drain()
+
+
+FORMATS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
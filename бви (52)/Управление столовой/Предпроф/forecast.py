@@ -0,0 +1,214 @@
+"""Прогноз спроса и предложения закупок — пакетный расчёт на NumPy.
+
+Запускается отдельно от сервера (cron, вручную) и пишет результат в таблицы
+planning.py, которые читает кабинет повара. В запросах ничего не считается.
+
+История спроса — дневные агрегаты stats_dish_daily (stats.py): число заказов
+по дню, школе и блюду. Они есть за всё время, даже когда сами заказы уже
+перенесены в архив, и их строк — дни × школы × блюда, а не число заказов.
+
+    1. Строки агрегатов → массивы; дни выравниваются по понедельнику и
+       раскладываются в куб блюда × недели × дни недели одним np.bincount.
+    2. Рабочий день — день, в который был хоть один заказ: выходные и
+       каникулы не тянут прогноз к нулю.
+    3. Прогноз на день недели — среднее по рабочим дням с весом, который
+       падает вдвое каждые FORECAST_HALF_LIFE_WEEKS недель. Рекомендуемые
+       порции — ceil(среднее + FORECAST_SAFETY × стандартное отклонение).
+    4. Расход ингредиентов — порции на горизонт × матрица рецептур
+       (блюда × ингредиенты); недостача против склада — предложение закупки.
+
+Блюдо истории сопоставляется с меню по имени (как в агрегатах), блюда без
+истории не прогнозируются.
+
+    FORECAST_HORIZON_DAYS     на сколько дней вперёд считать (7)
+    FORECAST_HALF_LIFE_WEEKS  за сколько недель вес истории падает вдвое (4)
+    FORECAST_SAFETY           запас в стандартных отклонениях (1.0)
+
+Вручную или из cron: python forecast.py [--start YYYY-MM-DD] [--days N]
+"""
+import argparse
+import os
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from db import DB_NAME, connect
+from logs import get_logger
+
+FORECAST_HORIZON_DAYS = int(os.environ.get('FORECAST_HORIZON_DAYS', 7))
+FORECAST_HALF_LIFE_WEEKS = float(os.environ.get('FORECAST_HALF_LIFE_WEEKS', 4))
+FORECAST_SAFETY = float(os.environ.get('FORECAST_SAFETY', 1.0))
+
+
+def _rows(db, query, params=()):
+    cursor = db.cursor()
+    cursor.row_factory = None
+    return cursor.execute(query, params).fetchall()
+
+
+def _day_numbers(days):
+    """ISO-даты → номера дней от 1970-01-01; каждая дата разбирается один раз"""
+    unique, inverse = np.unique(np.asarray(days), return_inverse=True)
+    return unique.astype('datetime64[D]').astype(np.int64)[inverse]
+
+
+def _weekday(day_numbers):
+    """Понедельник — 0 (1970-01-01 — четверг)"""
+    return (day_numbers + 3) % 7
+
+
+def load_history(db, before):
+    """Агрегаты до дня before: (номера дней, имена блюд, число заказов) или None, если истории нет"""
+    rows = _rows(db, """SELECT day, dish, ordersCount FROM stats_dish_daily
+        WHERE day < ? AND dish IS NOT NULL AND ordersCount > 0""", (before,))
+    if not rows:
+        return None
+    days, dishes, counts = zip(*rows)
+    return _day_numbers(days), np.asarray(dishes, dtype=object), np.asarray(counts, dtype=np.float64)
+
+
+def demand_cube(day_numbers, dish_index, counts, n_dishes):
+    """Спрос блюда × недели × дни недели и рабочие дни недели × дни недели.
+
+    dish_index = -1 — блюда нет в меню: в куб не входит, но день делает рабочим.
+    Возвращает (куб, рабочие дни, номер первого понедельника).
+    """
+    first = int(day_numbers.min())
+    first -= _weekday(first)
+    offset = day_numbers - first
+    n_weeks = int(offset.max()) // 7 + 1
+    cells = n_weeks * 7
+    open_days = np.bincount(offset, weights=counts, minlength=cells).reshape(n_weeks, 7) > 0
+    known = dish_index >= 0
+    cube = np.bincount(dish_index[known] * cells + offset[known], weights=counts[known],
+                       minlength=n_dishes * cells).reshape(n_dishes, n_weeks, 7)
+    return cube, open_days, first
+
+
+def weekday_forecast(cube, open_days, half_life=FORECAST_HALF_LIFE_WEEKS, safety=FORECAST_SAFETY):
+    """Взвешенные среднее и рекомендуемые порции по блюдам и дням недели, плюс открытые дни недели"""
+    n_weeks = cube.shape[1]
+    age = np.arange(n_weeks - 1, -1, -1, dtype=np.float64)
+    weights = np.where(open_days, (0.5 ** (age / half_life))[:, None], 0.0)
+    total = weights.sum(axis=0)
+    norm = np.where(total > 0, total, 1.0)
+    mean = (cube * weights).sum(axis=1) / norm
+    var = (weights * (cube - mean[:, None, :]) ** 2).sum(axis=1) / norm
+    # Погрешность float не должна добавлять лишнюю порцию к целому спросу
+    suggested = np.ceil(mean + safety * np.sqrt(var) - 1e-9).astype(np.int64)
+    return mean, suggested, total > 0
+
+
+def recipe_matrix(recipe_rows, dish_pos, ingredient_pos):
+    """Рецептуры [(dishId, ingredientId, qty)] → матрица блюда × ингредиенты"""
+    bom = np.zeros((len(dish_pos), len(ingredient_pos)))
+    lines = [(dish_pos[d], ingredient_pos[i], q) for d, i, q in recipe_rows if d in dish_pos and i in ingredient_pos]
+    if lines:
+        rows, cols, qty = (np.asarray(x) for x in zip(*lines))
+        bom[rows, cols] = qty
+    return bom
+
+
+def compute(db, start, days=FORECAST_HORIZON_DAYS):
+    """Прогноз на days дней с start. Возвращает (порции [(день, dishId, ожидание, порции)],
+    закупки [(ingredientId, потребность, остаток, докупить)], дней истории)"""
+    menu = _rows(db, "SELECT id, name FROM menu ORDER BY id")
+    ingredients = _rows(db, "SELECT id, COALESCE(amount, 0) FROM ingredients ORDER BY id")
+    history = load_history(db, start.isoformat())
+    if history is None or not menu:
+        return [], [], 0
+
+    # Одно имя в меню могло появиться дважды — как и агрегаты, берём последнее блюдо
+    dish_ids = np.asarray([r[0] for r in menu])
+    by_name = {name: pos for pos, (_, name) in enumerate(menu)}
+    day_numbers, dishes, counts = history
+    names, inverse = np.unique(dishes, return_inverse=True)
+    dish_index = np.asarray([by_name.get(n, -1) for n in names], dtype=np.int64)[inverse]
+
+    cube, open_days, _ = demand_cube(day_numbers, dish_index, counts, len(menu))
+    mean, suggested, open_weekdays = weekday_forecast(cube, open_days)
+
+    horizon = np.arange(days) + np.datetime64(start, 'D').astype(np.int64)
+    weekdays = _weekday(horizon)
+    open_horizon = open_weekdays[weekdays]
+    horizon, weekdays = horizon[open_horizon], weekdays[open_horizon]
+    planned = suggested[:, weekdays]  # блюда × рабочие дни горизонта
+
+    dish_pos, day_pos = np.nonzero(planned)
+    day_iso = horizon.astype('datetime64[D]').astype(str)
+    portions = list(zip(day_iso[day_pos].tolist(), dish_ids[dish_pos].tolist(),
+                        np.round(mean[dish_pos, weekdays[day_pos]], 2).tolist(),
+                        planned[dish_pos, day_pos].tolist()))
+
+    purchases = []
+    if ingredients:
+        ingredient_ids = np.asarray([r[0] for r in ingredients])
+        stock = np.asarray([r[1] for r in ingredients], dtype=np.float64)
+        bom = recipe_matrix(_rows(db, "SELECT dishId, ingredientId, qty FROM recipes"),
+                            {d: p for p, d in enumerate(dish_ids.tolist())},
+                            {i: p for p, i in enumerate(ingredient_ids.tolist())})
+        need = bom.T @ planned.sum(axis=1)
+        shortfall = np.ceil(np.round((need - np.maximum(stock, 0)) * 100, 6)) / 100
+        short = np.nonzero((need > 0) & (shortfall > 0))[0]
+        purchases = list(zip(ingredient_ids[short].tolist(), np.round(need[short], 3).tolist(),
+                             stock[short].tolist(), shortfall[short].tolist()))
+    return portions, purchases, int(open_days.sum())
+
+
+def save(db, start, days, portions, purchases, history_days, seconds):
+    """Заменяет прошлый расчёт одной транзакцией"""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM forecast_portions")
+        db.executemany("INSERT INTO forecast_portions (day, dishId, expected, suggested) VALUES (?,?,?,?)",
+                       portions)
+        db.execute("DELETE FROM purchase_suggestions")
+        db.executemany("INSERT INTO purchase_suggestions (ingredientId, need, stock, qty) VALUES (?,?,?,?)",
+                       purchases)
+        db.execute("INSERT INTO forecast_runs (computedAt, fromDay, toDay, historyDays, seconds) VALUES (?,?,?,?,?)",
+                   (datetime.now().isoformat(), start.isoformat(), (start + timedelta(days=days - 1)).isoformat(),
+                    history_days, round(seconds, 3)))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def run_forecast(db, start=None, days=FORECAST_HORIZON_DAYS):
+    """Считает и сохраняет прогноз. Возвращает {"portions", "purchases", "historyDays", "seconds"}"""
+    start = start or date.today()
+    started = time.perf_counter()
+    portions, purchases, history_days = compute(db, start, days)
+    seconds = time.perf_counter() - started
+    save(db, start, days, portions, purchases, history_days, seconds)
+    get_logger('FORECAST').info("Прогноз посчитан", start=start.isoformat(), days=days, portions=len(portions),
+                                purchases=len(purchases), historyDays=history_days, seconds=round(seconds, 3))
+    return {"portions": len(portions), "purchases": len(purchases), "historyDays": history_days,
+            "seconds": round(seconds, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогноз спроса по блюдам и предложения закупок")
+    parser.add_argument('--db', default=DB_NAME, help=f"рабочая база ({DB_NAME})")
+    parser.add_argument('--start', type=date.fromisoformat, default=date.today(),
+                        help="первый день прогноза (сегодня)")
+    parser.add_argument('--days', type=int, default=FORECAST_HORIZON_DAYS, help="дней вперёд")
+    args = parser.parse_args()
+
+    from migrations import migrate
+
+    db = connect(args.db)
+    try:
+        migrate(db)
+        result = run_forecast(db, args.start, args.days)
+        print(f"✅ Прогноз: {result}")
+        for r in db.execute('''SELECT i.name, i.unit, s.need, s.stock, s.qty FROM purchase_suggestions s
+                JOIN ingredients i ON i.id = s.ingredientId ORDER BY i.name''').fetchall():
+            print(f"   {r['name']}: нужно {r['need']} {r['unit']}, на складе {r['stock']}, докупить {r['qty']}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Входящие уведомления: личные и ролевые, курсор прочтения и срок хранения.
+
+Раньше все уведомления уходили клиентам через /api/sync целиком и навсегда,
+а каждое объявление для роли получал каждый клиент. Теперь у уведомления
+есть id, и адресат у него один — пользователь (toUser) или роль (toRole).
+Объявление для роли хранится одной строкой и подмешивается во входящие
+каждого её участника при чтении (fan-out on read): на «Новое блюдо» для
+тысячи учеников — одна запись, а не тысяча.
+
+Прочитанность — курсор на пользователя (notification_reads.lastReadId): всё,
+что с id не больше курсора, прочитано. Непрочитанные считаются двумя
+проходами по индексам (toUser, id) и (toRole, id) от курсора.
+
+    NOTIFICATION_TTL_DAYS  сколько дней хранить уведомления (60)
+"""
+import os
+from datetime import datetime, timedelta
+
+from events import publish
+
+NOTIFICATION_TTL_DAYS = int(os.environ.get('NOTIFICATION_TTL_DAYS', 60))
+
+# Больше этого непрочитанные не пересчитываются: бейджу достаточно «99+»
+UNREAD_LIMIT = 100
+
+
+def install_inbox(db):
+    """Пересобирает notifications с id и createdAt, создаёт курсоры прочтения"""
+    db.execute('''CREATE TABLE notifications_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        text TEXT,
+        type TEXT,
+        toUser TEXT,
+        toRole TEXT,
+        time TEXT,
+        createdAt TEXT)''')
+    # Старые строки сохраняют порядок (id = rowid); даты у них не было — считаем созданными сейчас
+    db.execute('''INSERT INTO notifications_new (id, title, text, type, toUser, toRole, time, createdAt)
+        SELECT rowid, title, text, type, toUser, CASE WHEN toUser IS NULL THEN toRole END, time, ?
+        FROM notifications''', (datetime.now().isoformat(),))
+    db.execute("DROP TABLE notifications")
+    db.execute("ALTER TABLE notifications_new RENAME TO notifications")
+    db.execute("CREATE INDEX idx_notifications_user_id ON notifications (toUser, id)")
+    db.execute("CREATE INDEX idx_notifications_role_id ON notifications (toRole, id)")
+    db.execute("CREATE INDEX idx_notifications_created ON notifications (createdAt)")
+
+    db.execute('''CREATE TABLE IF NOT EXISTS notification_reads (
+        username TEXT PRIMARY KEY,
+        lastReadId INTEGER NOT NULL DEFAULT 0,
+        readAt TEXT)''')
+    # Уведомления больше не синхронизируются через /api/sync
+    db.execute("DELETE FROM change_log WHERE tbl = 'notifications'")
+
+
+def notify(db, title, text, to_user=None, to_role=None, time=None):
+    """Добавляет уведомление пользователю или роли и будит их клиентов событием notification"""
+    now = datetime.now()
+    cursor = db.execute(
+        "INSERT INTO notifications (title, text, toUser, toRole, time, createdAt) VALUES (?,?,?,?,?,?)",
+        (title, text, to_user, None if to_user else to_role, time or now.strftime("%H:%M"),
+         now.isoformat()))
+    publish(db, 'notification', {"id": cursor.lastrowid}, to_user=to_user, to_role=None if to_user else to_role)
+    return cursor.lastrowid
+
+
+def last_read_id(db, username):
+    row = db.execute("SELECT lastReadId FROM notification_reads WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else 0
+
+
+def inbox_page(db, username, role, before=None, limit=50):
+    """Страница входящих от новых к старым: {"items", "next", "lastReadId"}.
+
+    Личные и ролевые уведомления выбираются отдельными проходами по своим
+    индексам и сливаются по id — без OR, который мешает SQLite взять индекс.
+    """
+    page, key = (" AND id < ?", [before]) if before is not None else ("", [])
+    branch = "SELECT * FROM notifications WHERE {} = ?" + page + " ORDER BY id DESC LIMIT ?"
+    rows = db.execute(
+        f"SELECT * FROM ({branch.format('toUser')}) UNION ALL SELECT * FROM ({branch.format('toRole')}) "
+        f"ORDER BY id DESC LIMIT ?", [username, *key, limit + 1, role, *key, limit + 1, limit + 1]).fetchall()
+
+    read_upto = last_read_id(db, username)
+    items = [dict(r, read=r['id'] <= read_upto) for r in rows[:limit]]
+    return {"items": items, "next": items[-1]['id'] if len(rows) > limit else None, "lastReadId": read_upto}
+
+
+def unread_count(db, username, role, limit=UNREAD_LIMIT):
+    """Число непрочитанных (не больше limit) и id последнего уведомления во входящих"""
+    read_upto = last_read_id(db, username)
+    row = db.execute('''SELECT
+        (SELECT COUNT(*) FROM (SELECT 1 FROM notifications WHERE toUser = ? AND id > ? LIMIT ?)),
+        (SELECT COUNT(*) FROM (SELECT 1 FROM notifications WHERE toRole = ? AND id > ? LIMIT ?)),
+        (SELECT MAX(id) FROM notifications WHERE toUser = ?),
+        (SELECT MAX(id) FROM notifications WHERE toRole = ?)''',
+                     (username, read_upto, limit, role, read_upto, limit, username, role)).fetchone()
+    return {"unread": min(row[0] + row[1], limit), "limit": limit, "lastReadId": read_upto,
+            "latestId": max(row[2] or 0, row[3] or 0)}
+
+
+def mark_read(db, username, upto=None):
+    """Сдвигает курсор прочтения до upto (по умолчанию — до последнего уведомления). Назад не двигается"""
+    latest = db.execute("SELECT COALESCE(MAX(id), 0) FROM notifications").fetchone()[0]
+    upto = latest if upto is None else min(int(upto), latest)
+    row = db.execute('''INSERT INTO notification_reads (username, lastReadId, readAt) VALUES (?,?,?)
+        ON CONFLICT (username) DO UPDATE SET lastReadId = MAX(lastReadId, excluded.lastReadId),
+                                             readAt = excluded.readAt
+        RETURNING lastReadId''', (username, upto, datetime.now().isoformat())).fetchone()
+    return row[0]
+
+
+def prune_notifications(db, ttl_days=NOTIFICATION_TTL_DAYS):
+    """Удаляет уведомления старше ttl_days и курсоры удалённых пользователей. Возвращает число удалённых"""
+    cutoff = (datetime.now() - timedelta(days=ttl_days)).isoformat()
+    deleted = db.execute("DELETE FROM notifications WHERE createdAt < ?", (cutoff,)).rowcount
+    db.execute("DELETE FROM notification_reads WHERE username NOT IN (SELECT username FROM users)")
+    return deleted
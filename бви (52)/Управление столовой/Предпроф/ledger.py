@@ -0,0 +1,234 @@
+"""Журнал денежных операций: только добавление, суммы в копейках.
+
+Раньше users.balance — REAL в рублях — менялся на месте покупкой,
+абонементом и пополнением: сверить его было не с чем, а ошибка округления
+float копилась. Теперь каждое списание и зачисление — строка ledger
+(amount в копейках, минус — списание) с видом операции и ссылкой на заказ
+или покупку абонемента. Менять и удалять строки журнала запрещено
+триггерами.
+
+Баланс — последний снимок пользователя (balance_snapshots: сумма его строк
+до ledgerId включительно) плюс хвост строк после снимка по индексу
+(user, id, amount). Снимки всех пользователей обновляются одним запросом
+раз в PRUNE_EVERY действий и при старте, поэтому хвост короткий.
+
+    opening       начальный баланс (старый users.balance, новые пользователи)
+    refill        пополнение
+    order         покупка блюда (ref — id заказа)
+    subscription  покупка абонемента (ref — rowid sub_transactions)
+
+Списание — один INSERT ... SELECT с проверкой баланса внутри транзакции
+записи: проверка и запись неразделимы. Сумма списания и зачисления не может
+быть отрицательной, иначе списание превратилось бы в зачисление.
+users.balance остаётся копией для клиентов (sync, профиль): после каждой
+строки журнала триггер пересчитывает её из целых копеек, а не прибавляет
+к float.
+
+Сверка (reconcile) одним проходом по журналу сравнивает по каждому
+пользователю сумму строк со снимком и с users.balance и ищет отрицательные
+балансы. Вручную или из cron: python ledger.py [--school S] [--fix]
+"""
+import argparse
+import time
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from db import DB_NAME, connect
+from ordering import OrderRejected, INSUFFICIENT_FUNDS, NO_USER, begin_immediate
+
+KINDS = ('opening', 'refill', 'order', 'subscription')
+NEGATIVE_AMOUNT = ('invalid', 'Сумма не может быть отрицательной', 400)
+
+
+def to_kopecks(rubles):
+    """Рубли (число или строка) → целые копейки с округлением до копейки"""
+    return int((Decimal(str(rubles)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _balance_sql(user):
+    """SQL-выражение баланса пользователя в копейках: снимок + хвост журнала после него"""
+    return f'''(COALESCE((SELECT balance FROM balance_snapshots WHERE user = {user}), 0)
+        + COALESCE((SELECT SUM(amount) FROM ledger WHERE user = {user}
+            AND id > COALESCE((SELECT ledgerId FROM balance_snapshots WHERE user = {user}), 0)), 0))'''
+
+
+def install_ledger(db):
+    """Журнал, снимки и триггеры; текущие балансы переносятся строками opening"""
+    db.execute('''CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        ref INTEGER,
+        createdAt TEXT)''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_id ON ledger (user, id, amount)")
+    db.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user TEXT PRIMARY KEY,
+        ledgerId INTEGER NOT NULL,
+        balance INTEGER NOT NULL,
+        takenAt TEXT)''')
+
+    for event in ('UPDATE', 'DELETE'):
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_ledger_no_{event.lower()}
+            BEFORE {event} ON ledger
+            BEGIN
+                SELECT RAISE(ABORT, 'ledger is append-only');
+            END''')
+    # Копия баланса для клиентов — пересчёт из копеек, а не накопление float
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_ledger_balance
+        AFTER INSERT ON ledger
+        BEGIN
+            UPDATE users SET balance = {_balance_sql('NEW.user')} / 100.0 WHERE username = NEW.user;
+        END''')
+    # Пользователь, созданный сразу с деньгами (тестовые аккаунты, генераторы), получает строку opening
+    db.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_opening_balance
+        AFTER INSERT ON users
+        WHEN COALESCE(NEW.balance, 0) != 0
+        BEGIN
+            INSERT INTO ledger (user, amount, kind, createdAt)
+            VALUES (NEW.username, CAST(ROUND(NEW.balance * 100) AS INTEGER), 'opening',
+                    strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'));
+        END''')
+    open_balances(db)
+    snapshot_balances(db)
+
+
+def open_balances(db):
+    """Строки opening для пользователей с деньгами и без журнала. Возвращает их число"""
+    return db.execute('''INSERT INTO ledger (user, amount, kind, createdAt)
+        SELECT username, CAST(ROUND(balance * 100) AS INTEGER), 'opening', ?
+        FROM users
+        WHERE COALESCE(balance, 0) != 0 AND NOT EXISTS (SELECT 1 FROM ledger WHERE ledger.user = users.username)''',
+        (datetime.now().isoformat(),)).rowcount
+
+
+def balance(db, user):
+    """Баланс в копейках: снимок и короткий хвост журнала"""
+    return db.execute(f"SELECT {_balance_sql('?1')}", (user,)).fetchone()[0]
+
+
+def credit(db, user, kopecks, kind, ref, created_at):
+    """Зачисление. Возвращает id строки журнала или бросает OrderRejected(NO_USER или NEGATIVE_AMOUNT)"""
+    if kopecks < 0:
+        raise OrderRejected(*NEGATIVE_AMOUNT)
+    row = db.execute('''INSERT INTO ledger (user, amount, kind, ref, createdAt)
+        SELECT username, ?, ?, ?, ? FROM users WHERE username = ?
+        RETURNING id''', (kopecks, kind, ref, created_at, user)).fetchone()
+    if row is None:
+        raise OrderRejected(*NO_USER)
+    return row[0]
+
+
+def debit(db, user, kopecks, kind, ref, created_at):
+    """Списание, только если хватает денег. Возвращает id строки журнала (None для нулевой суммы).
+
+    Бросает OrderRejected(INSUFFICIENT_FUNDS, NO_USER или NEGATIVE_AMOUNT); транзакция
+    записи открывается здесь, если её ещё нет, и остаётся открытой.
+    """
+    if kopecks < 0:
+        raise OrderRejected(*NEGATIVE_AMOUNT)
+    begin_immediate(db)
+    if kopecks == 0:
+        if not db.execute("SELECT 1 FROM users WHERE username = ?", (user,)).fetchone():
+            raise OrderRejected(*NO_USER)
+        return None
+    row = db.execute(f'''INSERT INTO ledger (user, amount, kind, ref, createdAt)
+        SELECT :user, -:amount, :kind, :ref, :now
+        WHERE EXISTS (SELECT 1 FROM users WHERE username = :user) AND {_balance_sql(':user')} >= :amount
+        RETURNING id''', {"user": user, "amount": kopecks, "kind": kind, "ref": ref, "now": created_at}).fetchone()
+    if row is None:
+        exists = db.execute("SELECT 1 FROM users WHERE username = ?", (user,)).fetchone()
+        raise OrderRejected(*(INSUFFICIENT_FUNDS if exists else NO_USER))
+    return row[0]
+
+
+def snapshot_balances(db):
+    """Сдвигает снимки всех, у кого есть строки новее последнего прохода. Возвращает число снимков.
+
+    После прохода строки до наибольшего ledgerId снимков учтены у всех,
+    поэтому следующий проход читает только строки журнала после него.
+    """
+    mark = db.execute("SELECT COALESCE(MAX(ledgerId), 0) FROM balance_snapshots").fetchone()[0]
+    return db.execute('''INSERT INTO balance_snapshots (user, ledgerId, balance, takenAt)
+        SELECT l.user, MAX(l.id), COALESCE(s.balance, 0) + SUM(l.amount), ?
+        FROM ledger l LEFT JOIN balance_snapshots s ON s.user = l.user
+        WHERE l.id > ?
+        GROUP BY l.user
+        ON CONFLICT (user) DO UPDATE SET
+            ledgerId = excluded.ledgerId, balance = excluded.balance, takenAt = excluded.takenAt''',
+        (datetime.now().isoformat(), mark)).rowcount
+
+
+def reconcile(db, school=None, fix=False):
+    """Сверка журнала со снимками и копией users.balance одним проходом.
+
+    Возвращает {"users", "entries", "total", "mismatches": [...], "fixed", "seconds"};
+    с fix=True пересчитывает расходящиеся снимки и копии из журнала (сам журнал не трогает).
+    """
+    started = time.perf_counter()
+    scope = "WHERE l.user IN (SELECT username FROM users WHERE school = :school)" if school else ""
+    rows = db.execute(f'''SELECT t.user, t.total, t.entries, t.upToSnapshot, t.snapshot, t.snapshotId,
+               CAST(ROUND(u.balance * 100) AS INTEGER) AS mirror, u.username IS NOT NULL AS known
+        FROM (SELECT l.user, SUM(l.amount) AS total, COUNT(*) AS entries,
+                     SUM(CASE WHEN l.id <= COALESCE(s.ledgerId, 0) THEN l.amount ELSE 0 END) AS upToSnapshot,
+                     s.balance AS snapshot, s.ledgerId AS snapshotId
+              FROM ledger l LEFT JOIN balance_snapshots s ON s.user = l.user
+              {scope}
+              GROUP BY l.user) t
+        LEFT JOIN users u ON u.username = t.user''', {"school": school}).fetchall()
+
+    mismatches = []
+    for user, total, entries, up_to_snapshot, snapshot, snapshot_id, mirror, known in rows:
+        if snapshot is not None and snapshot != up_to_snapshot:
+            mismatches.append({"user": user, "problem": "snapshot", "ledger": up_to_snapshot, "snapshot": snapshot,
+                               "ledgerId": snapshot_id})
+        if known and mirror != total:
+            mismatches.append({"user": user, "problem": "mirror", "ledger": total, "mirror": mirror})
+        if total < 0:
+            mismatches.append({"user": user, "problem": "negative", "ledger": total})
+
+    fixed = 0
+    if fix and mismatches:
+        begin_immediate(db)
+        for m in mismatches:
+            if m['problem'] == 'snapshot':
+                fixed += db.execute("UPDATE balance_snapshots SET balance = ? WHERE user = ?",
+                                    (m['ledger'], m['user'])).rowcount
+            elif m['problem'] == 'mirror':
+                fixed += db.execute("UPDATE users SET balance = ? / 100.0 WHERE username = ?",
+                                    (m['ledger'], m['user'])).rowcount
+        db.commit()
+
+    return {"users": len(rows), "entries": sum(r[2] for r in rows), "total": sum(r[1] for r in rows),
+            "mismatches": mismatches, "fixed": fixed, "seconds": round(time.perf_counter() - started, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Снимки балансов и сверка журнала денежных операций")
+    parser.add_argument('--db', default=DB_NAME, help=f"рабочая база ({DB_NAME})")
+    parser.add_argument('--school', help="сверить только учеников школы")
+    parser.add_argument('--fix', action='store_true', help="пересчитать расходящиеся снимки и users.balance")
+    args = parser.parse_args()
+
+    from migrations import migrate
+
+    db = connect(args.db)
+    try:
+        migrate(db)
+        begin_immediate(db)
+        snapshots = snapshot_balances(db)
+        db.commit()
+        result = reconcile(db, args.school, args.fix)
+        print(f"✅ Снимков обновлено: {snapshots}")
+        print(f"✅ Сверка: {result['users']} пользователей, {result['entries']} операций, "
+              f"{result['total'] / 100:.2f}₽ на счетах, {result['seconds']} с")
+        for m in result['mismatches']:
+            print(f"   ❌ {m}")
+        if args.fix:
+            print(f"✅ Исправлено: {result['fixed']}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Структурированное асинхронное логирование по подсистемам.
+
+Раньше обработчики писали в stdout через print() — синхронно (в Docker
+PYTHONUNBUFFERED=1), по несколько строк на каждый sync и action, а в дамп
+запроса попадали данные карты. Теперь запрос только кладёт запись в
+ограниченную очередь, в поток вывода её пишет отдельный поток. Если очередь
+переполнена, запись отбрасывается и учитывается в dropped: запрос никогда
+не ждёт вывода.
+
+    LOG_LEVEL       уровень по умолчанию (INFO)
+    LOG_LEVELS      уровни подсистем: SYNC=WARNING,BUY=DEBUG
+    LOG_FORMAT      text или json (одна JSON-строка на запись)
+    LOG_SAMPLE      доля записей ниже WARNING, которые пишутся, для частых
+                    подсистем (SYNC=0.1); предупреждения и ошибки пишутся всегда
+    LOG_QUEUE_SIZE  ёмкость очереди (10000)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+
+def _parse_map(value, cast):
+    """'SYNC=WARNING,BUY=DEBUG' → {'SYNC': cast('WARNING'), ...}"""
+    result = {}
+    for part in value.split(','):
+        name, _, v = part.partition('=')
+        if name.strip() and v.strip():
+            result[name.strip().upper()] = cast(v.strip())
+    return result
+
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = _parse_map(os.environ.get('LOG_LEVELS', ''), str.upper)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLE = _parse_map(os.environ.get('LOG_SAMPLE', 'SYNC=0.1'), float)
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+ROOT = 'canteen'
+
+# Значения этих полей в лог не попадают
+SECRET_FIELDS = {'password', 'adminKey', 'cardNumber', 'cardHolder', 'cardExpiry', 'cardCVV', 'cvv',
+                 'phone', 'email'}
+
+
+def redact(data):
+    """Копия данных запроса со скрытыми паролями, картой и контактами"""
+    if isinstance(data, dict):
+        return {k: '***' if k in SECRET_FIELDS and v else redact(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [redact(v) for v in data]
+    return data
+
+
+def _subsystem(record):
+    return record.name.rpartition('.')[2]
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 "level": record.levelname, "subsystem": _subsystem(record), "msg": record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = (f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} "
+                f"{record.levelname:<7} [{_subsystem(record)}] {record.getMessage()}")
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """Пропускает долю rate записей ниже WARNING"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в ограниченную очередь и сразу возвращается.
+
+    Поток вывода (QueueListener) запускается лениво и заново после fork:
+    поток родителя в дочернем процессе не существует.
+    """
+
+    def __init__(self, target, size=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(size))
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self._listener = logging.handlers.QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Дописывает оставшиеся записи (при завершении процесса)"""
+        if self._listener and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "capacity": self.queue.maxsize, "dropped": self.dropped}
+
+
+class SubsystemLogger(logging.LoggerAdapter):
+    """log.info("Покупка", user="a", dish="Суп") — именованные аргументы становятся полями записи"""
+
+    _RESERVED = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in self._RESERVED}
+        kwargs['extra'] = dict(kwargs.get('extra') or {}, fields=fields)
+        return msg, kwargs
+
+
+_handler = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging():
+    """Подключает асинхронный обработчик к логгеру canteen (один раз на процесс)"""
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return _handler
+        target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+        _handler = AsyncHandler(target)
+
+        root = logging.getLogger(ROOT)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(_handler)
+        root.propagate = False
+        atexit.register(_handler.stop)
+        return _handler
+
+
+@lru_cache(maxsize=None)
+def get_logger(subsystem):
+    """Логгер подсистемы (BUY, SYNC, ...) с её уровнем и выборкой из окружения"""
+    setup_logging()
+    logger = logging.getLogger(f'{ROOT}.{subsystem}')
+    if subsystem in LOG_LEVELS:
+        logger.setLevel(LOG_LEVELS[subsystem])
+    if subsystem in LOG_SAMPLE:
+        logger.addFilter(SampleFilter(LOG_SAMPLE[subsystem]))
+    return SubsystemLogger(logger, {})
+
+
+def log_stats():
+    return setup_logging().stats()
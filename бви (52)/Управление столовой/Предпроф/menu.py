@@ -0,0 +1,109 @@
+"""Кэш меню в памяти процесса с версией из журнала изменений.
+
+Меню читается на каждом sync, /api/menu, /api/chef/stock и при каждой
+покупке, а меняется редко — добавлением блюда, правкой порций и самими
+покупками. Поэтому строки меню держатся в памяти, а версия кэша — seq
+последнего изменения menu в change_log (триггеры из changes.py). Её
+проверка — один поиск по индексу (tbl, seq), поэтому она делается на каждом
+чтении и одинаково видит записи всех воркеров (canteen.py).
+
+Если версия сдвинулась, перечитываются только строки, изменённые после
+версии кэша, — после покупки это одна строка. Если журнал уже почищен
+дальше версии кэша или версия ушла назад, меню перечитывается целиком.
+Поэтому остатки порций в кэше точные на момент проверки версии.
+
+Внутри открытой транзакции (пакет действий) кэш не читается и не
+обновляется: незафиксированные изменения могут откатиться. Такие чтения идут
+прямо в базу.
+
+Строки из кэша общие для всех потоков — их нельзя изменять на месте. У
+каждой базы (шарда школы, shards.py) своё меню и свой журнал, поэтому
+состояние кэша хранится отдельно по файлу базы.
+"""
+import threading
+
+from changes import changed_keys, cursor_is_valid, select_by_keys, table_version
+from logs import get_logger
+
+
+class MenuCache:
+    def __init__(self):
+        # Файл базы → (версия, {id: строка}, строки по id DESC); заменяется целиком, читается без блокировки
+        self._states = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.reloads = 0
+        self.bypasses = 0
+
+    def _current(self, db):
+        """Актуальное состояние кэша или None, если читать нужно из базы"""
+        if db.in_transaction:
+            self.bypasses += 1
+            return None
+        version = table_version(db, 'menu')
+        key = getattr(db, 'path', None)
+        state = self._states.get(key)
+        if state is not None and state[0] == version:
+            self.hits += 1
+            return state
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or state[0] != version:
+                state = self._states[key] = self._load(db, state, version)
+        return state
+
+    def _load(self, db, state, version):
+        if state is None or version < state[0] or not cursor_is_valid(db, state[0]):
+            rows = {r['id']: dict(r) for r in db.execute("SELECT * FROM menu").fetchall()}
+            self.reloads += 1
+            get_logger('MENU').debug("Меню загружено в кэш", version=version, dishes=len(rows))
+        else:
+            rows = dict(state[1])
+            keys, deleted = changed_keys(db, 'menu', state[0], version)
+            for key in deleted:
+                rows.pop(key, None)
+            fresh = {r['id']: dict(r) for r in select_by_keys(db, 'menu', 'id', keys)}
+            for key in keys:
+                # Строку могли удалить уже после version — удаление подхватит следующая проверка
+                if key in fresh:
+                    rows[key] = fresh[key]
+                else:
+                    rows.pop(key, None)
+            self.refreshes += 1
+        return version, rows, sorted(rows.values(), key=lambda r: r['id'], reverse=True)
+
+    def refresh(self, db):
+        """Подтягивает изменения меню сразу после коммита, чтобы следующее чтение обошлось без базы"""
+        self._current(db)
+
+    def all(self, db):
+        """Все блюда от новых к старым"""
+        state = self._current(db)
+        if state is None:
+            return [dict(r) for r in db.execute("SELECT * FROM menu ORDER BY id DESC").fetchall()]
+        return state[2]
+
+    def get(self, db, dish_id):
+        """Блюдо по id или None"""
+        state = self._current(db)
+        if state is None:
+            row = db.execute("SELECT * FROM menu WHERE id = ?", (dish_id,)).fetchone()
+            return dict(row) if row else None
+        try:
+            return state[1].get(int(dish_id))
+        except (TypeError, ValueError):
+            return None
+
+    def stats(self):
+        states = list(self._states.values())
+        return {"version": states[0][0] if len(states) == 1 else None, "size": sum(len(s[1]) for s in states),
+                "databases": len(states), "hits": self.hits, "refreshes": self.refreshes, "reloads": self.reloads,
+                "bypasses": self.bypasses}
+
+
+menu_cache = MenuCache()
+
+
+def menu_cache_stats():
+    return menu_cache.stats()
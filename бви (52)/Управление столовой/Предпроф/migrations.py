@@ -0,0 +1,237 @@
+"""Версионные миграции схемы.
+
+Применённые версии записываются в schema_migrations. Каждая миграция
+выполняется в своей транзакции BEGIN IMMEDIATE, поэтому несколько процессов,
+стартующих одновременно, не применят её дважды, а на рабочей базе запись
+блокируется только на время одной миграции.
+
+Новая миграция — новая функция в конце MIGRATIONS. Уже выпущенные миграции
+не меняются.
+"""
+from datetime import datetime
+
+from allergens import install_allergens
+from archive import install_archive
+from changes import install_change_log, track_changes
+from events import install_events
+from inbox import install_inbox
+from ledger import install_ledger
+from logs import get_logger
+from planning import install_planning
+from stats import install_rollups, backfill_rollups
+from subscriptions import install_entitlements
+
+
+def _columns(db, table):
+    return [r[1] for r in db.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _add_column(db, table, column, ddl):
+    if column not in _columns(db, table):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def m001_base_schema(db):
+    """Базовые таблицы (для старых баз — досоздаёт недостающие столбцы)"""
+    db.execute('''CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT,
+        fullName TEXT,
+        role TEXT,
+        school TEXT,
+        grade TEXT,
+        phone TEXT,
+        email TEXT,
+        balance REAL DEFAULT 0,
+        allergies TEXT DEFAULT '',
+        isApproved INTEGER DEFAULT 1,
+        cardNumber TEXT DEFAULT '',
+        cardHolder TEXT DEFAULT '',
+        cardExpiry TEXT DEFAULT '')''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS menu (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        price REAL,
+        portions INTEGER,
+        type TEXT,
+        ingredients TEXT DEFAULT '',
+        category TEXT DEFAULT 'Обед',
+        addedDate TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT,
+        name TEXT,
+        price REAL,
+        status TEXT,
+        allergies TEXT,
+        issuedAt TEXT,
+        createdAt TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS ingredients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        amount REAL,
+        unit TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS reviews (
+        dish TEXT,
+        text TEXT,
+        author TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item TEXT,
+        qty TEXT,
+        price REAL DEFAULT 0,
+        status TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS notifications (
+        title TEXT,
+        text TEXT,
+        type TEXT,
+        toUser TEXT,
+        toRole TEXT,
+        time TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS sub_transactions (
+        user TEXT,
+        type TEXT,
+        amount REAL,
+        time TEXT)''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS subscription_usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT,
+        subType TEXT,
+        date TEXT,
+        dishesUsed TEXT,
+        createdAt TEXT)''')
+
+    # Столбцы, появившиеся в старых версиях без миграций
+    _add_column(db, 'menu', 'ingredients', "TEXT DEFAULT ''")
+    _add_column(db, 'menu', 'category', "TEXT DEFAULT 'Обед'")
+    _add_column(db, 'purchases', 'price', "REAL DEFAULT 0")
+    _add_column(db, 'users', 'cardNumber', "TEXT DEFAULT ''")
+    _add_column(db, 'users', 'cardHolder', "TEXT DEFAULT ''")
+    _add_column(db, 'users', 'cardExpiry', "TEXT DEFAULT ''")
+
+
+def m002_change_log(db):
+    """Журнал изменений для /api/sync?since="""
+    install_change_log(db)
+
+
+def m003_events(db):
+    """Таблица событий для /api/events"""
+    install_events(db)
+
+
+def m004_hot_query_indexes(db):
+    """Индексы под горячие запросы"""
+    # use_subscription: проверка «уже брал сегодня»
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sub_usage_user_type_date ON subscription_usage (user, subType, date)")
+    # use_subscription: проверка наличия абонемента
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sub_tx_user_type ON sub_transactions (user, type)")
+    # /api/me/orders и очередь повара /api/chef/queue
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user, id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_id ON orders (status, id)")
+    # Отчёты за период
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (createdAt)")
+    # Уведомления пользователю и роли
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications (toUser)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_role ON notifications (toRole)")
+    # Фильтры админа
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_role_school ON users (role, school)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status_id ON purchases (status, id)")
+
+
+def m005_stats_rollups(db):
+    """Дневные агрегаты для /api/stats, заполненные по имеющейся истории"""
+    install_rollups(db)
+    backfill_rollups(db)
+
+
+def m006_notification_inbox(db):
+    """Уведомления с id и датой, курсоры прочтения; из /api/sync уведомления убраны"""
+    install_inbox(db)
+
+
+def m007_archive(db):
+    """Реестр архивных файлов для переноса старой истории (archive.py)"""
+    install_archive(db)
+
+
+def m008_entitlements(db):
+    """Права по абонементам (срок и остаток обедов) с синхронизацией через журнал изменений"""
+    install_entitlements(db)
+    track_changes(db, 'entitlements', 'rowid')
+
+
+def m009_allergen_index(db):
+    """Индекс аллергенов блюд и профилей учеников для /api/menu/safe"""
+    install_allergens(db)
+
+
+def m010_planning(db):
+    """Рецептуры блюд и таблицы прогноза спроса и закупок (forecast.py)"""
+    install_planning(db)
+
+
+def m011_ledger(db):
+    """Журнал денежных операций в копейках со снимками балансов; текущие балансы — строками opening"""
+    install_ledger(db)
+
+
+MIGRATIONS = [
+    (1, 'base_schema', m001_base_schema),
+    (2, 'change_log', m002_change_log),
+    (3, 'events', m003_events),
+    (4, 'hot_query_indexes', m004_hot_query_indexes),
+    (5, 'stats_rollups', m005_stats_rollups),
+    (6, 'notification_inbox', m006_notification_inbox),
+    (7, 'archive', m007_archive),
+    (8, 'entitlements', m008_entitlements),
+    (9, 'allergen_index', m009_allergen_index),
+    (10, 'planning', m010_planning),
+    (11, 'ledger', m011_ledger),
+]
+
+
+def migrate(db, log=None):
+    """Применяет все неприменённые миграции. Возвращает список применённых версий"""
+    log = log or get_logger('MIGRATION').info
+    db.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        appliedAt TEXT)''')
+    db.commit()
+
+    done = {r[0] for r in db.execute("SELECT version FROM schema_migrations").fetchall()}
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if version in done:
+            continue
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Проверяем внутри транзакции: другой процесс мог успеть раньше
+            if db.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                db.rollback()
+                continue
+            log(f"Применяем {version:03d}_{name}...")
+            migration(db)
+            db.execute("INSERT INTO schema_migrations (version, name, appliedAt) VALUES (?,?,?)",
+                       (version, name, datetime.now().isoformat()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+        log(f"✅ {version:03d}_{name} применена")
+    return applied
+
+
+def schema_version(db):
+    row = db.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
@@ -0,0 +1,101 @@
+"""Покупка блюда без перепродажи порций и ухода баланса в минус.
+
+Раньше buy читал баланс и порции, сравнивал их в Python и отдельно писал
+UPDATE: два ученика, пришедших за последней порцией одновременно, оба
+проходили проверку. Теперь списание — условные UPDATE (portions > 0,
+balance >= цена) внутри BEGIN IMMEDIATE: запись сразу берёт блокировку
+писателя, поэтому проверка и изменение неразделимы, а читатели в WAL при
+этом не ждут. Деньги списываются строкой журнала ledger.py со ссылкой на
+заказ. Если блокировку не удалось получить за busy_timeout,
+попытка повторяется ограниченное число раз с небольшой случайной паузой.
+
+    ORDER_RETRIES    сколько раз повторять при занятой базе (3)
+    ORDER_BACKOFF    базовая пауза между повторами, сек (0.02)
+"""
+import os
+import random
+import sqlite3
+import time
+
+ORDER_RETRIES = int(os.environ.get('ORDER_RETRIES', 3))
+ORDER_BACKOFF = float(os.environ.get('ORDER_BACKOFF', 0.02))
+
+PAID = 'Оплачено'
+
+
+class OrderRejected(Exception):
+    """Покупка невозможна. code — машинная причина, status — HTTP-код ответа"""
+
+    def __init__(self, code, message, status=409):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+SOLD_OUT = ('sold_out', 'Порции закончились', 409)
+INSUFFICIENT_FUNDS = ('insufficient_funds', 'Недостаточно средств', 402)
+NO_DISH = ('no_dish', 'Блюдо не найдено', 404)
+NO_USER = ('no_user', 'Пользователь не найден', 404)
+BUSY = ('busy', 'Слишком много покупок одновременно, попробуйте ещё раз', 503)
+
+
+def _is_busy(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+
+def begin_immediate(db):
+    """BEGIN IMMEDIATE с ограниченным повтором, пока база занята другим писателем.
+
+    Если транзакция уже открыта (пакет действий), ничего не делает.
+    """
+    if db.in_transaction:
+        return
+    for attempt in range(ORDER_RETRIES + 1):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == ORDER_RETRIES:
+                if _is_busy(e):
+                    raise OrderRejected(*BUSY)
+                raise
+            time.sleep(ORDER_BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+
+
+def reserve_portion(db, menu_id):
+    """Условно списывает одну порцию. Возвращает (name, price, остаток) или None, если порций нет"""
+    return db.execute("UPDATE menu SET portions = portions - 1 WHERE id = ? AND portions > 0 "
+                      "RETURNING name, price, portions", (menu_id,)).fetchone()
+
+
+def place_order(db, user, menu_id, allergies, created_at):
+    """Списывает порцию и деньги и создаёт заказ в одной транзакции записи.
+
+    Транзакция остаётся открытой — её фиксирует вызывающий код вместе с
+    уведомлениями. Возвращает (id заказа, name, price, остаток порций),
+    при отказе откатывает изменения этой покупки и бросает OrderRejected.
+    """
+    from ledger import debit, to_kopecks  # ledger.py сам зависит от этого модуля
+
+    begin_immediate(db)
+    # Точка сохранения: при отказе откатываем только эту покупку, а не весь пакет действий
+    db.execute("SAVEPOINT place_order")
+    try:
+        dish = reserve_portion(db, menu_id)
+        if dish is None:
+            exists = db.execute("SELECT 1 FROM menu WHERE id = ?", (menu_id,)).fetchone()
+            raise OrderRejected(*(SOLD_OUT if exists else NO_DISH))
+
+        name, price, portions_left = dish
+        price = price or 0
+        # Сначала заказ, чтобы строка журнала ссылалась на него; при отказе оба откатываются
+        order_id = db.execute("INSERT INTO orders (user, name, price, status, allergies, createdAt) "
+                              "VALUES (?,?,?,?,?,?)", (user, name, price, PAID, allergies, created_at)).lastrowid
+        debit(db, user, to_kopecks(price), 'order', order_id, created_at)
+    except BaseException:
+        db.execute("ROLLBACK TO place_order")
+        db.execute("RELEASE place_order")
+        raise
+    db.execute("RELEASE place_order")
+    return order_id, name, price, portions_left
@@ -0,0 +1,103 @@
+"""Хэширование паролей в ограниченном пуле воркеров.
+
+scrypt специально дорогой по CPU и памяти. Чтобы класс, входящий разом, не
+занимал все потоки сервера, хэши считаются в пуле фиксированного размера,
+а при переполнении очереди запрос сразу получает отказ (HashPoolBusy),
+вместо того чтобы копиться. Не дождавшийся результата за PASSWORD_HASH_TIMEOUT
+запрос тоже получает HashPoolBusy; место в очереди освобождается, только
+когда задача действительно завершилась.
+
+    PASSWORD_HASH_METHOD   метод и стоимость для новых хэшей werkzeug
+                           (scrypt:32768:8:1 по умолчанию; pbkdf2:sha256:600000 и т.п.)
+    PASSWORD_HASH_POOL     thread (по умолчанию: hashlib отпускает GIL на время scrypt/pbkdf2)
+                           или process
+    PASSWORD_HASH_WORKERS  размер пула (число CPU)
+    PASSWORD_HASH_QUEUE    максимум задач в работе и в очереди (64)
+    PASSWORD_HASH_TIMEOUT  сколько ждать результат, сек (30)
+
+Проверка старых хэшей не зависит от PASSWORD_HASH_METHOD: метод записан в самом хэше.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+PASSWORD_HASH_POOL = os.environ.get('PASSWORD_HASH_POOL', 'thread')
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 64))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 30))
+
+
+class HashPoolBusy(Exception):
+    """Очередь хэширования переполнена — клиенту стоит повторить попытку позже"""
+
+
+class HashPool:
+    def __init__(self, kind=PASSWORD_HASH_POOL, workers=PASSWORD_HASH_WORKERS, limit=PASSWORD_HASH_QUEUE):
+        self.kind = kind
+        self.workers = workers
+        self.limit = limit
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._stats = {"submitted": 0, "rejected": 0, "timeouts": 0, "max_inflight": 0}
+
+    def _get_executor(self):
+        # После fork пул родителя непригоден — создаём свой
+        if self._executor is None or self._pid != os.getpid():
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pwhash')
+            self._pid = os.getpid()
+        return self._executor
+
+    def run(self, fn, *args):
+        with self._lock:
+            if self._inflight >= self.limit:
+                self._stats['rejected'] += 1
+                raise HashPoolBusy()
+            self._inflight += 1
+            self._stats['submitted'] += 1
+            self._stats['max_inflight'] = max(self._stats['max_inflight'], self._inflight)
+            executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # Слот занят, пока задача работает, даже если запрос перестал её ждать
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+        except FutureTimeout:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise HashPoolBusy() from None
+
+    def _release(self, future=None):
+        with self._lock:
+            self._inflight -= 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, kind=self.kind, workers=self.workers, limit=self.limit, inflight=self._inflight)
+
+
+_pool = HashPool()
+
+
+def hash_password(password):
+    return _pool.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash, password):
+    return _pool.run(check_password_hash, pwhash, password)
+
+
+def hash_pool_stats():
+    return _pool.stats()
@@ -0,0 +1,127 @@
+"""Шифрование персональных данных (Fernet) и кэш расшифровки.
+
+Один и тот же шифротекст при каждом sync/login расшифровывался заново.
+Теперь результат хранится в ограниченном LRU-кэше по шифротексту: при
+изменении данных меняется и шифротекст, поэтому устаревшее значение выдано
+быть не может, а forget_user() сразу вытесняет старые значения.
+
+    ENCRYPTION_KEY   ключ Fernet (в продакшене обязателен)
+    PII_CACHE_SIZE   сколько расшифрованных значений держать в памяти (10000, 0 — без кэша)
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet
+
+# ===== КЛЮЧ ШИФРОВАНИЯ =====
+# В продакшене храните этот ключ в переменных окружения!
+ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or Fernet.generate_key()
+cipher = Fernet(ENCRYPTION_KEY)
+
+PII_CACHE_SIZE = int(os.environ.get('PII_CACHE_SIZE', 10000))
+
+# Контакты и данные карты хранятся зашифрованными
+CONTACT_FIELDS = ('phone', 'email')
+CARD_FIELDS = ('cardNumber', 'cardHolder')
+PII_FIELDS = CONTACT_FIELDS + CARD_FIELDS
+
+
+class DecryptCache:
+    """LRU: шифротекст → открытый текст"""
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "capacity": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+_cache = DecryptCache(PII_CACHE_SIZE)
+
+# Счётчики текущего запроса: сколько раз просили расшифровать и сколько дошло до Fernet
+_request = threading.local()
+
+
+def encrypt_data(data):
+    """Шифрует строку"""
+    if not data:
+        return ''
+    return cipher.encrypt(data.encode()).decode()
+
+
+def decrypt_data(data):
+    """Дешифрует строку (через кэш)"""
+    if not data:
+        return ''
+    _request.calls = getattr(_request, 'calls', 0) + 1
+    value = _cache.get(data)
+    if value is not None:
+        return value
+
+    _request.fernet = getattr(_request, 'fernet', 0) + 1
+    try:
+        value = cipher.decrypt(data.encode()).decode()
+    except Exception:
+        value = data  # Возвращаем как есть если не получилось расшифровать (для старых данных)
+    _cache.put(data, value)
+    return value
+
+
+def decrypt_fields(u, fields=PII_FIELDS):
+    """Расшифровывает указанные поля пользователя (dict) на месте"""
+    for field in fields:
+        if u.get(field):
+            u[field] = decrypt_data(u[field])
+    return u
+
+
+def forget_user(db, username):
+    """Вытесняет из кэша текущие значения пользователя — вызывать перед их изменением"""
+    row = db.execute(f"SELECT {', '.join(PII_FIELDS)} FROM users WHERE username = ?", (username,)).fetchone()
+    if row:
+        _cache.invalidate([v for v in row if v])
+
+
+def reset_request_counters():
+    _request.calls = 0
+    _request.fernet = 0
+
+
+def request_counters():
+    """(обращения к decrypt_data, реальные расшифровки Fernet) в текущем запросе"""
+    return getattr(_request, 'calls', 0), getattr(_request, 'fernet', 0)
+
+
+def cache_stats():
+    return _cache.stats()
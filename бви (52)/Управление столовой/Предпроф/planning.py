@@ -0,0 +1,97 @@
+"""Рецептуры блюд и результаты прогноза для повара.
+
+recipes — сколько ингредиента со склада уходит на одну порцию блюда
+(в единицах ингредиента: 0.05 кг, 0.2 л, 1 шт). Повар задаёт рецептуру
+действием set_recipe, она целиком заменяет прежнюю.
+
+Таблицы прогноза заполняет только пакетный расчёт forecast.py (NumPy, вне
+запросов — из cron или вручную), эндпоинты их лишь читают:
+
+    forecast_runs         когда считали, горизонт и сколько дней истории вошло
+    forecast_portions     (день, блюдо) → ожидаемый спрос и рекомендуемые порции
+    purchase_suggestions  ингредиент → потребность на горизонт, остаток и сколько докупить
+
+Каждый расчёт заменяет прежние строки одной транзакцией.
+"""
+import json
+
+NO_DISH = ('no_dish', 'Блюдо не найдено', 404)
+BAD_RECIPE = ('invalid', 'Рецептура: нужны ingredientId и qty > 0 для существующих ингредиентов', 400)
+
+
+def install_planning(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS recipes (
+        dishId INTEGER NOT NULL,
+        ingredientId INTEGER NOT NULL,
+        qty REAL NOT NULL,
+        PRIMARY KEY (dishId, ingredientId)) WITHOUT ROWID''')
+    db.execute('''CREATE TABLE IF NOT EXISTS forecast_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        computedAt TEXT,
+        fromDay TEXT,
+        toDay TEXT,
+        historyDays INTEGER,
+        seconds REAL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS forecast_portions (
+        day TEXT NOT NULL,
+        dishId INTEGER NOT NULL,
+        expected REAL NOT NULL,
+        suggested INTEGER NOT NULL,
+        PRIMARY KEY (day, dishId))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS purchase_suggestions (
+        ingredientId INTEGER PRIMARY KEY,
+        need REAL NOT NULL,
+        stock REAL NOT NULL,
+        qty REAL NOT NULL)''')
+
+
+def _recipe_items(items):
+    """[{"ingredientId", "qty"}] → {ingredientId: qty} или None, если данные неверные"""
+    result = {}
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        ingredient_id, qty = item.get('ingredientId'), item.get('qty')
+        if isinstance(ingredient_id, bool) or isinstance(qty, bool):
+            return None
+        try:
+            ingredient_id, qty = int(ingredient_id), float(qty)
+        except (TypeError, ValueError):
+            return None
+        if qty <= 0:
+            return None
+        result[ingredient_id] = result.get(ingredient_id, 0) + qty
+    return result
+
+
+def set_recipe(db, dish_id, items):
+    """Заменяет рецептуру блюда. Возвращает (None, число строк) или (кортеж ошибки, None)"""
+    lines = _recipe_items(items)
+    if lines is None:
+        return BAD_RECIPE, None
+    if not db.execute("SELECT 1 FROM menu WHERE id = ?", (dish_id,)).fetchone():
+        return NO_DISH, None
+    known = db.execute("SELECT COUNT(*) FROM ingredients WHERE id IN (SELECT CAST(key AS INTEGER) FROM json_each(?))",
+                       (json.dumps(lines),)).fetchone()[0]
+    if known != len(lines):
+        return BAD_RECIPE, None
+    db.execute("DELETE FROM recipes WHERE dishId = ?", (dish_id,))
+    db.executemany("INSERT INTO recipes (dishId, ingredientId, qty) VALUES (?, ?, ?)",
+                   [(dish_id, ingredient_id, qty) for ingredient_id, qty in lines.items()])
+    return None, len(lines)
+
+
+def recipes(db):
+    return [dict(r) for r in db.execute("SELECT * FROM recipes ORDER BY dishId, ingredientId").fetchall()]
+
+
+def forecast_view(db):
+    """Последний расчёт: рекомендуемые порции по дням и предложения закупок"""
+    portions = [dict(r) for r in db.execute('''SELECT f.day, f.dishId, m.name, m.portions, f.expected, f.suggested
+        FROM forecast_portions f JOIN menu m ON m.id = f.dishId
+        ORDER BY f.day, m.name''').fetchall()]
+    purchases = [dict(r) for r in db.execute('''SELECT s.ingredientId, i.name, i.unit, s.need, s.stock, s.qty
+        FROM purchase_suggestions s JOIN ingredients i ON i.id = s.ingredientId
+        ORDER BY i.name''').fetchall()]
+    run = db.execute("SELECT computedAt, fromDay, toDay, historyDays FROM forecast_runs ORDER BY id DESC LIMIT 1").fetchone()
+    return {"run": dict(run) if run else None, "portions": portions, "purchases": purchases}
@@ -1,159 +1,62 @@
-import sqlite3
-import os
-from datetime import datetime
-from werkzeug.security import generate_password_hash
+"""Сброс базы и заполнение тестовыми данными.
 
-DB_NAME = "canteen_full.db"
+Без параметров — как раньше: 4 тестовых аккаунта, 13 блюд и 8 ингредиентов.
+С параметрами — ещё и синтетическая история нужного размера для профилирования
+и нагрузочных прогонов: школы, ученики, повара, месяцы заказов, абонементы,
+их использование, отзывы и уведомления.
 
-print("=" * 60)
-print("🔄 СБРОС И ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ")
-print("=" * 60)
+    python reset_and_fill_database.py
+    python reset_and_fill_database.py --schools 20 --students 20000 --days 60      # ~1 млн заказов
+    python reset_and_fill_database.py --db /tmp/big.db --students 50000 --seed 7
 
-# Удаляем старую базу если есть
-if os.path.exists(DB_NAME):
-    os.remove(DB_NAME)
-    print("✅ Старая база данных удалена")
+Генерация детерминирована (--seed), строки пишутся через executemany пачками
+по --batch в отдельных транзакциях. Хэш пароля считается один раз и общий для
+всех (пароль 123), контакты шифруются тем же ключом, что у сервера
+(ENCRYPTION_KEY). Триггеры журнала изменений и агрегатов на время массовой
+вставки снимаются, агрегаты потом пересчитываются одним запросом.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
 
-# Создаём новую базу
-conn = sqlite3.connect(DB_NAME)
-cursor = conn.cursor()
-
-print("✅ Новая база данных создана")
-
-# ===== СОЗДАНИЕ ТАБЛИЦ =====
-cursor.execute('''CREATE TABLE users (
-    username TEXT PRIMARY KEY, 
-    password TEXT, 
-    fullName TEXT, 
-    role TEXT, 
-    school TEXT, 
-    grade TEXT, 
-    phone TEXT, 
-    email TEXT, 
-    balance REAL DEFAULT 0, 
-    allergies TEXT DEFAULT '', 
-    isApproved INTEGER DEFAULT 1,
-    cardNumber TEXT DEFAULT '',
-    cardHolder TEXT DEFAULT '',
-    cardExpiry TEXT DEFAULT '')''')
-
-cursor.execute('''CREATE TABLE menu (
-    id INTEGER PRIMARY KEY AUTOINCREMENT, 
-    name TEXT, 
-    price REAL, 
-    portions INTEGER, 
-    type TEXT,
-    ingredients TEXT DEFAULT '',
-    category TEXT DEFAULT 'Обед',
-    addedDate TEXT)''')
-
-cursor.execute('''CREATE TABLE orders (
-    id INTEGER PRIMARY KEY AUTOINCREMENT, 
-    user TEXT, 
-    name TEXT, 
-    price REAL, 
-    status TEXT, 
-    allergies TEXT, 
-    issuedAt TEXT, 
-    createdAt TEXT)''')
-
-cursor.execute('''CREATE TABLE ingredients (
-    id INTEGER PRIMARY KEY AUTOINCREMENT, 
-    name TEXT, 
-    amount REAL, 
-    unit TEXT)''')
-
-cursor.execute('''CREATE TABLE reviews (
-    dish TEXT, 
-    text TEXT, 
-    author TEXT)''')
-
-cursor.execute('''CREATE TABLE purchases (
-    id INTEGER PRIMARY KEY AUTOINCREMENT, 
-    item TEXT, 
-    qty TEXT,
-    price REAL DEFAULT 0,
-    status TEXT)''')
-
-cursor.execute('''CREATE TABLE notifications (
-    title TEXT, 
-    text TEXT, 
-    type TEXT, 
-    toUser TEXT, 
-    toRole TEXT, 
-    time TEXT)''')
-
-cursor.execute('''CREATE TABLE sub_transactions (
-    user TEXT, 
-    type TEXT, 
-    amount REAL, 
-    time TEXT)''')
-
-cursor.execute('''CREATE TABLE subscription_usage (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user TEXT,
-    subType TEXT,
-    date TEXT,
-    dishesUsed TEXT,
-    createdAt TEXT)''')
-
-print("✅ Таблицы созданы")
-
-# ===== ТЕСТОВЫЕ ПОЛЬЗОВАТЕЛИ (ПАРОЛЬ 123 ДЛЯ ВСЕХ) =====
-now = datetime.now().isoformat()
-
-users = [
-    # Системный админ
-    ('admin', generate_password_hash('123'), 'Главный Администратор', 'admin', 'Система', '', '', '', 0, '', 1, '', '',
-     ''),
-
-    # Ученик
-    ('a', generate_password_hash('123'), 'Иван Иванов', 'student', 'ГБОУ Школа №656', '9А', '+7 999 111-11-11',
-     'student@school.ru', 1000, '', 1, '', '', ''),
-
-    # Повар
-    ('aa', generate_password_hash('123'), 'Мария Петрова', 'chef', 'ГБОУ Школа №656', '', '+7 999 222-22-22',
-     'chef@school.ru', 0, '', 1, '', '', ''),
-
-    # Администратор
-    ('aaa', generate_password_hash('123'), 'Александр Сидоров', 'admin', 'ГБОУ Школа №656', '', '+7 999 333-33-33',
-     'admin1@school.ru', 0, '', 1, '', '', '')
-]
+from werkzeug.security import generate_password_hash
+
+from allergens import reindex_allergens
+from db import DB_NAME
+from ledger import open_balances, snapshot_balances
+from migrations import migrate
+from passwords import PASSWORD_HASH_METHOD
+from pii import encrypt_data
+from stats import backfill_rollups
+from subscriptions import backfill_entitlements
 
-for user in users:
-    cursor.execute("INSERT INTO users VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", user)
-    print(f"✅ Пользователь добавлен: {user[0]:6} ({user[3]:8}) | Пароль: 123")
+PASSWORD = '123'
 
 # ===== ТЕСТОВЫЕ БЛЮДА =====
-test_dishes = [
+TEST_DISHES = [
     # Завтраки
-    ("Каша овсяная с маслом", 80, 20, "Первое", "овсяные хлопья, молоко, масло сливочное, сахар", "Завтрак", now),
-    ("Омлет с сыром", 120, 15, "Второе", "яйца, молоко, сыр, масло растительное", "Завтрак", now),
-    ("Сырники со сметаной", 150, 12, "Второе", "творог, яйца, мука, сахар, сметана", "Завтрак", now),
-    ("Чай с лимоном", 30, 50, "Напиток", "чай черный, лимон, сахар", "Завтрак", now),
-    ("Какао", 60, 30, "Напиток", "какао порошок, молоко, сахар", "Завтрак", now),
+    ("Каша овсяная с маслом", 80, 20, "Первое", "овсяные хлопья, молоко, масло сливочное, сахар", "Завтрак"),
+    ("Омлет с сыром", 120, 15, "Второе", "яйца, молоко, сыр, масло растительное", "Завтрак"),
+    ("Сырники со сметаной", 150, 12, "Второе", "творог, яйца, мука, сахар, сметана", "Завтрак"),
+    ("Чай с лимоном", 30, 50, "Напиток", "чай черный, лимон, сахар", "Завтрак"),
+    ("Какао", 60, 30, "Напиток", "какао порошок, молоко, сахар", "Завтрак"),
 
     # Обеды
-    ("Борщ украинский", 180, 15, "Первое", "свекла, капуста, картофель, морковь, лук, говядина, томатная паста", "Обед",
-     now),
-    ("Суп куриный с лапшой", 150, 20, "Первое", "курица, лапша, морковь, лук, картофель", "Обед", now),
-    ("Котлета с пюре", 200, 12, "Второе", "говядина, свинина, хлеб, яйца, картофель, молоко, масло сливочное", "Обед",
-     now),
-    ("Рыба запечённая", 220, 8, "Второе", "рыба, лимон, специи, масло растительное", "Обед", now),
-    ("Плов узбекский", 190, 10, "Второе", "рис, баранина, морковь, лук, чеснок, специи", "Обед", now),
-    ("Салат Цезарь", 120, 15, "Салат", "курица, салат, помидоры, сыр, сухарики, соус", "Обед", now),
-    ("Компот из сухофруктов", 50, 40, "Напиток", "яблоки сушеные, курага, изюм, сахар", "Обед", now),
-    ("Сок апельсиновый", 70, 25, "Напиток", "апельсины, сахар", "Обед", now),
+    ("Борщ украинский", 180, 15, "Первое", "свекла, капуста, картофель, морковь, лук, говядина, томатная паста", "Обед"),
+    ("Суп куриный с лапшой", 150, 20, "Первое", "курица, лапша, морковь, лук, картофель", "Обед"),
+    ("Котлета с пюре", 200, 12, "Второе", "говядина, свинина, хлеб, яйца, картофель, молоко, масло сливочное", "Обед"),
+    ("Рыба запечённая", 220, 8, "Второе", "рыба, лимон, специи, масло растительное", "Обед"),
+    ("Плов узбекский", 190, 10, "Второе", "рис, баранина, морковь, лук, чеснок, специи", "Обед"),
+    ("Салат Цезарь", 120, 15, "Салат", "курица, салат, помидоры, сыр, сухарики, соус", "Обед"),
+    ("Компот из сухофруктов", 50, 40, "Напиток", "яблоки сушеные, курага, изюм, сахар", "Обед"),
+    ("Сок апельсиновый", 70, 25, "Напиток", "апельсины, сахар", "Обед"),
 ]
 
-for dish in test_dishes:
-    cursor.execute(
-        "INSERT INTO menu (name, price, portions, type, ingredients, category, addedDate) VALUES (?,?,?,?,?,?,?)", dish)
-    category_icon = "🌅" if dish[5] == "Завтрак" else "🍽️"
-    print(f"✅ Блюдо добавлено: {dish[0]:25} {category_icon} {dish[5]:8} ({dish[1]}₽, {dish[2]} порций)")
-
 # ===== ИНГРЕДИЕНТЫ =====
-ingredients = [
+INGREDIENTS = [
     ("Мука пшеничная", 50, "кг"),
     ("Сахар", 30, "кг"),
     ("Рис", 40, "кг"),
@@ -164,28 +67,307 @@ ingredients = [
     ("Яйца", 200, "шт"),
 ]
 
-for ing in ingredients:
-    cursor.execute("INSERT INTO ingredients (name, amount, unit) VALUES (?,?,?)", ing)
-    print(f"✅ Ингредиент: {ing[0]:20} ({ing[1]} {ing[2]})")
-
-conn.commit()
-conn.close()
-
-print("\n" + "=" * 60)
-print("✅ БАЗА ДАННЫХ ГОТОВА!")
-print("=" * 60)
-print("\n📋 ТЕСТОВЫЕ АККАУНТЫ (ЕДИНЫЙ ПАРОЛЬ: 123):\n")
-print("┌─────────────┬──────────┬────────────────────────────┐")
-print("│ Логин       │ Пароль   │ Роль                       │")
-print("├─────────────┼──────────┼────────────────────────────┤")
-print("│ a           │ 123      │ Ученик (9А, баланс 1000₽) │")
-print("│ aa          │ 123      │ Повар (одобрен)            │")
-print("│ aaa         │ 123      │ Администратор              │")
-print("│ admin       │ 123      │ Системный администратор    │")
-print("└─────────────┴──────────┴────────────────────────────┘")
-print("\n🍽️  В меню добавлено:", len(test_dishes), "блюд (Завтраки + Обеды)")
-print("📦  На складе:", len(ingredients), "ингредиентов")
-print("=" * 60)
-print("\n🚀 Запустите сервер: python app.py")
-print("🌐 Откройте браузер: http://127.0.0.1:8008")
-print("=" * 60)
\ No newline at end of file
+# ===== РЕЦЕПТУРЫ (расход на порцию в единицах ингредиента) =====
+RECIPES = {
+    "Каша овсяная с маслом": [("Молоко", 0.15), ("Сахар", 0.01)],
+    "Омлет с сыром": [("Яйца", 2), ("Молоко", 0.05)],
+    "Сырники со сметаной": [("Яйца", 1), ("Мука пшеничная", 0.03), ("Сахар", 0.015)],
+    "Чай с лимоном": [("Сахар", 0.01)],
+    "Какао": [("Молоко", 0.2), ("Сахар", 0.015)],
+    "Борщ украинский": [("Картофель", 0.08), ("Мясо (говядина)", 0.05)],
+    "Суп куриный с лапшой": [("Курица", 0.06), ("Картофель", 0.06)],
+    "Котлета с пюре": [("Мясо (говядина)", 0.08), ("Картофель", 0.2), ("Яйца", 0.25), ("Молоко", 0.03)],
+    "Плов узбекский": [("Рис", 0.08)],
+    "Салат Цезарь": [("Курица", 0.05)],
+    "Компот из сухофруктов": [("Сахар", 0.02)],
+    "Сок апельсиновый": [("Сахар", 0.01)],
+}
+
+FIRST_NAMES = ["Иван", "Мария", "Алексей", "Анна", "Дмитрий", "Елена", "Сергей", "Ольга", "Никита", "Дарья",
+               "Артём", "Полина", "Максим", "София", "Кирилл", "Виктория"]
+LAST_NAMES = ["Иванов", "Петров", "Смирнов", "Кузнецов", "Попов", "Соколов", "Лебедев", "Козлов", "Новиков",
+              "Морозов", "Волков", "Фёдоров"]
+GRADES = [f"{n}{letter}" for n in range(1, 12) for letter in "АБВ"]
+ALLERGENS = ['Лактоза', 'Орехи', 'Глютен', 'Яйца', 'Цитрус', 'Морепродукты']
+REVIEW_TEXTS = ["Очень вкусно!", "Нормально", "Порция маленькая", "Хотелось бы погорячее", "Лучшее блюдо недели",
+                "Пересолено", "Спасибо поварам!"]
+SUB_TYPES = [('Завтраки', 1500, 'Завтрак'), ('Обеды', 2500, 'Обед')]
+
+# Таблицы, в которые идёт массовая вставка (на них снимаются триггеры)
+BULK_TABLES = ('users', 'orders', 'sub_transactions', 'subscription_usage', 'reviews', 'notifications',
+               'entitlements')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сброс базы и генерация тестовых данных")
+    parser.add_argument('--db', default=DB_NAME, help=f"файл базы ({DB_NAME})")
+    parser.add_argument('--schools', type=int, default=0, help="число синтетических школ (0 — только демо-данные)")
+    parser.add_argument('--students', type=int, default=0, help="учеников всего, делятся между школами")
+    parser.add_argument('--chefs', type=int, default=2, help="поваров на школу")
+    parser.add_argument('--days', type=int, default=30, help="дней истории (учебные дни, без выходных)")
+    parser.add_argument('--orders-per-day', type=float, default=0.9, help="среднее число заказов ученика в день")
+    parser.add_argument('--subscribers', type=float, default=0.3, help="доля учеников с абонементами")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch', type=int, default=50000, help="строк в одной транзакции")
+    args = parser.parse_args()
+    if args.students and not args.schools:
+        args.schools = 1
+    return args
+
+
+def school_days(days):
+    """Последние days учебных дней, заканчивая вчерашним"""
+    result, d = [], date.today()
+    while len(result) < days:
+        d -= timedelta(days=1)
+        if d.weekday() < 5:
+            result.append(d)
+    return result[::-1]
+
+
+def insert_batched(conn, sql, rows, batch):
+    """executemany пачками, каждая пачка — своя транзакция. Возвращает число строк"""
+    total, chunk = 0, []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch:
+            conn.executemany(sql, chunk)
+            conn.commit()
+            total += len(chunk)
+            chunk.clear()
+    if chunk:
+        conn.executemany(sql, chunk)
+        conn.commit()
+        total += len(chunk)
+    return total
+
+
+def drop_triggers(conn, tables):
+    """Снимает триггеры с таблиц и возвращает их SQL для восстановления"""
+    marks = ','.join('?' * len(tables))
+    triggers = conn.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ({marks})",
+                            tables).fetchall()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.commit()
+    return [sql for _, sql in triggers]
+
+
+def seed_demo(conn, pwhash, now):
+    users = [
+        # Системный админ
+        ('admin', pwhash, 'Главный Администратор', 'admin', 'Система', '', '', '', 0),
+        # Ученик
+        ('a', pwhash, 'Иван Иванов', 'student', 'ГБОУ Школа №656', '9А', '+7 999 111-11-11', 'student@school.ru', 1000),
+        # Повар
+        ('aa', pwhash, 'Мария Петрова', 'chef', 'ГБОУ Школа №656', '', '+7 999 222-22-22', 'chef@school.ru', 0),
+        # Администратор
+        ('aaa', pwhash, 'Александр Сидоров', 'admin', 'ГБОУ Школа №656', '', '+7 999 333-33-33', 'admin1@school.ru', 0),
+    ]
+    conn.executemany("INSERT INTO users (username, password, fullName, role, school, grade, phone, email, balance, "
+                     "isApproved) VALUES (?,?,?,?,?,?,?,?,?,1)",
+                     [u[:6] + (encrypt_data(u[6]), encrypt_data(u[7]), u[8]) for u in users])
+    for u in users:
+        print(f"✅ Пользователь добавлен: {u[0]:6} ({u[3]:8}) | Пароль: {PASSWORD}")
+
+    conn.executemany("INSERT INTO menu (name, price, portions, type, ingredients, category, addedDate) "
+                     "VALUES (?,?,?,?,?,?,?)", [dish + (now,) for dish in TEST_DISHES])
+    for dish in TEST_DISHES:
+        category_icon = "🌅" if dish[5] == "Завтрак" else "🍽️"
+        print(f"✅ Блюдо добавлено: {dish[0]:25} {category_icon} {dish[5]:8} ({dish[1]}₽, {dish[2]} порций)")
+
+    conn.executemany("INSERT INTO ingredients (name, amount, unit) VALUES (?,?,?)", INGREDIENTS)
+    for ing in INGREDIENTS:
+        print(f"✅ Ингредиент: {ing[0]:20} ({ing[1]} {ing[2]})")
+
+    conn.executemany("INSERT INTO recipes (dishId, ingredientId, qty) "
+                     "SELECT m.id, i.id, ? FROM menu m, ingredients i WHERE m.name = ? AND i.name = ?",
+                     [(qty, dish, ingredient) for dish, lines in RECIPES.items() for ingredient, qty in lines])
+    print(f"✅ Рецептуры: {len(RECIPES)} блюд")
+    conn.commit()
+
+
+def generate(conn, args, pwhash):
+    """Синтетическая история: возвращает {таблица: число строк}"""
+    rng = random.Random(args.seed)
+    counts = {}
+    schools = [f"ГБОУ Школа №{1000 + i}" for i in range(args.schools)]
+    days = school_days(args.days)
+    dishes = [(name, price, category) for name, price, _, _, _, category in TEST_DISHES]
+    by_category = {c: [d for d in dishes if d[2] == c] for c in ('Завтрак', 'Обед')}
+
+    # Ученики: школа — по номеру, контакты зашифрованы (Fernet — самая дорогая часть, поэтому не у всех)
+    students = [(f"st{i}", schools[i % len(schools)]) for i in range(args.students)]
+
+    def user_rows():
+        for username, school in students:
+            with_contacts = rng.random() < 0.2
+            yield (username, pwhash, f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}", 'student', school,
+                   rng.choice(GRADES),
+                   encrypt_data(f"+7 9{rng.randint(10, 99)} {rng.randint(100, 999)}-{rng.randint(10, 99)}-"
+                                f"{rng.randint(10, 99)}") if with_contacts else '',
+                   encrypt_data(f"{username}@school.ru") if with_contacts else '',
+                   rng.randint(0, 3000),
+                   ', '.join(rng.sample(ALLERGENS, 1)) if rng.random() < 0.1 else '', 1)
+        for s, school in enumerate(schools):
+            for c in range(args.chefs):
+                yield (f"chef{s}_{c}", pwhash, f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}", 'chef', school,
+                       '', '', '', 0, '', 1)
+            yield (f"admin{s}", pwhash, f"Администратор школы {s}", 'admin', school, '', '', '', 0, '', 1)
+
+    counts['users'] = insert_batched(
+        conn, "INSERT INTO users (username, password, fullName, role, school, grade, phone, email, balance, "
+              "allergies, isApproved) VALUES (?,?,?,?,?,?,?,?,?,?,?)", user_rows(), args.batch)
+
+    # Абонементы: подписчики покупают их в начале каждого месяца истории
+    subscribers = {username: rng.choice(SUB_TYPES) for username, _ in students if rng.random() < args.subscribers}
+    months = sorted({d.replace(day=1) for d in days})
+
+    def sub_rows():
+        for month in months:
+            for username, (sub_type, price, _) in subscribers.items():
+                yield username, sub_type, price, f"{month.isoformat()}T08:{rng.randint(0, 59):02d}:00"
+
+    counts['sub_transactions'] = insert_batched(
+        conn, "INSERT INTO sub_transactions (user, type, amount, time) VALUES (?,?,?,?)", sub_rows(), args.batch)
+
+    # Заказы и использование абонементов по дням; прошлые заказы в основном выданы
+    usage = []
+
+    def order_rows():
+        for day in days:
+            prefix = day.isoformat()
+            for username, _ in students:
+                n = int(args.orders_per_day) + (rng.random() < args.orders_per_day % 1)
+                sub = subscribers.get(username)
+                for k in range(n):
+                    hour = rng.choice((8, 9, 12, 13))
+                    created = f"{prefix}T{hour:02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+                    issued = rng.random() < 0.92
+                    if sub and k == 0:
+                        name = rng.choice(by_category[sub[2]])[0]
+                        price = 0
+                        usage.append((username, sub[0], prefix, name, created))
+                    else:
+                        name, price, _ = rng.choice(dishes)
+                    yield (username, name, price, 'Выдано' if issued else 'Оплачено', '',
+                           f"{hour:02d}:{rng.randint(0, 59):02d}" if issued else None, created)
+
+    counts['orders'] = insert_batched(
+        conn, "INSERT INTO orders (user, name, price, status, allergies, issuedAt, createdAt) VALUES (?,?,?,?,?,?,?)",
+        order_rows(), args.batch)
+    counts['subscription_usage'] = insert_batched(
+        conn, "INSERT INTO subscription_usage (user, subType, date, dishesUsed, createdAt) VALUES (?,?,?,?,?)",
+        usage, args.batch)
+
+    def review_rows():
+        for _ in range(max(1, len(students) // 10)):
+            username, _ = rng.choice(students)
+            yield rng.choice(dishes)[0], rng.choice(REVIEW_TEXTS), username
+
+    counts['reviews'] = insert_batched(conn, "INSERT INTO reviews (dish, text, author) VALUES (?,?,?)",
+                                       review_rows(), args.batch)
+
+    # Уведомления: пополнения и выдачи у части учеников плюс объявления для ролей
+    def notification_rows():
+        for day in days[-14:]:
+            yield ('Новое блюдо!', 'В меню добавлены новые блюда', 'menu', None, 'student', '09:00',
+                   f"{day.isoformat()}T09:00:00")
+            for username, _ in students:
+                if rng.random() < 0.1:
+                    hhmm = f"{rng.randint(9, 14):02d}:{rng.randint(0, 59):02d}"
+                    yield ('Заказ выдан', 'Ваш заказ готов к получению', 'order', username, None, hhmm,
+                           f"{day.isoformat()}T{hhmm}:00")
+
+    counts['notifications'] = insert_batched(
+        conn, "INSERT INTO notifications (title, text, type, toUser, toRole, time, createdAt) "
+              "VALUES (?,?,?,?,?,?,?)",
+        notification_rows(), args.batch)
+    return counts
+
+
+def main():
+    args = parse_args()
+    started = time.time()
+
+    print("=" * 60)
+    print("🔄 СБРОС И ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ")
+    print("=" * 60)
+
+    # Удаляем старую базу если есть
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    print("✅ Старая база данных удалена")
+
+    conn = sqlite3.connect(args.db)
+    # Для одноразовой заливки: журнал в памяти, без fsync
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    print("✅ Новая база данных создана")
+
+    # ===== СОЗДАНИЕ ТАБЛИЦ =====
+    # Та же схема и индексы, что и у сервера
+    migrate(conn, log=lambda msg: None)
+    print("✅ Таблицы созданы")
+
+    if not os.environ.get('ENCRYPTION_KEY'):
+        print("⚠️  ENCRYPTION_KEY не задан — контакты зашифрованы случайным ключом, сервер их не расшифрует")
+
+    # ===== ТЕСТОВЫЕ ДАННЫЕ (ПАРОЛЬ 123 ДЛЯ ВСЕХ) =====
+    # Один хэш на всех: пароль у всех одинаковый, а scrypt на каждого занял бы минуты
+    pwhash = generate_password_hash(PASSWORD, PASSWORD_HASH_METHOD)
+    seed_demo(conn, pwhash, datetime.now().isoformat())
+
+    counts = {}
+    if args.schools:
+        print(f"\n⏳ Генерация: {args.schools} школ, {args.students} учеников, {args.days} учебных дней...")
+        saved_triggers = drop_triggers(conn, BULK_TABLES)
+        counts = generate(conn, args, pwhash)
+        counts['entitlements'] = backfill_entitlements(conn)
+        # Триггеры users сняты — начальные балансы в журнал переносим разом
+        counts['ledger'] = open_balances(conn)
+        for sql in saved_triggers:
+            conn.execute(sql)
+        backfill_rollups(conn)
+        conn.commit()
+        for table, n in counts.items():
+            print(f"✅ {table:20} {n:>10,}".replace(',', ' '))
+
+    # Блюда и аллергии залиты напрямую, без add_menu_item и save_profile — размечаем разом
+    reindex_allergens(conn)
+    snapshot_balances(conn)
+    conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.commit()
+    conn.close()
+
+    print("\n" + "=" * 60)
+    print(f"✅ БАЗА ДАННЫХ ГОТОВА! ({time.time() - started:.1f} с, {os.path.getsize(args.db) / 1024 / 1024:.1f} МБ)")
+    print("=" * 60)
+    print(f"\n📋 ТЕСТОВЫЕ АККАУНТЫ (ЕДИНЫЙ ПАРОЛЬ: {PASSWORD}):\n")
+    print("┌─────────────┬──────────┬────────────────────────────┐")
+    print("│ Логин       │ Пароль   │ Роль                       │")
+    print("├─────────────┼──────────┼────────────────────────────┤")
+    print("│ a           │ 123      │ Ученик (9А, баланс 1000₽) │")
+    print("│ aa          │ 123      │ Повар (одобрен)            │")
+    print("│ aaa         │ 123      │ Администратор              │")
+    print("│ admin       │ 123      │ Системный администратор    │")
+    if counts:
+        print("│ st0, st1... │ 123      │ Сгенерированные ученики    │")
+        print("│ chef0_0...  │ 123      │ Повара школ                │")
+        print("│ admin0...   │ 123      │ Администраторы школ        │")
+    print("└─────────────┴──────────┴────────────────────────────┘")
+    print("\n🍽️  В меню добавлено:", len(TEST_DISHES), "блюд (Завтраки + Обеды)")
+    print("📦  На складе:", len(INGREDIENTS), "ингредиентов")
+    print("=" * 60)
+    print("\n🚀 Запустите сервер: python app.py")
+    print("🌐 Откройте браузер: http://127.0.0.1:8080")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
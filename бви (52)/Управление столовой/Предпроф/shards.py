@@ -0,0 +1,410 @@
+"""Шарды по школам: у каждой школы своя база SQLite.
+
+SQLite пропускает одного писателя на файл, поэтому с общей базой обеденный
+пик одной школы задерживал buy и confirm_order всех остальных. Данные и так
+делятся по users.school, поэтому у школы своя база со всеми таблицами
+(меню, склад, заказы, деньги, абонементы), а общим остаётся маленький
+каталог:
+
+    SHARDS_DIR/catalog.db              schools (школа → каталог шарда),
+                                       accounts (логин → школа)
+    SHARDS_DIR/school-001/canteen.db   база школы; её архив — school-001/archive
+
+Запрос работает с базой школы вошедшего пользователя: сервер выбирает её
+перед запросом (db.route), и get_db() без пути отдаёт соединение с ней.
+Вход и регистрация находят школу по логину в каталоге. Отчёты админа
+обходят шарды параллельно (fan_out) и сливают результат. Нумерация
+AUTOINCREMENT-таблиц шарда начинается с номер школы × SHARD_ID_SPAN,
+поэтому id заказов и закупок разных школ не совпадают и страницы сливаются
+по id.
+
+Без SHARDS_DIR шардов нет: все школы в одной базе DB_PATH, как раньше.
+
+    SHARDS_DIR            каталог каталога и шардов (пусто — одна база)
+    SHARD_FANOUT_THREADS  сколько шардов читать параллельно в отчётах (4)
+
+    python shards.py split [--db canteen_full.db] [--to DIR] [--shared-to ШКОЛА]
+    python shards.py add ШКОЛА      — подключить новую школу
+    python shards.py list           — файлы баз шардов (для cron: forecast.py, ledger.py, archive.py --db)
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from archive import ARCHIVED_TABLES, archive_dir, attached
+from db import DB_NAME, connect, get_db
+from ledger import snapshot_balances
+from logs import get_logger
+
+SHARDS_DIR = os.environ.get('SHARDS_DIR', '')
+SHARD_FANOUT_THREADS = int(os.environ.get('SHARD_FANOUT_THREADS', 4))
+
+# Сколько id у каждой школы в AUTOINCREMENT-таблицах: до 90 000 школ без выхода за 2^53 (числа JS)
+SHARD_ID_SPAN = 10 ** 11
+
+CATALOG_FILE = 'catalog.db'
+SHARD_FILE = 'canteen.db'
+
+NO_SCHOOL = ('no_school', 'Школа не подключена к системе', 400)
+
+# Строки учеников при разделении базы: таблица → столбец с логином
+USER_TABLES = {
+    'orders': 'user',
+    'entitlements': 'user',
+    'sub_transactions': 'user',
+    'subscription_usage': 'user',
+    'ledger': 'user',
+    'user_allergens': 'username',
+    'notification_reads': 'username',
+    'notifications': 'toUser',
+}
+# Агрегаты по школам
+SCHOOL_TABLES = {
+    'stats_dish_daily': 'school',
+    'stats_sub_daily': 'school',
+}
+# История без школы (заявки на закупку, отзывы) остаётся в одном шарде — --shared-to
+SHARED_HISTORY = ('purchases', 'stats_purchase_daily', 'reviews')
+# Пересчитываются в шарде заново: журнал изменений (клиенты получат полный снимок),
+# события, снимки балансов и прогноз
+RESET_TABLES = ('change_log', 'events', 'balance_snapshots', 'forecast_runs', 'forecast_portions',
+                'purchase_suggestions')
+
+
+def install_catalog(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS schools (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        dir TEXT NOT NULL UNIQUE,
+        createdAt TEXT)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS accounts (
+        username TEXT PRIMARY KEY,
+        school TEXT NOT NULL) WITHOUT ROWID''')
+
+
+def set_id_floor(db, floor):
+    """AUTOINCREMENT-таблицы базы продолжают нумерацию не ниже floor"""
+    tables = [r[0] for r in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE '%AUTOINCREMENT%'").fetchall()]
+    for table in tables:
+        if not db.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (floor, table)).rowcount:
+            db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, floor))
+
+
+def create_shard(path, school_id):
+    """Новая база школы с текущей схемой"""
+    from migrations import migrate
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = connect(path)
+    try:
+        migrate(db)
+        db.execute("BEGIN IMMEDIATE")
+        set_id_floor(db, school_id * SHARD_ID_SPAN)
+        db.commit()
+    finally:
+        db.close()
+
+
+class ShardRouter:
+    """Школа и логин → файл базы. Без root (SHARDS_DIR) всё идёт в одну базу default"""
+
+    def __init__(self, root=SHARDS_DIR, default=DB_NAME):
+        self.root = root
+        self.default = default
+        # Школа → путь к базе; школы только добавляются, при промахе каталог перечитывается
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._installed = False
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def catalog(self):
+        if not self._installed:
+            os.makedirs(self.root, exist_ok=True)
+            with get_db(os.path.join(self.root, CATALOG_FILE)) as db:
+                install_catalog(db)
+            self._installed = True
+        return get_db(os.path.join(self.root, CATALOG_FILE))
+
+    def _reload(self):
+        with self.catalog() as db:
+            rows = db.execute("SELECT name, dir FROM schools ORDER BY id").fetchall()
+        self._paths = {name: os.path.join(self.root, d, SHARD_FILE) for name, d in rows}
+
+    def path_for_school(self, school):
+        """База школы или None, если школа не подключена"""
+        if not self.enabled:
+            return self.default
+        if not school:
+            return None
+        path = self._paths.get(school)
+        if path is None:
+            # Школу могли подключить в другом процессе
+            self._reload()
+            path = self._paths.get(school)
+        return path
+
+    def locate(self, username):
+        """(школа из каталога, база) пользователя; (None, None) — логина нет. Без шардов — (None, default)"""
+        if not self.enabled:
+            return None, self.default
+        with self.catalog() as db:
+            row = db.execute("SELECT school FROM accounts WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], self.path_for_school(row[0])
+
+    def path_for_user(self, username):
+        return self.locate(username)[1]
+
+    def first_path(self):
+        """База для запросов без школы (гость без ?school=): первая подключённая школа"""
+        if not self.enabled:
+            return self.default
+        if not self._paths:
+            self._reload()
+        return next(iter(self._paths.values()), None)
+
+    def schools(self):
+        """Подключённые школы; без шардов — школы пользователей общей базы"""
+        if not self.enabled:
+            with get_db(self.default) as db:
+                return [r[0] for r in db.execute("SELECT DISTINCT school FROM users "
+                                                 "WHERE COALESCE(school, '') != '' ORDER BY school").fetchall()]
+        self._reload()
+        return list(self._paths)
+
+    def paths(self, school=None):
+        """Базы для обхода: все шарды или шард одной школы (пусто, если школа не подключена)"""
+        if not self.enabled:
+            return [self.default]
+        if school:
+            path = self.path_for_school(school)
+            return [path] if path else []
+        self._reload()
+        return list(self._paths.values())
+
+    def add_school(self, name):
+        """Подключает школу: новая база и строка каталога. Возвращает путь к базе"""
+        with self._lock, self.catalog() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT dir FROM schools WHERE name = ?", (name,)).fetchone()
+            if row:
+                return os.path.join(self.root, row[0], SHARD_FILE)
+            school_id = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM schools").fetchone()[0]
+            directory = f"school-{school_id:03d}"
+            path = os.path.join(self.root, directory, SHARD_FILE)
+            # База создаётся до записи в каталог: другие процессы не увидят школу без базы
+            create_shard(path, school_id)
+            db.execute("INSERT INTO schools (id, name, dir, createdAt) VALUES (?,?,?,?)",
+                       (school_id, name, directory, datetime.now().isoformat()))
+        get_logger('SHARDS').info(f"✅ Школа подключена: {name}", path=path)
+        return path
+
+    def claim(self, username, school):
+        """Занимает логин в каталоге за школой. False — логин у существующего пользователя"""
+        if not self.enabled:
+            return True
+        with self.catalog() as db:
+            if db.execute("INSERT OR IGNORE INTO accounts (username, school) VALUES (?, ?)",
+                          (username, school)).rowcount:
+                return True
+            owner = db.execute("SELECT school FROM accounts WHERE username = ?", (username,)).fetchone()[0]
+        path = self.path_for_school(owner)
+        if path:
+            with get_db(path) as db:
+                if db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                    return False
+        # Строка осталась от неудавшейся регистрации или удалённого пользователя — логин свободен
+        with self.catalog() as db:
+            db.execute("UPDATE accounts SET school = ? WHERE username = ?", (school, username))
+        return True
+
+    def release(self, username):
+        if self.enabled:
+            with self.catalog() as db:
+                db.execute("DELETE FROM accounts WHERE username = ?", (username,))
+
+    def stats(self):
+        return {"enabled": self.enabled, "schools": len(self._paths) if self.enabled else 1}
+
+
+router = ShardRouter()
+
+_executor = None
+_executor_pid = None
+
+
+def fan_out(fn, paths):
+    """fn(db) для каждой базы из paths, не больше SHARD_FANOUT_THREADS одновременно. Результаты — в порядке paths"""
+    global _executor, _executor_pid
+
+    def run(path):
+        with get_db(path) as db:
+            return fn(db)
+
+    if len(paths) <= 1:
+        return [run(p) for p in paths]
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(SHARD_FANOUT_THREADS, thread_name_prefix='fan-out')
+        _executor_pid = os.getpid()
+    return list(_executor.map(run, paths))
+
+
+# ===== РАЗДЕЛЕНИЕ ОБЩЕЙ БАЗЫ =====
+
+def keep_school(db, school, shared):
+    """Оставляет в копии общей базы только данные школы school. shared — школа, которой
+    достаются пользователи без школы и история без владельца"""
+    db.execute("BEGIN IMMEDIATE")
+    # Триггеры журнала, агрегатов и запрета правок ledger на время чистки снимаются
+    triggers = db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    for name, _ in triggers:
+        db.execute(f'DROP TRIGGER "{name}"')
+    tables = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+
+    db.execute("DELETE FROM users WHERE COALESCE(NULLIF(school, ''), ?) != ?", (shared, school))
+    for table, column in USER_TABLES.items():
+        if table in tables:
+            db.execute(f"DELETE FROM {table} WHERE {column} IS NOT NULL "
+                       f"AND {column} NOT IN (SELECT username FROM users)")
+    for table, column in SCHOOL_TABLES.items():
+        if table in tables:
+            db.execute(f"DELETE FROM {table} WHERE COALESCE(NULLIF({column}, ''), ?) != ?", (shared, school))
+    if school != shared:
+        for table in SHARED_HISTORY:
+            if table in tables:
+                db.execute(f"DELETE FROM {table}")
+    for table in RESET_TABLES:
+        if table in tables:
+            db.execute(f"DELETE FROM {table}")
+
+    snapshot_balances(db)
+    for _, sql in triggers:
+        db.execute(sql)
+    users = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    db.commit()
+    return users
+
+
+def _split_archives(source, shard, shard_path):
+    """Копирует архивные файлы общей базы в архив шарда, оставляя строки его учеников"""
+    files = [r[0] for r in shard.execute("SELECT file FROM archive_files").fetchall()]
+    if not files:
+        return
+    source_dir, target_dir = archive_dir(source), os.path.join(os.path.dirname(shard_path), 'archive')
+    os.makedirs(target_dir, exist_ok=True)
+    for file in files:
+        target = os.path.join(target_dir, file)
+        if not os.path.exists(os.path.join(source_dir, file)):
+            get_logger('SHARDS').warning(f"⚠️ Нет архивного файла {file}")
+            shard.execute("DELETE FROM archive_files WHERE file = ?", (file,))
+            continue
+        with attached(source, file) as schema:
+            source.execute(f"VACUUM {schema} INTO ?", (target,))
+        # Архив — обычный файл без WAL, как его создаёт archive.py
+        cold = sqlite3.connect(target)
+        try:
+            cold.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            tables = {r[0] for r in cold.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")}
+            rows = 0
+            for table in ARCHIVED_TABLES:
+                if table in tables:
+                    cold.execute(f"DELETE FROM main.{table} WHERE user NOT IN (SELECT username FROM shard.users)")
+                    rows += cold.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+            cold.commit()
+            cold.execute("DETACH DATABASE shard")
+            cold.execute("VACUUM")
+        finally:
+            cold.close()
+        shard.execute("UPDATE archive_files SET rows = ? WHERE file = ?", (rows, file))
+        if not rows:
+            os.remove(target)
+    shard.commit()
+
+
+def split(source, root, shared=None):
+    """Раскладывает общую базу source по шардам школ в каталоге root. Возвращает {школа: пользователей}"""
+    from migrations import migrate
+
+    if os.path.exists(os.path.join(root, CATALOG_FILE)):
+        raise SystemExit(f"❌ В {root} уже есть каталог шардов")
+    src = connect(source)
+    try:
+        migrate(src)
+        schools = [r[0] for r in src.execute('''SELECT school FROM users WHERE COALESCE(school, '') != ''
+            GROUP BY school ORDER BY COUNT(*) DESC, school''').fetchall()]
+        if not schools:
+            raise SystemExit("❌ В базе нет пользователей со школой")
+        # Без владельца — в школу с наибольшим числом пользователей
+        shared = shared or schools[0]
+        if shared not in schools:
+            raise SystemExit(f"❌ Нет школы {shared}")
+
+        os.makedirs(root, exist_ok=True)
+        catalog = connect(os.path.join(root, CATALOG_FILE))
+        install_catalog(catalog)
+        result = {}
+        for school_id, school in enumerate(sorted(schools), 1):
+            directory = f"school-{school_id:03d}"
+            path = os.path.join(root, directory, SHARD_FILE)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            started = time.perf_counter()
+            src.execute("VACUUM INTO ?", (path,))
+            shard = connect(path)
+            try:
+                result[school] = keep_school(shard, school, shared)
+                shard.execute("BEGIN IMMEDIATE")
+                set_id_floor(shard, school_id * SHARD_ID_SPAN)
+                shard.commit()
+                _split_archives(src, shard, path)
+                shard.execute("VACUUM")
+                catalog.executemany("INSERT INTO accounts (username, school) VALUES (?, ?)",
+                                    ((r[0], school) for r in shard.execute("SELECT username FROM users")))
+            finally:
+                shard.close()
+            catalog.execute("INSERT INTO schools (id, name, dir, createdAt) VALUES (?,?,?,?)",
+                            (school_id, school, directory, datetime.now().isoformat()))
+            get_logger('SHARDS').info(f"✅ {school}: {result[school]} пользователей", path=path,
+                                      seconds=round(time.perf_counter() - started, 2))
+        catalog.commit()
+        catalog.close()
+        return result
+    finally:
+        src.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Шарды по школам: разделение общей базы и каталог")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split_parser = commands.add_parser('split', help="разложить общую базу по шардам школ")
+    split_parser.add_argument('--db', default=DB_NAME, help=f"общая база ({DB_NAME}); не меняется")
+    split_parser.add_argument('--to', default=SHARDS_DIR or 'shards', help="каталог шардов (SHARDS_DIR или shards)")
+    split_parser.add_argument('--shared-to', help="школа для закупок и отзывов (по умолчанию — самая большая)")
+    add_parser = commands.add_parser('add', help="подключить новую школу")
+    add_parser.add_argument('school')
+    add_parser.add_argument('--dir', default=SHARDS_DIR or 'shards')
+    list_parser = commands.add_parser('list', help="файлы баз шардов")
+    list_parser.add_argument('--dir', default=SHARDS_DIR or 'shards')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        result = split(args.db, args.to, args.shared_to)
+        print(f"✅ Шардов: {len(result)}, пользователей: {sum(result.values())}")
+        print(f"   Запуск с шардами: SHARDS_DIR={os.path.abspath(args.to)}")
+    elif args.command == 'add':
+        print(ShardRouter(args.dir).add_school(args.school))
+    else:
+        for path in ShardRouter(args.dir).paths():
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Статистика для админки на дневных агрегатах (/api/stats).
+
+Агрегаты по дню, школе и блюду обновляются триггерами в той же транзакции,
+что и сами заказы, абонементы и закупки. Запрос за период читает только
+строки агрегатов (дни × блюда), а не всю историю заказов.
+
+Агрегаты — это история: при удалении или архивировании заказов они не
+уменьшаются. С шардами (shards.py) у каждой школы свои агрегаты, сводки
+баз складываются merge_stats.
+"""
+
+ISSUED = 'Выдано'
+APPROVED = 'Одобрено'
+
+# Допустимые разрезы для ?group=
+GROUPS = {
+    'day': 'day',
+    'school': 'school',
+    'dish': 'dish',
+    'category': 'category',
+}
+
+
+def install_rollups(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS stats_dish_daily (
+        day TEXT,
+        school TEXT,
+        dish TEXT,
+        category TEXT,
+        ordersCount INTEGER DEFAULT 0,
+        ordersAmount REAL DEFAULT 0,
+        issuedCount INTEGER DEFAULT 0,
+        issuedAmount REAL DEFAULT 0,
+        PRIMARY KEY (day, school, dish))''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS stats_sub_daily (
+        day TEXT,
+        school TEXT,
+        subType TEXT,
+        count INTEGER DEFAULT 0,
+        amount REAL DEFAULT 0,
+        PRIMARY KEY (day, school, subType))''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS stats_purchase_daily (
+        day TEXT PRIMARY KEY,
+        approvedCount INTEGER DEFAULT 0,
+        approvedAmount REAL DEFAULT 0)''')
+
+    db.execute("CREATE INDEX IF NOT EXISTS idx_stats_dish_school_day ON stats_dish_daily (school, day)")
+
+    # Новый заказ: +1 к заказам дня (и к выданным, если сразу выдан)
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_insert_stats
+        AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO stats_dish_daily (day, school, dish, category, ordersCount, ordersAmount, issuedCount, issuedAmount)
+            VALUES (substr(NEW.createdAt, 1, 10),
+                    COALESCE((SELECT school FROM users WHERE username = NEW.user), ''),
+                    NEW.name,
+                    COALESCE((SELECT category FROM menu WHERE name = NEW.name ORDER BY id DESC LIMIT 1), ''),
+                    1, COALESCE(NEW.price, 0),
+                    NEW.status = '{ISSUED}', CASE WHEN NEW.status = '{ISSUED}' THEN COALESCE(NEW.price, 0) ELSE 0 END)
+            ON CONFLICT (day, school, dish) DO UPDATE SET
+                ordersCount = ordersCount + excluded.ordersCount,
+                ordersAmount = ordersAmount + excluded.ordersAmount,
+                issuedCount = issuedCount + excluded.issuedCount,
+                issuedAmount = issuedAmount + excluded.issuedAmount;
+        END''')
+
+    # Выдача заказа: +1 к выданным в день заказа
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_orders_issue_stats
+        AFTER UPDATE OF status ON orders
+        WHEN NEW.status = '{ISSUED}' AND OLD.status IS NOT '{ISSUED}'
+        BEGIN
+            INSERT INTO stats_dish_daily (day, school, dish, category, issuedCount, issuedAmount)
+            VALUES (substr(NEW.createdAt, 1, 10),
+                    COALESCE((SELECT school FROM users WHERE username = NEW.user), ''),
+                    NEW.name,
+                    COALESCE((SELECT category FROM menu WHERE name = NEW.name ORDER BY id DESC LIMIT 1), ''),
+                    1, COALESCE(NEW.price, 0))
+            ON CONFLICT (day, school, dish) DO UPDATE SET
+                issuedCount = issuedCount + 1,
+                issuedAmount = issuedAmount + excluded.issuedAmount;
+        END''')
+
+    db.execute('''CREATE TRIGGER IF NOT EXISTS trg_sub_tx_insert_stats
+        AFTER INSERT ON sub_transactions
+        BEGIN
+            INSERT INTO stats_sub_daily (day, school, subType, count, amount)
+            VALUES (substr(NEW.time, 1, 10),
+                    COALESCE((SELECT school FROM users WHERE username = NEW.user), ''),
+                    NEW.type, 1, COALESCE(NEW.amount, 0))
+            ON CONFLICT (day, school, subType) DO UPDATE SET
+                count = count + 1,
+                amount = amount + excluded.amount;
+        END''')
+
+    # У закупок нет даты создания — считаем расход днём одобрения
+    db.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_purchases_approve_stats
+        AFTER UPDATE OF status ON purchases
+        WHEN NEW.status = '{APPROVED}' AND OLD.status IS NOT '{APPROVED}'
+        BEGIN
+            INSERT INTO stats_purchase_daily (day, approvedCount, approvedAmount)
+            VALUES (date('now', 'localtime'), 1, COALESCE(NEW.price, 0))
+            ON CONFLICT (day) DO UPDATE SET
+                approvedCount = approvedCount + 1,
+                approvedAmount = approvedAmount + excluded.approvedAmount;
+        END''')
+
+
+def backfill_rollups(db):
+    """Однократно пересчитывает агрегаты по уже накопленной истории"""
+    db.execute("DELETE FROM stats_dish_daily")
+    db.execute("DELETE FROM stats_sub_daily")
+    db.execute("DELETE FROM stats_purchase_daily")
+
+    db.execute(f'''INSERT INTO stats_dish_daily
+            (day, school, dish, category, ordersCount, ordersAmount, issuedCount, issuedAmount)
+        SELECT substr(o.createdAt, 1, 10), COALESCE(u.school, ''), o.name,
+               COALESCE((SELECT category FROM menu WHERE name = o.name ORDER BY id DESC LIMIT 1), ''),
+               COUNT(*), SUM(COALESCE(o.price, 0)),
+               SUM(o.status = '{ISSUED}'), SUM(CASE WHEN o.status = '{ISSUED}' THEN COALESCE(o.price, 0) ELSE 0 END)
+        FROM orders o LEFT JOIN users u ON u.username = o.user
+        GROUP BY 1, 2, 3''')
+
+    db.execute('''INSERT INTO stats_sub_daily (day, school, subType, count, amount)
+        SELECT substr(t.time, 1, 10), COALESCE(u.school, ''), t.type, COUNT(*), SUM(COALESCE(t.amount, 0))
+        FROM sub_transactions t LEFT JOIN users u ON u.username = t.user
+        GROUP BY 1, 2, 3''')
+
+    # Дата одобрения старых закупок неизвестна — относим их на день пересчёта
+    db.execute(f'''INSERT INTO stats_purchase_daily (day, approvedCount, approvedAmount)
+        SELECT date('now', 'localtime'), COUNT(*), COALESCE(SUM(price), 0)
+        FROM purchases WHERE status = '{APPROVED}'
+        HAVING COUNT(*) > 0''')
+
+
+def query_stats(db, date_from=None, date_to=None, school=None, group=None):
+    """Итоги за период (даты YYYY-MM-DD включительно) и, если задан group, разбивка по нему"""
+    where, params = [], []
+    if date_from:
+        where.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("day <= ?")
+        params.append(date_to)
+    # Расходы на закупки не привязаны к школе
+    purchase_where, purchase_params = list(where), list(params)
+    if school:
+        where.append("school = ?")
+        params.append(school)
+
+    where_sql = " WHERE " + " AND ".join(where) if where else ""
+    purchase_sql = " WHERE " + " AND ".join(purchase_where) if purchase_where else ""
+
+    dish = db.execute(f'''SELECT COALESCE(SUM(ordersCount), 0), COALESCE(SUM(issuedCount), 0),
+                                 COALESCE(SUM(issuedAmount), 0)
+                          FROM stats_dish_daily{where_sql}''', params).fetchone()
+    sub_revenue = db.execute(f"SELECT COALESCE(SUM(amount), 0) FROM stats_sub_daily{where_sql}", params).fetchone()[0]
+    purchase_expense = db.execute(f"SELECT COALESCE(SUM(approvedAmount), 0) FROM stats_purchase_daily{purchase_sql}",
+                                  purchase_params).fetchone()[0]
+
+    orders_count, issued_count, dish_revenue = dish
+    result = {
+        "dishRevenue": dish_revenue,
+        "subRevenue": sub_revenue,
+        "purchaseExpense": purchase_expense,
+        "totalDishes": issued_count,
+        "ordersCount": orders_count,
+        "attendance": round(issued_count * 100 / orders_count) if orders_count else 0,
+    }
+
+    if group in GROUPS:
+        column = GROUPS[group]
+        result["breakdown"] = [dict(r) for r in db.execute(f'''
+            SELECT {column} AS key, SUM(ordersCount) AS ordersCount, SUM(ordersAmount) AS ordersAmount,
+                   SUM(issuedCount) AS issuedCount, SUM(issuedAmount) AS issuedAmount
+            FROM stats_dish_daily{where_sql}
+            GROUP BY {column} ORDER BY {column}''', params).fetchall()]
+    return result
+
+
+def merge_stats(results, group=None):
+    """Сводки query_stats нескольких баз (шардов школ) — одна сводка, как по общей базе"""
+    if len(results) == 1:
+        return results[0]
+    fields = ('dishRevenue', 'subRevenue', 'purchaseExpense', 'totalDishes', 'ordersCount')
+    merged = {f: sum(r[f] for r in results) for f in fields}
+    merged["attendance"] = round(merged["totalDishes"] * 100 / merged["ordersCount"]) if merged["ordersCount"] else 0
+
+    if group in GROUPS:
+        sums = ('ordersCount', 'ordersAmount', 'issuedCount', 'issuedAmount')
+        rows = {}
+        for r in results:
+            for row in r["breakdown"]:
+                total = rows.setdefault(row["key"], dict.fromkeys(sums, 0))
+                for f in sums:
+                    total[f] += row[f] or 0
+        # Порядок как у ORDER BY в SQLite: NULL первым
+        merged["breakdown"] = [dict(key=k, **rows[k]) for k in sorted(rows, key=lambda k: (k is not None, k or ''))]
+    return merged
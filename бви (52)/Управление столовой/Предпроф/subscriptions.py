@@ -0,0 +1,172 @@
+"""Права по абонементам: срок действия и остаток обедов.
+
+Раньше абонемент считался действующим, если в sub_transactions нашлась
+хоть одна покупка, — навсегда и без счёта обедов, а выдача по нему шла
+циклом: SELECT, UPDATE и INSERT на каждое блюдо. Теперь у пары
+(ученик, тип) одна строка entitlements: validFrom—validTo (включительно),
+mealsLeft и lastUsed — день последнего использования. buy_sub её создаёт
+или продлевает по цене из SUBSCRIPTION_PRICES (цену от клиента не
+берём), а выдача — постоянное число запросов при любом числе блюд:
+
+    1. UPDATE entitlements — проверка срока, остатка и «сегодня ещё не брал»
+       и списание обеда одним условным запросом;
+    2. UPDATE menu ... FROM json_each — списание порций всех выбранных блюд;
+    3. INSERT INTO orders ... SELECT FROM json_each — заказы пачкой;
+    4. INSERT INTO subscription_usage.
+
+Раскупленные блюда пропускаются; если не досталось ни одного, не
+списывается и обед.
+
+    SUBSCRIPTION_DAYS   срок абонемента, дней (30)
+    SUBSCRIPTION_MEALS  обедов в абонементе (22 — учебные дни месяца)
+"""
+import json
+import os
+from collections import Counter
+from datetime import datetime
+
+from ordering import OrderRejected, PAID, SOLD_OUT, begin_immediate
+
+SUBSCRIPTION_DAYS = int(os.environ.get('SUBSCRIPTION_DAYS', 30))
+SUBSCRIPTION_MEALS = int(os.environ.get('SUBSCRIPTION_MEALS', 22))
+
+# Цена абонемента, ₽ — та же, что на карточках в интерфейсе
+SUBSCRIPTION_PRICES = {'Завтраки': 3300, 'Обеды': 5500}
+SUBSCRIPTION_TYPES = tuple(SUBSCRIPTION_PRICES)
+
+NO_SUBSCRIPTION = ('no_subscription', 'У вас нет этого абонемента', 400)
+NOT_STARTED = ('subscription_not_started', 'Абонемент ещё не начал действовать', 400)
+EXPIRED = ('subscription_expired', 'Срок абонемента истёк', 400)
+NO_MEALS = ('no_meals_left', 'По абонементу не осталось обедов', 400)
+USED_TODAY = ('used_today', 'Вы уже использовали абонемент сегодня', 400)
+NO_DISHES = ('no_dishes', 'Выберите блюда', 400)
+
+
+def install_entitlements(db):
+    """Таблица прав, заполненная по истории покупок и использований"""
+    db.execute('''CREATE TABLE IF NOT EXISTS entitlements (
+        user TEXT NOT NULL,
+        type TEXT NOT NULL,
+        validFrom TEXT,
+        validTo TEXT,
+        mealsLeft INTEGER NOT NULL DEFAULT 0,
+        lastUsed TEXT,
+        updatedAt TEXT,
+        UNIQUE (user, type))''')
+    backfill_entitlements(db)
+
+
+def backfill_entitlements(db, days=SUBSCRIPTION_DAYS, meals=SUBSCRIPTION_MEALS):
+    """Права по последней покупке каждого абонемента за вычетом использований с её даты.
+
+    Уже заведённые права не трогает. Возвращает число добавленных.
+    """
+    return db.execute(f'''INSERT INTO entitlements (user, type, validFrom, validTo, mealsLeft, lastUsed, updatedAt)
+        SELECT p.user, p.type, p.day, date(p.day, '+{days - 1} days'),
+               MAX(0, ? - (SELECT COUNT(*) FROM subscription_usage u
+                           WHERE u.user = p.user AND u.subType = p.type AND u.date >= p.day)),
+               (SELECT MAX(date) FROM subscription_usage u WHERE u.user = p.user AND u.subType = p.type), ?
+        FROM (SELECT user, type, date(MAX(time)) AS day FROM sub_transactions GROUP BY user, type) p
+        WHERE true
+        ON CONFLICT (user, type) DO NOTHING''', (meals, datetime.now().isoformat())).rowcount
+
+
+def grant(db, user, sub_type, today, days=SUBSCRIPTION_DAYS, meals=SUBSCRIPTION_MEALS):
+    """Выдаёт или продлевает абонемент: действующий продлевается на days дней и пополняется
+    на meals обедов, истёкший начинается заново с today. Возвращает (validTo, mealsLeft)"""
+    return tuple(db.execute(f'''INSERT INTO entitlements (user, type, validFrom, validTo, mealsLeft, updatedAt)
+        VALUES (:user, :type, :today, date(:today, '+{days - 1} days'), :meals, :now)
+        ON CONFLICT (user, type) DO UPDATE SET
+            validFrom = CASE WHEN validTo < :today THEN :today ELSE validFrom END,
+            mealsLeft = CASE WHEN validTo < :today THEN 0 ELSE mealsLeft END + :meals,
+            validTo = date(MAX(validTo, date(:today, '-1 day')), '+{days} days'),
+            updatedAt = :now
+        RETURNING validTo, mealsLeft''',
+        {"user": user, "type": sub_type, "today": today, "meals": meals,
+         "now": datetime.now().isoformat()}).fetchone())
+
+
+def purchase(db, user, sub_type, created_at):
+    """Покупка абонемента: запись покупки, списание по серверной цене и выдача права.
+
+    Транзакция записи остаётся открытой. Возвращает (цена, validTo, mealsLeft),
+    при отказе откатывает изменения этой покупки и бросает OrderRejected.
+    """
+    from ledger import debit, to_kopecks  # ledger.py зависит от ordering.py, как и этот модуль
+
+    price = SUBSCRIPTION_PRICES[sub_type]
+    begin_immediate(db)
+    db.execute("SAVEPOINT buy_sub")
+    try:
+        # Сначала покупка, чтобы строка журнала ссылалась на неё; при отказе обе откатываются
+        tx = db.execute("INSERT INTO sub_transactions (user, type, amount, time) VALUES (?,?,?,?)",
+                        (user, sub_type, price, created_at)).lastrowid
+        debit(db, user, to_kopecks(price), 'subscription', tx, created_at)
+    except BaseException:
+        db.execute("ROLLBACK TO buy_sub")
+        db.execute("RELEASE buy_sub")
+        raise
+    db.execute("RELEASE buy_sub")
+    return (price,) + grant(db, user, sub_type, created_at[:10])
+
+
+def _rejection(db, user, sub_type, today):
+    """Почему право не списалось (только на пути отказа)"""
+    row = db.execute("SELECT validFrom, validTo, mealsLeft, lastUsed FROM entitlements WHERE user = ? AND type = ?",
+                     (user, sub_type)).fetchone()
+    if row is None:
+        return NO_SUBSCRIPTION
+    if row['lastUsed'] is not None and row['lastUsed'] >= today:
+        return USED_TODAY
+    if row['validFrom'] > today:
+        return NOT_STARTED
+    if row['validTo'] < today:
+        return EXPIRED
+    return NO_MEALS
+
+
+def redeem(db, user, sub_type, dish_ids, allergies, created_at, today):
+    """Обед по абонементу: право, порции, заказы и запись использования в одной транзакции записи.
+
+    Транзакция остаётся открытой — её фиксирует вызывающий код. Возвращает
+    (заказы [(id, name)], остатки [(id блюда, portions)], обедов осталось),
+    при отказе откатывает свои изменения и бросает OrderRejected.
+    """
+    dish_ids = [int(d) for d in dish_ids or () if isinstance(d, int) or (isinstance(d, str) and d.isdigit())]
+    wanted = Counter(dish_ids)
+    if not wanted:
+        raise OrderRejected(*NO_DISHES)
+
+    begin_immediate(db)
+    db.execute("SAVEPOINT redeem")
+    try:
+        left = db.execute('''UPDATE entitlements SET mealsLeft = mealsLeft - 1, lastUsed = :today, updatedAt = :now
+            WHERE user = :user AND type = :type AND validFrom <= :today AND validTo >= :today
+              AND mealsLeft > 0 AND (lastUsed IS NULL OR lastUsed < :today)
+            RETURNING mealsLeft''', {"user": user, "type": sub_type, "today": today,
+                                     "now": datetime.now().isoformat()}).fetchone()
+        if left is None:
+            raise OrderRejected(*_rejection(db, user, sub_type, today))
+
+        # Блюдо, выбранное n раз, списывается только если осталось не меньше n порций
+        reserved = db.execute('''UPDATE menu SET portions = menu.portions - x.n
+            FROM (SELECT CAST(key AS INTEGER) AS id, value AS n FROM json_each(?)) AS x
+            WHERE menu.id = x.id AND menu.portions >= x.n
+            RETURNING menu.id, menu.name, menu.portions''', (json.dumps(wanted),)).fetchall()
+        if not reserved:
+            raise OrderRejected(*SOLD_OUT)
+    except BaseException:
+        db.execute("ROLLBACK TO redeem")
+        db.execute("RELEASE redeem")
+        raise
+    db.execute("RELEASE redeem")
+
+    names = {r[0]: r[1] for r in reserved}
+    # Заказы — в порядке выбора блюд
+    selected = [names[d] for d in dish_ids if d in names]
+    orders = db.execute('''INSERT INTO orders (user, name, price, status, allergies, createdAt)
+        SELECT ?, value, 0, ?, ?, ? FROM json_each(?)
+        RETURNING id, name''', (user, PAID, allergies, created_at, json.dumps(selected))).fetchall()
+    db.execute("INSERT INTO subscription_usage (user, subType, date, dishesUsed, createdAt) VALUES (?,?,?,?,?)",
+               (user, sub_type, today, ', '.join(selected), created_at))
+    return [tuple(r) for r in orders], [(r[0], r[2]) for r in reserved], left[0]
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Модули приложения лежат рядом с app.py, а не в пакете
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app при импорте создаёт и заполняет базу — в тестах во временном каталоге, а не рядом с кодом
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'canteen_full.db'))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Пустая база со всеми миграциями"""
+    from db import connect
+    from migrations import migrate
+
+    path = str(tmp_path / 'canteen.db')
+    db = connect(path)
+    migrate(db, log=lambda *a, **k: None)
+    db.close()
+    return path
@@ -0,0 +1,90 @@
+"""Пакет /api/action/batch: all откатывает всё на первой ошибке, best_effort — только ошибочные.
+
+База приложения — временная (conftest.py); каждый тест заводит своего ученика
+и своё блюдо, чтобы не зависеть от порядка тестов.
+"""
+import itertools
+
+import pytest
+
+from app import app
+from db import get_db
+
+PRICE = 100
+
+_ids = itertools.count()
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def student():
+    """Ученик с деньгами на две порции и блюдо с тремя порциями"""
+    n = next(_ids)
+    user = f'batch{n}'
+    with get_db() as db:
+        db.execute("INSERT INTO users (username, password, fullName, role, school, balance, isApproved) "
+                   "VALUES (?, '-', ?, 'student', 'ГБОУ Школа №656', ?, 1)", (user, user, 2 * PRICE))
+        menu_id = db.execute("INSERT INTO menu (name, price, portions) VALUES (?, ?, 3)",
+                             (f'Суп {n}', PRICE)).lastrowid
+        db.commit()
+    return user, menu_id
+
+
+def _state(user, menu_id):
+    with get_db() as db:
+        return (db.execute("SELECT balance FROM users WHERE username = ?", (user,)).fetchone()[0],
+                db.execute("SELECT portions FROM menu WHERE id = ?", (menu_id,)).fetchone()[0],
+                db.execute("SELECT COUNT(*) FROM orders WHERE user = ?", (user,)).fetchone()[0])
+
+
+def _buy(user, menu_id):
+    return {'type': 'buy', 'user': user, 'menuId': menu_id}
+
+
+def test_all_rolls_back_whole_batch(client, student):
+    user, menu_id = student
+    # Третья покупка — на деньги, которых уже нет
+    r = client.post('/api/action/batch', json={'mode': 'all', 'actions': [
+        _buy(user, menu_id), _buy(user, menu_id), _buy(user, menu_id), _buy(user, menu_id)]})
+
+    body = r.get_json()
+    assert r.status_code == 402
+    assert body['ok'] is False and body['failed'] == 2
+    assert [x.get('rolledBack') for x in body['results'][:2]] == [True, True]
+    assert body['results'][2]['code'] == 'insufficient_funds'
+    assert body['results'][3]['skipped'] is True
+    assert _state(user, menu_id) == (2 * PRICE, 3, 0)
+
+
+def test_best_effort_rolls_back_only_failed(client, student):
+    user, menu_id = student
+    r = client.post('/api/action/batch', json={'mode': 'best_effort', 'actions': [
+        _buy(user, menu_id), {'type': 'no_such_action'}, _buy(user, menu_id), _buy(user, menu_id)]})
+
+    body = r.get_json()
+    assert r.status_code == 200
+    assert body['ok'] is False
+    assert [x['ok'] for x in body['results']] == [True, False, True, False]
+    assert body['results'][3]['code'] == 'insufficient_funds'
+    assert _state(user, menu_id) == (0, 1, 2)
+
+
+def test_best_effort_all_ok(client, student):
+    user, menu_id = student
+    r = client.post('/api/action/batch', json={'mode': 'best_effort', 'actions': [_buy(user, menu_id)]})
+
+    assert r.get_json()['ok'] is True
+    assert _state(user, menu_id) == (PRICE, 2, 1)
+
+
+@pytest.mark.parametrize('payload', [
+    {'mode': 'some', 'actions': [{'type': 'buy'}]},
+    {'mode': 'all', 'actions': []},
+    {'mode': 'all'},
+])
+def test_rejects_malformed_batch(client, payload):
+    assert client.post('/api/action/batch', json=payload).status_code == 400
@@ -0,0 +1,110 @@
+"""Журнал денежных операций: отказ без строки журнала, покупка абонемента, сверка."""
+import itertools
+import sqlite3
+
+import pytest
+
+from db import connect
+from ledger import balance, credit, debit, reconcile
+from ordering import OrderRejected
+from subscriptions import SUBSCRIPTION_PRICES, purchase
+
+NOW = '2026-03-02T12:00:00'
+
+_ids = itertools.count()
+
+
+@pytest.fixture
+def db(db_path):
+    db = connect(db_path)
+    # 300 ₽ — строка opening от триггера на users
+    db.execute("INSERT INTO users (username, password, fullName, role, school, balance) "
+               "VALUES ('u', '-', 'u', 'student', 'Школа', 300)")
+    db.commit()
+    yield db
+    db.close()
+
+
+def _entries(db, user='u'):
+    return db.execute("SELECT COUNT(*) FROM ledger WHERE user = ?", (user,)).fetchone()[0]
+
+
+def test_debit(db):
+    assert debit(db, 'u', 10050, 'order', 1, NOW)
+    db.commit()
+    assert balance(db, 'u') == 19950
+    assert db.execute("SELECT balance FROM users WHERE username = 'u'").fetchone()[0] == 199.5
+
+
+def test_debit_insufficient_funds_writes_nothing(db):
+    with pytest.raises(OrderRejected) as e:
+        debit(db, 'u', 30001, 'order', 1, NOW)
+    db.rollback()
+
+    assert e.value.code == 'insufficient_funds'
+    assert _entries(db) == 1
+    assert balance(db, 'u') == 30000
+
+
+@pytest.mark.parametrize('operation', [debit, credit])
+def test_negative_amount_rejected(db, operation):
+    with pytest.raises(OrderRejected) as e:
+        operation(db, 'u', -100, 'refill', None, NOW)
+    db.rollback()
+
+    assert e.value.code == 'invalid'
+    assert _entries(db) == 1
+
+
+def test_purchase_rolls_back_when_debit_fails(db):
+    # На абонемент 300 ₽ не хватает: ни покупки, ни права, ни строки журнала
+    with pytest.raises(OrderRejected) as e:
+        purchase(db, 'u', 'Обеды', NOW)
+    db.rollback()
+
+    assert e.value.code == 'insufficient_funds'
+    for table in ('sub_transactions', 'entitlements'):
+        assert db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
+    assert _entries(db) == 1
+
+
+def test_buy_sub_ignores_client_price():
+    from app import app
+    from db import get_db
+
+    user = f'sub{next(_ids)}'
+    price = SUBSCRIPTION_PRICES['Завтраки']
+    with get_db() as db:
+        db.execute("INSERT INTO users (username, password, fullName, role, school, balance, isApproved) "
+                   "VALUES (?, '-', ?, 'student', 'ГБОУ Школа №656', ?, 1)", (user, user, price + 1))
+        db.commit()
+
+    r = app.test_client().post('/api/action', json={
+        'type': 'buy_sub', 'user': user, 'subType': 'Завтраки', 'price': 1})
+
+    assert r.get_json() == {'ok': True}
+    with get_db() as db:
+        assert balance(db, user) == 100
+        assert db.execute("SELECT amount FROM sub_transactions WHERE user = ?", (user,)).fetchone()[0] == price
+
+
+def test_reconcile_finds_tampered_balance(db):
+    assert reconcile(db)['mismatches'] == []
+
+    # Правка копии мимо журнала
+    db.execute("UPDATE users SET balance = 1000000 WHERE username = 'u'")
+    db.commit()
+
+    result = reconcile(db, fix=True)
+    assert result['mismatches'] == [{"user": 'u', "problem": "mirror", "ledger": 30000, "mirror": 100000000}]
+    assert result['fixed'] == 1
+    assert reconcile(db)['mismatches'] == []
+    assert db.execute("SELECT balance FROM users WHERE username = 'u'").fetchone()[0] == 300
+
+
+@pytest.mark.parametrize('statement', ["UPDATE ledger SET amount = 1000000", "DELETE FROM ledger"])
+def test_ledger_is_append_only(db, statement):
+    with pytest.raises(sqlite3.DatabaseError, match='append-only'):
+        db.execute(statement)
+    db.rollback()
+    assert _entries(db) == 1
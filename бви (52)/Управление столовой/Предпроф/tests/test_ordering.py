@@ -0,0 +1,96 @@
+"""Покупка под конкуренцией: порции и деньги не уходят в минус.
+
+Потоки со своими соединениями одновременно вызывают place_order на временной
+базе — так же, как воркеры сервера пишут в общий файл SQLite.
+"""
+import threading
+from datetime import datetime
+
+from db import connect
+from ledger import reconcile
+from ordering import BUSY, OrderRejected, place_order
+
+THREADS = 32
+PORTIONS = 10
+PRICE = 100
+
+
+def _setup(path, balances, portions):
+    db = connect(path)
+    db.executemany("INSERT INTO users (username, password, fullName, role, school, balance) VALUES (?,?,?,?,?,?)",
+                   [(name, '-', name, 'student', 'Школа', balance) for name, balance in balances.items()])
+    menu_id = db.execute("INSERT INTO menu (name, price, portions) VALUES ('Суп', ?, ?)",
+                         (PRICE, portions)).lastrowid
+    db.commit()
+    db.close()
+    return menu_id
+
+
+def _buy_concurrently(path, users, menu_id):
+    """Каждый поток — своё соединение и одна покупка; возвращает коды отказов"""
+    start = threading.Barrier(len(users))
+    rejected, lock = [], threading.Lock()
+
+    def buy(user):
+        db = connect(path)
+        start.wait()
+        try:
+            while True:
+                try:
+                    place_order(db, user, menu_id, '', datetime.now().isoformat())
+                    db.commit()
+                    return
+                except OrderRejected as e:
+                    db.rollback()
+                    # Занятая база — не отказ по сути, повторяем
+                    if e.code != BUSY[0]:
+                        with lock:
+                            rejected.append(e.code)
+                        return
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=buy, args=(u,)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return rejected
+
+
+def _check_invariants(path, menu_id):
+    db = connect(path)
+    try:
+        assert db.execute("SELECT MIN(balance) FROM users").fetchone()[0] >= 0
+        assert reconcile(db)['mismatches'] == []
+        return (db.execute("SELECT COUNT(*) FROM orders").fetchone()[0],
+                db.execute("SELECT portions FROM menu WHERE id = ?", (menu_id,)).fetchone()[0])
+    finally:
+        db.close()
+
+
+def test_no_overselling(db_path):
+    users = [f'u{i}' for i in range(THREADS)]
+    menu_id = _setup(db_path, {u: 10 * PRICE for u in users}, PORTIONS)
+
+    rejected = _buy_concurrently(db_path, users, menu_id)
+
+    orders, portions = _check_invariants(db_path, menu_id)
+    assert orders == PORTIONS
+    assert portions == 0
+    assert rejected == ['sold_out'] * (THREADS - PORTIONS)
+
+
+def test_no_overspending(db_path):
+    # Один ученик с деньгами на PORTIONS порций покупает из всех потоков разом
+    menu_id = _setup(db_path, {'u': PORTIONS * PRICE}, THREADS)
+
+    rejected = _buy_concurrently(db_path, ['u'] * THREADS, menu_id)
+
+    orders, portions = _check_invariants(db_path, menu_id)
+    assert orders == PORTIONS
+    assert portions == THREADS - PORTIONS
+    assert rejected == ['insufficient_funds'] * (THREADS - PORTIONS)
+    db = connect(db_path)
+    assert db.execute("SELECT balance FROM users WHERE username = 'u'").fetchone()[0] == 0
+    db.close()
@@ -0,0 +1,145 @@
+"""Абонементы: выдача и продление (grant), обед по абонементу (redeem)."""
+from datetime import date, timedelta
+
+import pytest
+
+from db import connect
+from ordering import OrderRejected
+from subscriptions import SUBSCRIPTION_DAYS, SUBSCRIPTION_MEALS, grant, redeem
+
+TODAY = '2026-03-02'
+SUB = 'Обеды'
+
+
+def _day(offset):
+    return (date.fromisoformat(TODAY) + timedelta(days=offset)).isoformat()
+
+
+@pytest.fixture
+def db(db_path):
+    db = connect(db_path)
+    db.execute("INSERT INTO users (username, password, fullName, role, school) "
+               "VALUES ('u', '-', 'u', 'student', 'Школа')")
+    db.commit()
+    yield db
+    db.close()
+
+
+def _dish(db, portions, name='Суп'):
+    menu_id = db.execute("INSERT INTO menu (name, price, portions) VALUES (?, 100, ?)", (name, portions)).lastrowid
+    db.commit()
+    return menu_id
+
+
+def _redeem(db, dishes, today=TODAY):
+    result = redeem(db, 'u', SUB, dishes, '', f'{today}T12:00', today)
+    db.commit()
+    return result
+
+
+def _rejected(db, dishes, today=TODAY):
+    with pytest.raises(OrderRejected) as e:
+        _redeem(db, dishes, today)
+    db.rollback()
+    return e.value.code
+
+
+def _entitlement(db):
+    return db.execute("SELECT validFrom, validTo, mealsLeft, lastUsed FROM entitlements "
+                      "WHERE user = 'u' AND type = ?", (SUB,)).fetchone()
+
+
+def test_grant_new(db):
+    assert grant(db, 'u', SUB, TODAY) == (_day(SUBSCRIPTION_DAYS - 1), SUBSCRIPTION_MEALS)
+    assert _entitlement(db)['validFrom'] == TODAY
+
+
+def test_grant_extends_active(db):
+    grant(db, 'u', SUB, TODAY)
+    _redeem(db, [_dish(db, 5)])
+
+    # Продление до конца срока: срок и обеды добавляются к оставшимся
+    assert grant(db, 'u', SUB, _day(10)) == (_day(2 * SUBSCRIPTION_DAYS - 1), 2 * SUBSCRIPTION_MEALS - 1)
+    assert _entitlement(db)['validFrom'] == TODAY
+
+
+def test_grant_restarts_expired(db):
+    grant(db, 'u', SUB, TODAY)
+    restart = _day(SUBSCRIPTION_DAYS + 5)
+
+    # Неиспользованные обеды истёкшего абонемента не переносятся
+    assert grant(db, 'u', SUB, restart) == (_day(2 * SUBSCRIPTION_DAYS + 4), SUBSCRIPTION_MEALS)
+    assert _entitlement(db)['validFrom'] == restart
+
+
+def test_redeem(db):
+    grant(db, 'u', SUB, TODAY)
+    soup, salad = _dish(db, 5), _dish(db, 5, 'Салат')
+
+    orders, left, meals = _redeem(db, [soup, salad])
+
+    assert [name for _, name in orders] == ['Суп', 'Салат']
+    assert sorted(left) == [(soup, 4), (salad, 4)]
+    assert meals == SUBSCRIPTION_MEALS - 1
+    assert _entitlement(db)['lastUsed'] == TODAY
+    assert db.execute("SELECT COUNT(*) FROM subscription_usage").fetchone()[0] == 1
+
+
+def test_redeem_without_subscription(db):
+    assert _rejected(db, [_dish(db, 5)]) == 'no_subscription'
+
+
+def test_redeem_used_today(db):
+    grant(db, 'u', SUB, TODAY)
+    soup = _dish(db, 5)
+    _redeem(db, [soup])
+
+    assert _rejected(db, [soup]) == 'used_today'
+    # На следующий день — снова можно
+    _redeem(db, [soup], _day(1))
+
+
+def test_redeem_expired(db):
+    grant(db, 'u', SUB, TODAY)
+    assert _rejected(db, [_dish(db, 5)], _day(SUBSCRIPTION_DAYS)) == 'subscription_expired'
+
+
+def test_redeem_not_started(db):
+    grant(db, 'u', SUB, TODAY)
+    assert _rejected(db, [_dish(db, 5)], _day(-1)) == 'subscription_not_started'
+
+
+def test_redeem_no_meals_left(db):
+    grant(db, 'u', SUB, TODAY, meals=1)
+    soup = _dish(db, 5)
+    _redeem(db, [soup])
+
+    assert _rejected(db, [soup], _day(1)) == 'no_meals_left'
+
+
+def test_redeem_no_dishes(db):
+    grant(db, 'u', SUB, TODAY)
+    assert _rejected(db, []) == 'no_dishes'
+
+
+def test_dish_picked_twice_needs_two_portions(db):
+    grant(db, 'u', SUB, TODAY)
+    soup, salad = _dish(db, 1), _dish(db, 2, 'Салат')
+
+    # Суп выбран дважды, а порция одна — он пропускается целиком; салата хватает на оба
+    orders, left, _ = _redeem(db, [soup, soup, salad, salad])
+
+    assert [name for _, name in orders] == ['Салат', 'Салат']
+    assert left == [(salad, 0)]
+    assert db.execute("SELECT portions FROM menu WHERE id = ?", (soup,)).fetchone()[0] == 1
+
+
+def test_all_sold_out_keeps_meal(db):
+    grant(db, 'u', SUB, TODAY)
+
+    assert _rejected(db, [_dish(db, 0), _dish(db, 0, 'Салат')]) == 'sold_out'
+
+    # Обед не списан, день не отмечен, заказов и использований нет
+    assert tuple(_entitlement(db))[2:] == (SUBSCRIPTION_MEALS, None)
+    assert db.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM subscription_usage").fetchone()[0] == 0